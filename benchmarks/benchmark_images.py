@@ -0,0 +1,359 @@
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+from PIL import Image
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Directorios de las herramientas que se miden
+TOOL_PATHS = {
+    'watermark': os.path.join(REPO_ROOT, 'watermark_photos', 'api'),
+    'aspect_ratio': os.path.join(REPO_ROOT, 'aspect_ratio'),
+    'stripe': os.path.join(REPO_ROOT, 'frontmatter'),
+}
+
+# Módulo de cada herramienta
+TOOL_MODULES = {
+    'watermark': 'watermark_engine',
+    'aspect_ratio': 'aspect_ratio',
+    'stripe': 'frontmatter',
+}
+
+DEFAULT_SIZES = '1,12,24,50'
+DEFAULT_MODES = 'RGB,RGBA,P,L'
+DEFAULT_SEED = 1234
+
+# Formato en el que se guarda cada imagen sintética (las herramientas leen
+# archivos): JPEG como una foto real cuando el modo lo permite y PNG rápido si no
+SOURCE_FORMATS = {'RGB': 'JPEG', 'L': 'JPEG', 'RGBA': 'PNG', 'P': 'PNG'}
+
+# Umbrales por defecto de compare: aumento relativo y mínimo absoluto para que
+# una diferencia cuente como regresión (por debajo es ruido de medida)
+DEFAULT_TIME_THRESHOLD = 0.10
+MIN_TIME_DIFFERENCE = 0.005
+DEFAULT_MEMORY_THRESHOLD = 0.10
+MIN_MEMORY_DIFFERENCE_MB = 5
+
+def synthetic_size(megapixels):
+    """Tamaño (ancho, alto) de 3:2 con el número de megapíxeles indicado."""
+    width = int((megapixels * 1_000_000 * 1.5) ** 0.5)
+    return width, int(width / 1.5)
+
+def make_synthetic_image(megapixels, mode, seed=DEFAULT_SEED):
+    """
+    Genera una imagen sintética reproducible en el modo indicado.
+
+    Es un degradado con ruido de semilla fija, para que el coste de codificar y
+    decodificar se parezca al de una foto real y sea el mismo en cada ejecución.
+    """
+    width, height = synthetic_size(megapixels)
+    rng = np.random.default_rng(seed)
+    gradient = np.linspace(0, 200, width, dtype=np.float32)[np.newaxis, :]
+
+    if mode == 'P':
+        # Índices de paleta directamente, sin cuantizar (que con 50 MP es lento)
+        noise = rng.integers(0, 56, (height, width), dtype=np.uint8)
+        img = Image.fromarray((gradient + noise).astype(np.uint8), 'L')
+        img = img.convert('P')
+        img.putpalette(rng.integers(0, 256, 768, dtype=np.uint8).tobytes())
+        return img
+
+    noise = rng.integers(0, 56, (height, width, 3), dtype=np.uint8)
+    img = Image.fromarray((gradient[..., np.newaxis] + noise).astype(np.uint8), 'RGB')
+    if mode == 'RGBA':
+        alpha = np.linspace(64, 255, height, dtype=np.float32)[:, np.newaxis]
+        img.putalpha(Image.fromarray(np.broadcast_to(alpha, (height, width)).astype(np.uint8), 'L'))
+    elif mode != 'RGB':
+        img = img.convert(mode)
+    return img
+
+def source_image(cache_dir, megapixels, mode, seed):
+    """
+    Devuelve la ruta de la imagen sintética de un caso, generándola si no existe.
+
+    Las imágenes se guardan en cache_dir para no regenerarlas en cada ejecución.
+    """
+    image_format = SOURCE_FORMATS[mode]
+    extension = '.jpg' if image_format == 'JPEG' else '.png'
+    path = os.path.join(cache_dir, f"synthetic_{seed}_{megapixels}mp_{mode}{extension}")
+    if not os.path.exists(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        img = make_synthetic_image(megapixels, mode, seed)
+        options = {'quality': 90} if image_format == 'JPEG' else {'compress_level': 1}
+        temp_path = f"{path}.tmp"
+        img.save(temp_path, image_format, **options)
+        os.replace(temp_path, path)
+    return path
+
+def peak_rss_mb():
+    """Memoria residente máxima de este proceso hasta ahora, en MB."""
+    # En Linux, VmHWM es solo de este programa; ru_maxrss conserva tras exec el
+    # máximo del proceso padre (el que genera las imágenes sintéticas)
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux la da en KB y macOS en bytes
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def run_watermark(path, scratch_dir):
+    """create_watermark con las etapas que mide el propio motor."""
+    from watermark_engine import create_watermark
+    timings = {}
+    start = time.perf_counter()
+    img = Image.open(path)
+    timings['open'] = time.perf_counter() - start
+    create_watermark(img, io.BytesIO(), 'bench', timings=timings)
+    return timings
+
+def run_aspect_ratio(path, scratch_dir):
+    """crop_to_aspect_ratio (decodificación y recorte) y el guardado PNG de process_images."""
+    from aspect_ratio import crop_to_aspect_ratio
+    timings = {}
+    start = time.perf_counter()
+    cropped = crop_to_aspect_ratio(path, '16:9')
+    timings['crop'] = time.perf_counter() - start
+    start = time.perf_counter()
+    cropped.save(io.BytesIO(), 'PNG')
+    timings['save'] = time.perf_counter() - start
+    return timings
+
+def run_stripe(path, scratch_dir):
+    """add_translucent_center_stripe completa (decodificación, composición y guardado PNG)."""
+    from frontmatter import add_translucent_center_stripe
+    output_path = os.path.join(scratch_dir, 'stripe.png')
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        add_translucent_center_stripe(path, output_path, (178, 238, 248), 0.3, 200)
+    return {'stripe': time.perf_counter() - start}
+
+TOOLS = {
+    'watermark': run_watermark,
+    'aspect_ratio': run_aspect_ratio,
+    'stripe': run_stripe,
+}
+
+def run_case(tool, path, repeat, warmup):
+    """
+    Ejecuta un caso en el proceso actual (lo llama run_suite en un subproceso).
+
+    Returns:
+        dict: Mediana de cada etapa y del total, y memoria máxima
+    """
+    sys.path.insert(0, TOOL_PATHS[tool])
+    function = TOOLS[tool]
+    with tempfile.TemporaryDirectory() as scratch_dir:
+        # Importar la herramienta antes de medir la memoria base
+        importlib.import_module(TOOL_MODULES[tool])
+        baseline_rss = peak_rss_mb()
+
+        for _ in range(warmup):
+            function(path, scratch_dir)
+        runs = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            stages = function(path, scratch_dir)
+            stages['total'] = time.perf_counter() - start
+            runs.append(stages)
+
+    stages = {name: statistics.median(run.get(name, 0.0) for run in runs) for name in runs[0]}
+    total = stages.pop('total')
+    return {
+        'stages': stages,
+        'total': total,
+        'total_min': min(run['total'] for run in runs),
+        'baseline_rss_mb': round(baseline_rss, 1),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+
+def environment():
+    """Versiones y máquina con las que se han medido los resultados."""
+    import PIL
+    return {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'pillow': PIL.__version__,
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+    }
+
+def run_suite(tools, sizes, modes, repeat, warmup, seed, cache_dir):
+    """
+    Mide cada combinación de herramienta, tamaño y modo en un subproceso propio,
+    para que la memoria máxima de un caso no se mezcle con la de los demás.
+
+    Returns:
+        dict: Resultados listos para guardar como JSON
+    """
+    results = {}
+    for megapixels in sizes:
+        for mode in modes:
+            path = source_image(cache_dir, megapixels, mode, seed)
+            for tool in tools:
+                key = f"{tool}/{mode}/{megapixels}MP"
+                print(f"{key}...", end=' ', flush=True)
+                command = [sys.executable, os.path.abspath(__file__), '_case', tool, path,
+                           '--repeat', str(repeat), '--warmup', str(warmup)]
+                completed = subprocess.run(command, capture_output=True, text=True)
+                if completed.returncode != 0:
+                    error = completed.stderr.strip().splitlines()[-1:] or ['sin salida']
+                    print(f"error: {error[0]}")
+                    results[key] = {'error': error[0]}
+                    continue
+                case = json.loads(completed.stdout.strip().splitlines()[-1])
+                case.update(tool=tool, mode=mode, megapixels=megapixels,
+                            size=list(synthetic_size(megapixels)),
+                            source_format=SOURCE_FORMATS[mode])
+                results[key] = case
+                print(f"{case['total']:.3f} s, {case['peak_rss_mb']:.0f} MB")
+
+    return {
+        'environment': environment(),
+        'settings': {'repeat': repeat, 'warmup': warmup, 'seed': seed},
+        'results': results,
+    }
+
+def compare(baseline, current, time_threshold=DEFAULT_TIME_THRESHOLD,
+            memory_threshold=DEFAULT_MEMORY_THRESHOLD):
+    """
+    Compara dos resultados de run_suite.
+
+    Un caso es una regresión si su tiempo total o su memoria máxima crecen más
+    que el umbral relativo y, además, más que un mínimo absoluto.
+
+    Returns:
+        tuple: (líneas del informe, número de regresiones)
+    """
+    lines = [f"{'Caso':<28} {'Base (s)':>9} {'Actual (s)':>10} {'Cambio':>8} "
+             f"{'Base MB':>8} {'Actual MB':>9} {'Cambio':>8}"]
+    regressions = 0
+    for key, new in current['results'].items():
+        old = baseline['results'].get(key)
+        if old is None or 'error' in old or 'error' in new:
+            continue
+        time_change = new['total'] / old['total'] - 1 if old['total'] else 0.0
+        memory_change = new['peak_rss_mb'] / old['peak_rss_mb'] - 1 if old['peak_rss_mb'] else 0.0
+        flags = []
+        if (time_change > time_threshold
+                and new['total'] - old['total'] > MIN_TIME_DIFFERENCE):
+            flags.append('TIEMPO')
+        if (memory_change > memory_threshold
+                and new['peak_rss_mb'] - old['peak_rss_mb'] > MIN_MEMORY_DIFFERENCE_MB):
+            flags.append('MEMORIA')
+        lines.append(f"{key:<28} {old['total']:>9.3f} {new['total']:>10.3f} {time_change:>+8.1%} "
+                     f"{old['peak_rss_mb']:>8.0f} {new['peak_rss_mb']:>9.0f} {memory_change:>+8.1%}"
+                     + (f"  <- {' y '.join(flags)}" if flags else ''))
+        if flags:
+            regressions += 1
+            # Detallar qué etapas han empeorado
+            for stage, seconds in new['stages'].items():
+                before = old['stages'].get(stage)
+                if before and seconds - before > MIN_TIME_DIFFERENCE:
+                    lines.append(f"    {stage:<24} {before:>9.3f} {seconds:>10.3f} "
+                                 f"{seconds / before - 1:>+8.1%}")
+
+    missing = sorted(set(baseline['results']) - set(current['results']))
+    if missing:
+        lines.append(f"Casos de la base que no se han medido: {', '.join(missing)}")
+    return lines, regressions
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Mide el tiempo por etapa y la memoria máxima de las herramientas de imagen "
+                    "con imágenes sintéticas")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help="Ejecuta las mediciones y guarda un JSON")
+    run_parser.add_argument('--tools', default=','.join(TOOLS),
+                            help="Herramientas separadas por comas (%(default)s)")
+    run_parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                            help="Megapíxeles separados por comas (%(default)s)")
+    run_parser.add_argument('--modes', default=DEFAULT_MODES,
+                            help="Modos de imagen separados por comas (%(default)s)")
+    run_parser.add_argument('--repeat', type=int, default=3, help="Repeticiones por caso")
+    run_parser.add_argument('--warmup', type=int, default=1,
+                            help="Ejecuciones previas que no se miden")
+    run_parser.add_argument('--seed', type=int, default=DEFAULT_SEED,
+                            help="Semilla de las imágenes sintéticas")
+    run_parser.add_argument('--cache-dir',
+                            default=os.path.join(tempfile.gettempdir(), 'videotools-benchmarks'),
+                            help="Directorio donde se guardan las imágenes sintéticas")
+    run_parser.add_argument('--output', help="Archivo JSON de resultados "
+                            "(por defecto benchmarks/results/<fecha>.json)")
+
+    compare_parser = subparsers.add_parser(
+        'compare', help="Compara unos resultados con una base guardada")
+    compare_parser.add_argument('baseline', help="JSON de la base")
+    compare_parser.add_argument('current', help="JSON de los resultados nuevos")
+    compare_parser.add_argument('--time-threshold', type=float, default=DEFAULT_TIME_THRESHOLD,
+                                help="Aumento relativo de tiempo que cuenta como regresión")
+    compare_parser.add_argument('--memory-threshold', type=float,
+                                default=DEFAULT_MEMORY_THRESHOLD,
+                                help="Aumento relativo de memoria que cuenta como regresión")
+
+    case_parser = subparsers.add_parser('_case')
+    case_parser.add_argument('tool', choices=list(TOOLS))
+    case_parser.add_argument('path')
+    case_parser.add_argument('--repeat', type=int, default=3)
+    case_parser.add_argument('--warmup', type=int, default=1)
+
+    args = parser.parse_args()
+
+    if args.command == '_case':
+        print(json.dumps(run_case(args.tool, args.path, args.repeat, args.warmup)))
+        return
+
+    if args.command == 'compare':
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        lines, regressions = compare(baseline, current, args.time_threshold,
+                                     args.memory_threshold)
+        print('\n'.join(lines))
+        if baseline['environment'].get('pillow') != current['environment'].get('pillow'):
+            print(f"Pillow {baseline['environment'].get('pillow')} -> "
+                  f"{current['environment'].get('pillow')}")
+        print(f"\n{regressions} regresiones")
+        sys.exit(1 if regressions else 0)
+
+    tools = args.tools.split(',')
+    unknown = [tool for tool in tools if tool not in TOOLS]
+    if unknown:
+        parser.error(f"Herramientas desconocidas: {', '.join(unknown)}")
+    sizes = [float(value) if '.' in value else int(value) for value in args.sizes.split(',')]
+    modes = args.modes.split(',')
+    unknown = [mode for mode in modes if mode not in SOURCE_FORMATS]
+    if unknown:
+        parser.error(f"Modos no admitidos: {', '.join(unknown)}")
+
+    results = run_suite(tools, sizes, modes, args.repeat, args.warmup, args.seed, args.cache_dir)
+    output = args.output or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'results',
+        f"{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Resultados guardados en {output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+import argparse
+import io
+import os
+import statistics
+import sys
+import time
+
+from benchmark_images import TOOL_PATHS, make_synthetic_image
+
+sys.path.insert(0, TOOL_PATHS['watermark'])
+from watermark_engine import create_watermark
+
+def benchmark(megapixels, thread_counts, repeat):
+    """
+    Mide la latencia de create_watermark para cada número de hilos.
+
+    Returns:
+        dict: Mediana de latencia en segundos por número de hilos
+    """
+    source = make_synthetic_image(megapixels, 'RGB')
+    results = {}
+
+    for threads in thread_counts:
+        # Calentar las cachés de fuente y tesela y el pool de hilos
+        create_watermark(source.copy(), io.BytesIO(), 'bench', threads=threads)
+
+        timings = []
+        for _ in range(repeat):
+            img = source.copy()
+            start = time.perf_counter()
+            create_watermark(img, io.BytesIO(), 'bench', threads=threads)
+            timings.append(time.perf_counter() - start)
+        results[threads] = statistics.median(timings)
+
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Mide la aceleración de create_watermark con varios hilos por imagen")
+    parser.add_argument('--megapixels', type=float, default=24, help="Tamaño de la imagen sintética")
+    parser.add_argument('--threads', default='1,2,4,8', help="Números de hilos separados por comas")
+    parser.add_argument('--repeat', type=int, default=5, help="Repeticiones por configuración")
+    args = parser.parse_args()
+
+    thread_counts = [int(value) for value in args.threads.split(',')]
+    print(f"Imagen sintética de {args.megapixels} MP, {os.cpu_count()} CPU disponibles")
+
+    results = benchmark(args.megapixels, thread_counts, args.repeat)
+    baseline = results[thread_counts[0]]
+
+    print(f"{'Hilos':>6} {'Latencia (s)':>13} {'Aceleración':>12}")
+    for threads, latency in results.items():
+        print(f"{threads:>6} {latency:>13.3f} {baseline / latency:>11.2f}x")
@@ -0,0 +1,506 @@
+import argparse
+import http.client
+import io
+import json
+import os
+import queue
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+from datetime import datetime
+from urllib.parse import urlsplit
+
+import numpy as np
+
+from benchmark_images import REPO_ROOT, make_synthetic_image
+
+API_DIR = os.path.join(REPO_ROOT, 'watermark_photos', 'api')
+
+# Mezcla de imágenes por defecto: megapíxeles y peso de cada tamaño
+DEFAULT_MIX = '1:0.5,4:0.3,12:0.2'
+DEFAULT_SEED = 1234
+
+# Segundos máximos que se espera a que arranque el servidor
+STARTUP_TIMEOUT = 60
+
+def parse_mix(value):
+    """Convierte '1:0.5,12:0.5' en una lista de (megapíxeles, peso normalizado)."""
+    mix = []
+    for item in value.split(','):
+        megapixels, _, weight = item.partition(':')
+        mix.append((float(megapixels), float(weight or 1)))
+    total = sum(weight for _, weight in mix)
+    return [(megapixels, weight / total) for megapixels, weight in mix]
+
+def synthetic_jpegs(mix, seed):
+    """Genera (una sola vez) un JPEG sintético por cada tamaño de la mezcla."""
+    images = {}
+    for megapixels, _ in mix:
+        buffer = io.BytesIO()
+        make_synthetic_image(megapixels, 'RGB', seed).save(buffer, 'JPEG', quality=90)
+        images[megapixels] = buffer.getvalue()
+    return images
+
+def multipart_body(image, code, fields):
+    """Cuerpo multipart con los campos y la imagen (en ese orden, como requests)."""
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in [('code', code)] + list(fields.items()):
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'
+                     f'{value}\r\n'.encode('utf-8'))
+    parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="image"; '
+                 f'filename="carga.jpg"\r\nContent-Type: image/jpeg\r\n\r\n'.encode('utf-8'))
+    parts.append(image)
+    parts.append(f'\r\n--{boundary}--\r\n'.encode('utf-8'))
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+def percentile(sorted_values, fraction):
+    """Percentil por rango más cercano de una lista ya ordenada."""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+def process_tree_rss_mb(root_pid):
+    """Memoria residente total (MB) de un proceso y todos sus descendientes (Linux)."""
+    parents = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f'/proc/{name}/stat') as f:
+                # El nombre del proceso va entre paréntesis y puede tener espacios
+                fields = f.read().rsplit(')', 1)[1].split()
+            parents.setdefault(int(fields[1]), []).append(int(name))
+        except (OSError, IndexError):
+            continue
+
+    total_kb = 0
+    pending = [root_pid]
+    while pending:
+        pid = pending.pop()
+        pending.extend(parents.get(pid, []))
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total_kb += int(line.split()[1])
+                        break
+        except OSError:
+            continue
+    return total_kb / 1024
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+class Server:
+    """gunicorn con la API en localhost, con estadísticas y trabajos en un directorio temporal."""
+
+    def __init__(self, port, workers, env):
+        self.port = port
+        self.workers = workers
+        self.env = env
+        self.process = None
+        self._temp_dir = None
+
+    def start(self):
+        if shutil.which('gunicorn') is None:
+            raise RuntimeError("gunicorn no está instalado; instálalo (pip install gunicorn) o usa "
+                               "--url con un servidor ya arrancado")
+        self._temp_dir = tempfile.mkdtemp(prefix='watermark-load-')
+        env = dict(os.environ,
+                   WATERMARK_BIND=f'127.0.0.1:{self.port}',
+                   WEB_CONCURRENCY=str(self.workers),
+                   WATERMARK_STATS_DB=os.path.join(self._temp_dir, 'stats.db'),
+                   WATERMARK_JOBS_DIR=os.path.join(self._temp_dir, 'jobs'))
+        env.update(self.env)
+        self.process = subprocess.Popen(['gunicorn', '-c', 'gunicorn.conf.py', 'app:app'],
+                                        cwd=API_DIR, env=env, stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.DEVNULL)
+
+        deadline = time.time() + STARTUP_TIMEOUT
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"gunicorn terminó al arrancar (código {self.process.returncode})")
+            try:
+                connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=5)
+                connection.request('GET', '/metrics')
+                connection.getresponse().read()
+                connection.close()
+                return
+            except OSError:
+                time.sleep(0.2)
+        raise RuntimeError("El servidor no respondió a tiempo")
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.send_signal(signal.SIGTERM)
+            try:
+                self.process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        if self._temp_dir:
+            shutil.rmtree(self._temp_dir, ignore_errors=True)
+
+class LoadTest:
+    """
+    Envía peticiones a /watermark y guarda la latencia y el resultado de cada una.
+
+    En modo de concurrencia fija cada hilo envía la siguiente petición al recibir
+    la respuesta anterior. En modo de tasa (o al reproducir el historial) las
+    peticiones tienen una hora de envío prevista y su latencia se cuenta desde
+    ella, para que un servidor lento no oculte la espera acumulada.
+    """
+
+    def __init__(self, host, port, images, mix, fields, seed, timeout):
+        self.host = host
+        self.port = port
+        self.images = images
+        self.mix = mix
+        self.fields = fields
+        self.timeout = timeout
+        self.rng = np.random.default_rng(seed)
+
+        self.results = []
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        self._counter = 0
+        self.start_time = None
+
+    def choose_image(self, key=None):
+        """Elige un tamaño de la mezcla, al azar o de forma fija para una clave."""
+        sizes = [megapixels for megapixels, _ in self.mix]
+        weights = [weight for _, weight in self.mix]
+        if key is None:
+            with self._lock:
+                return sizes[self.rng.choice(len(sizes), p=weights)]
+        # Misma clave (por ejemplo, el mismo archivo del historial), mismo tamaño
+        point = (zlib.crc32(key.encode('utf-8')) % 10000) / 10000
+        for megapixels, weight in self.mix:
+            point -= weight
+            if point < 0:
+                return megapixels
+        return sizes[-1]
+
+    def next_code(self):
+        with self._lock:
+            self._counter += 1
+            return f"carga{self._counter:06d}"
+
+    def send(self, connection, megapixels, code, scheduled=None):
+        """
+        Envía una petición y registra su resultado.
+
+        Returns:
+            La conexión a reutilizar (None si hay que abrir otra)
+        """
+        body, content_type = multipart_body(self.images[megapixels], code, self.fields)
+        with self._lock:
+            self.in_flight += 1
+        start = time.perf_counter()
+        status, size = None, 0
+        try:
+            if connection is None:
+                connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            connection.request('POST', '/watermark', body=body,
+                               headers={'Content-Type': content_type})
+            response = connection.getresponse()
+            size = len(response.read())
+            status = response.status
+            if response.getheader('Connection', '').lower() == 'close':
+                connection.close()
+                connection = None
+        except (OSError, http.client.HTTPException):
+            if connection is not None:
+                connection.close()
+            connection = None
+        end = time.perf_counter()
+
+        with self._lock:
+            self.in_flight -= 1
+            self.results.append({
+                'start': (scheduled or start) - self.start_time,
+                'latency': end - (scheduled or start),
+                'status': status,
+                'megapixels': megapixels,
+                'bytes': size,
+            })
+        return connection
+
+    def run_concurrency(self, concurrency, duration, max_requests):
+        """Mantiene concurrency peticiones en curso hasta agotar la duración o las peticiones."""
+        self.start_time = time.perf_counter()
+        deadline = self.start_time + duration
+        remaining = [max_requests]
+
+        def worker():
+            connection = None
+            while time.perf_counter() < deadline:
+                with self._lock:
+                    if remaining[0] is not None:
+                        if remaining[0] <= 0:
+                            break
+                        remaining[0] -= 1
+                connection = self.send(connection, self.choose_image(), self.next_code())
+            if connection is not None:
+                connection.close()
+
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def run_schedule(self, schedule, max_in_flight):
+        """
+        Envía las peticiones a sus horas previstas.
+
+        Args:
+            schedule: Lista de (segundos desde el inicio, megapíxeles, código)
+            max_in_flight: Hilos que envían peticiones (peticiones en curso máximas)
+        """
+        pending = queue.Queue()
+        self.start_time = time.perf_counter()
+
+        def worker():
+            connection = None
+            while True:
+                item = pending.get()
+                if item is None:
+                    break
+                connection = self.send(connection, *item)
+            if connection is not None:
+                connection.close()
+
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(max_in_flight)]
+        for thread in threads:
+            thread.start()
+        for offset, megapixels, code in schedule:
+            scheduled = self.start_time + offset
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pending.put((megapixels, code, scheduled))
+        for _ in threads:
+            pending.put(None)
+        for thread in threads:
+            thread.join()
+
+def rate_schedule(load_test, rate, duration, max_requests, seed):
+    """Llegadas de Poisson a rate peticiones por segundo."""
+    rng = np.random.default_rng(seed + 1)
+    schedule = []
+    offset = 0.0
+    while True:
+        offset += rng.exponential(1 / rate)
+        if offset > duration or (max_requests and len(schedule) >= max_requests):
+            return schedule
+        schedule.append((offset, load_test.choose_image(), load_test.next_code()))
+
+def replay_schedule(load_test, stats_db, speed, since, max_requests, max_gap):
+    """
+    Reproduce las peticiones registradas en el historial de estadísticas.
+
+    Se respetan los intervalos entre eventos (divididos por speed y recortados a
+    max_gap segundos, para saltarse las horas sin tráfico) y los códigos; como el
+    historial no guarda las imágenes, cada archivo se asocia siempre al mismo
+    tamaño de la mezcla.
+    """
+    sys.path.insert(0, API_DIR)
+    from stats_store import StatsStore
+    store = StatsStore(stats_db)
+    events = store.events(since=since)
+    store.close()
+    if max_requests:
+        events = events[:max_requests]
+    if not events:
+        return []
+    schedule = []
+    offset = 0.0
+    previous = events[0]['created']
+    for event in events:
+        offset += min((event['created'] - previous) / speed, max_gap)
+        previous = event['created']
+        schedule.append((offset, load_test.choose_image(event['filename']), event['code']))
+    return schedule
+
+def summarize(load_test, elapsed, rss_samples):
+    """Calcula percentiles, tasas de error y la evolución de la memoria."""
+    results = load_test.results
+    latencies = sorted(result['latency'] for result in results if result['status'] == 200)
+    statuses = {}
+    for result in results:
+        key = str(result['status']) if result['status'] is not None else 'conexión'
+        statuses[key] = statuses.get(key, 0) + 1
+    errors = sum(count for status, count in statuses.items() if status != '200')
+
+    by_size = {}
+    for megapixels in sorted({result['megapixels'] for result in results}):
+        size_latencies = sorted(result['latency'] for result in results
+                                if result['megapixels'] == megapixels and result['status'] == 200)
+        by_size[f"{megapixels:g}MP"] = {
+            'requests': sum(1 for result in results if result['megapixels'] == megapixels),
+            'p50': percentile(size_latencies, 0.50),
+            'p95': percentile(size_latencies, 0.95),
+        }
+
+    return {
+        'requests': len(results),
+        'elapsed': elapsed,
+        'throughput': len(latencies) / elapsed if elapsed else 0.0,
+        'latency': {
+            'p50': percentile(latencies, 0.50),
+            'p95': percentile(latencies, 0.95),
+            'p99': percentile(latencies, 0.99),
+            'max': latencies[-1] if latencies else None,
+        },
+        'statuses': statuses,
+        'error_rate': errors / len(results) if results else 0.0,
+        'by_size': by_size,
+        'rss_mb': rss_samples,
+        'peak_rss_mb': max((rss for _, rss in rss_samples), default=None),
+    }
+
+def format_seconds(value):
+    return f"{value:.3f}" if value is not None else '-'
+
+def print_report(summary):
+    latency = summary['latency']
+    print(f"\nPeticiones: {summary['requests']} en {summary['elapsed']:.1f} s "
+          f"({summary['throughput']:.2f} respuestas 200/s)")
+    print(f"Latencia (s): p50 {format_seconds(latency['p50'])}  p95 {format_seconds(latency['p95'])}  "
+          f"p99 {format_seconds(latency['p99'])}  máx {format_seconds(latency['max'])}")
+    print(f"Códigos: {', '.join(f'{status}: {count}' for status, count in sorted(summary['statuses'].items()))}"
+          f"  (errores {summary['error_rate']:.1%})")
+    for size, values in summary['by_size'].items():
+        print(f"  {size:>6}: {values['requests']} peticiones, p50 {format_seconds(values['p50'])} s, "
+              f"p95 {format_seconds(values['p95'])} s")
+    if summary['peak_rss_mb'] is not None:
+        print(f"Memoria del servidor: máximo {summary['peak_rss_mb']:.0f} MB")
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Prueba de carga de /watermark: arranca la API con gunicorn en localhost y "
+                    "mide latencia, errores y memoria")
+    load = parser.add_mutually_exclusive_group()
+    load.add_argument('--concurrency', type=int, default=4,
+                      help="Peticiones en curso constantes (%(default)s)")
+    load.add_argument('--rate', type=float, help="Peticiones por segundo (llegadas de Poisson)")
+    load.add_argument('--replay', metavar='STATS_DB',
+                      help="Reproduce el historial de una base de datos de estadísticas")
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help="Con --replay, factor de aceleración del historial")
+    parser.add_argument('--since', type=float, help="Con --replay, epoch desde el que reproducir")
+    parser.add_argument('--max-gap', type=float, default=5.0,
+                        help="Con --replay, segundos máximos entre dos peticiones (%(default)s)")
+    parser.add_argument('--duration', type=float, default=30, help="Segundos de prueba")
+    parser.add_argument('--requests', type=int, help="Número máximo de peticiones")
+    parser.add_argument('--max-in-flight', type=int, default=64,
+                        help="Con --rate o --replay, peticiones en curso máximas")
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help="Tamaños en megapíxeles y pesos (%(default)s)")
+    parser.add_argument('--field', action='append', default=[], metavar='NOMBRE=VALOR',
+                        help="Campo adicional del formulario (por ejemplo max_dimension=2048)")
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    parser.add_argument('--timeout', type=float, default=120, help="Segundos máximos por petición")
+    parser.add_argument('--url', help="Servidor ya arrancado (http://host:puerto); si no se "
+                        "indica, se arranca gunicorn en localhost")
+    parser.add_argument('--pid', type=int, help="Con --url, PID del servidor para medir su memoria")
+    parser.add_argument('--workers', type=int, default=1, help="Workers de gunicorn")
+    parser.add_argument('--env', action='append', default=[], metavar='NOMBRE=VALOR',
+                        help="Variable de entorno para la API (por ejemplo "
+                        "WATERMARK_SERVING_MODE=process)")
+    parser.add_argument('--rss-interval', type=float, default=1.0,
+                        help="Segundos entre mediciones de memoria")
+    parser.add_argument('--output', help="Guarda el resumen y cada petición en un JSON")
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    fields = dict(item.split('=', 1) for item in args.field)
+    print("Generando imágenes sintéticas...")
+    images = synthetic_jpegs(mix, args.seed)
+
+    server = None
+    server_pid = args.pid
+    if args.url:
+        target = urlsplit(args.url)
+        host, port = target.hostname, target.port or 80
+    else:
+        host, port = '127.0.0.1', free_port()
+        server = Server(port, args.workers, dict(item.split('=', 1) for item in args.env))
+        print(f"Arrancando gunicorn en {host}:{port}...")
+        try:
+            server.start()
+        except RuntimeError as e:
+            server.stop()
+            sys.exit(str(e))
+        server_pid = server.process.pid
+
+    load_test = LoadTest(host, port, images, mix, fields, args.seed, args.timeout)
+    rss_samples = []
+    stop = threading.Event()
+
+    def monitor():
+        """Muestra cada intervalo las respuestas por segundo, la latencia y la memoria."""
+        last_count = 0
+        while not stop.wait(args.rss_interval):
+            if load_test.start_time is None:
+                continue
+            now = time.perf_counter() - load_test.start_time
+            with load_test._lock:
+                recent = load_test.results[last_count:]
+                last_count = len(load_test.results)
+                in_flight = load_test.in_flight
+            rss = process_tree_rss_mb(server_pid) if server_pid else None
+            if rss is not None:
+                rss_samples.append((round(now, 1), round(rss, 1)))
+            latencies = sorted(result['latency'] for result in recent)
+            errors = sum(1 for result in recent if result['status'] != 200)
+            print(f"t={now:6.1f} s  {len(recent) / args.rss_interval:6.2f} resp/s  "
+                  f"p95 {format_seconds(percentile(latencies, 0.95))} s  en curso {in_flight:3d}  "
+                  f"errores {errors:3d}" + (f"  RSS {rss:.0f} MB" if rss is not None else ''))
+
+    monitor_thread = threading.Thread(target=monitor, daemon=True)
+    monitor_thread.start()
+    try:
+        start = time.perf_counter()
+        if args.replay:
+            schedule = replay_schedule(load_test, args.replay, args.speed, args.since,
+                                       args.requests, args.max_gap)
+            print(f"Reproduciendo {len(schedule)} peticiones del historial")
+            load_test.run_schedule(schedule, args.max_in_flight)
+        elif args.rate:
+            schedule = rate_schedule(load_test, args.rate, args.duration, args.requests, args.seed)
+            load_test.run_schedule(schedule, args.max_in_flight)
+        else:
+            load_test.run_concurrency(args.concurrency, args.duration, args.requests)
+        elapsed = time.perf_counter() - start
+    finally:
+        stop.set()
+        monitor_thread.join()
+        if server:
+            server.stop()
+
+    summary = summarize(load_test, elapsed, rss_samples)
+    print_report(summary)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'created': datetime.now().isoformat(timespec='seconds'),
+                'arguments': vars(args),
+                'summary': summary,
+                'requests': load_test.results,
+            }, f, indent=2)
+        print(f"Resultados guardados en {args.output}")
+
+if __name__ == "__main__":
+    main()
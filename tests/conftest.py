@@ -0,0 +1,13 @@
+import os
+import sys
+import tempfile
+
+# Los módulos de la API se importan como en el contenedor, desde su carpeta
+API_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                       'watermark_photos', 'api')
+sys.path.insert(0, API_DIR)
+
+# Estadísticas, métricas y trabajos en un directorio temporal, nunca en los de la API
+_data_dir = tempfile.mkdtemp(prefix='watermark-tests-')
+os.environ.setdefault('WATERMARK_STATS_DB', os.path.join(_data_dir, 'stats.db'))
+os.environ.setdefault('WATERMARK_JOBS_DIR', os.path.join(_data_dir, 'jobs'))
@@ -0,0 +1,34 @@
+from batch_manifest import LEGACY_LOG_NAME, MANIFEST_NAME, BatchManifest
+
+def test_legacy_log_is_imported_and_left_untouched(tmp_path):
+    input_dir = tmp_path / 'input'
+    output_dir = tmp_path / 'output'
+    input_dir.mkdir()
+    output_dir.mkdir()
+    legacy = output_dir / LEGACY_LOG_NAME
+    legacy_bytes = 'código,archivo_original\r\nfoto_año,foto_año.jpg\r\n'.encode('latin-1')
+    legacy.write_bytes(legacy_bytes)
+
+    (input_dir / 'foto_año.jpg').write_bytes(b'imagen')
+    (output_dir / 'foto_año_watermarked.jpg').write_bytes(b'resultado')
+    with BatchManifest(str(input_dir), str(output_dir)) as manifest:
+        assert manifest.entries['foto_año.jpg']['código'] == 'foto_año'
+        # El registro antiguo no tiene tamaño ni hash: la imagen se procesa
+        assert manifest.pending([('foto_año.jpg', 'foto_año_watermarked.jpg')])
+        manifest.record('foto_año.jpg', 'foto_año', 'foto_año_watermarked.jpg')
+
+    assert legacy.read_bytes() == legacy_bytes
+    with BatchManifest(str(input_dir), str(output_dir)) as manifest:
+        assert not manifest.pending([('foto_año.jpg', 'foto_año_watermarked.jpg')])
+    assert (output_dir / MANIFEST_NAME).read_text(encoding='utf-8-sig').count('foto_año.jpg') == 1
+    assert legacy.read_bytes() == legacy_bytes
+
+def test_names_outside_latin1_are_recorded(tmp_path):
+    (tmp_path / 'output').mkdir()
+    (tmp_path / 'output' / LEGACY_LOG_NAME).write_bytes('código,archivo_original\r\n'.encode('latin-1'))
+    (tmp_path / '写真.png').write_bytes(b'imagen')
+    (tmp_path / 'output' / '写真_watermarked.png').write_bytes(b'resultado')
+    with BatchManifest(str(tmp_path), str(tmp_path / 'output')) as manifest:
+        manifest.record('写真.png', '写真', '写真_watermarked.png')
+    with BatchManifest(str(tmp_path), str(tmp_path / 'output')) as manifest:
+        assert manifest.is_done('写真.png', '写真_watermarked.png')
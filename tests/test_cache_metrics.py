@@ -0,0 +1,40 @@
+import io
+
+import pytest
+from PIL import Image
+
+import app as api
+from result_cache import ResultCache
+
+def make_png(size):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, 'white').save(buffer, 'PNG')
+    return buffer.getvalue()
+
+@pytest.fixture
+def cache_results(monkeypatch):
+    monkeypatch.setattr(api, 'result_cache', ResultCache(16 * 1024 * 1024))
+    monkeypatch.setattr(api, 'MAX_IMAGE_PIXELS', 100 * 100)
+    results = []
+    original_inc = api.metrics.inc
+    def recording_inc(name, value=1, **labels):
+        if name == 'watermark_cache_requests_total':
+            results.append(labels['result'])
+        return original_inc(name, value, **labels)
+    monkeypatch.setattr(api.metrics, 'inc', recording_inc)
+    return results
+
+def post(data, code):
+    return api.app.test_client().post(f'/watermark?code={code}', data=data,
+                                       content_type='image/png')
+
+def test_rejected_images_are_not_cache_misses(cache_results):
+    assert post(make_png((200, 200)), 'big').status_code == 413
+    assert post(b'esto no es una imagen', 'bad').status_code == 400
+    assert cache_results == []
+
+def test_rendered_image_counts_one_miss_then_a_hit(cache_results):
+    image = make_png((80, 60))
+    assert post(image, 'small').status_code == 200
+    assert post(image, 'small').status_code == 200
+    assert cache_results == ['miss', 'hit']
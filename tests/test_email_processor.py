@@ -0,0 +1,247 @@
+import socket
+import socketserver
+import threading
+import time
+from email.mime.text import MIMEText
+
+import pytest
+
+class FakeIMAPHandler(socketserver.StreamRequestHandler):
+    """Sesión IMAP mínima: login, buzón vacío, IDLE y cierre de la conexión a petición."""
+
+    def setup(self):
+        super().setup()
+        self.lock = threading.Lock()
+
+    def send_line(self, line):
+        with self.lock:
+            self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        fake = self.server
+        with fake.lock:
+            fake.sessions.append(self)
+            number = len(fake.sessions)
+        self.send_line('* OK Servidor IMAP de prueba listo')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            tag, command = line.decode().split(' ', 2)[:2]
+            command = command.strip().upper()
+            if command == 'CAPABILITY':
+                self.send_line('* CAPABILITY IMAP4rev1 IDLE')
+                self.send_line(f'{tag} OK CAPABILITY completed')
+            elif command in ('LOGIN', 'NOOP', 'CLOSE'):
+                self.send_line(f'{tag} OK {command} completed')
+            elif command == 'SELECT':
+                self.send_line('* 0 EXISTS')
+                self.send_line(f'{tag} OK [READ-WRITE] SELECT completed')
+            elif command == 'SEARCH':
+                if number <= fake.drop_on_search:
+                    # La conexión se pierde antes de completar la comprobación
+                    return
+                self.send_line('* SEARCH')
+                self.send_line(f'{tag} OK SEARCH completed')
+                fake.checked.set()
+            elif command == 'IDLE':
+                with self.lock:
+                    # El aviso puede llegar en el mismo paquete que la aceptación
+                    self.wfile.write(b'+ idling\r\n' + fake.idle_notice)
+                fake.idling.set()
+                if self.rfile.readline().strip() != b'DONE':
+                    return
+                self.send_line(f'{tag} OK IDLE terminated')
+            elif command == 'LOGOUT':
+                self.send_line('* BYE Hasta luego')
+                self.send_line(f'{tag} OK LOGOUT completed')
+                return
+            else:
+                self.send_line(f'{tag} BAD Comando desconocido')
+
+class FakeIMAPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeIMAPHandler)
+        self.lock = threading.Lock()
+        self.sessions = []
+        self.drop_on_search = 0
+        self.idle_notice = b''
+        self.idling = threading.Event()
+        self.checked = threading.Event()
+
+    def notify(self, count=1):
+        """Avisa de un correo nuevo a la última sesión."""
+        self.sessions[-1].send_line(f'* {count} EXISTS')
+
+    def drop(self):
+        """Corta la última sesión sin despedirse."""
+        self.sessions[-1].connection.shutdown(socket.SHUT_RDWR)
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    """Servidor SMTP mínimo que cuenta las conexiones y los correos recibidos."""
+
+    def send_line(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        fake = self.server
+        with fake.lock:
+            fake.connections += 1
+            fake.open_sessions.append(self)
+        self.send_line('220 smtp.prueba ESMTP')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode().strip().upper()
+            if command.startswith(('EHLO', 'HELO')):
+                self.send_line('250 smtp.prueba')
+            elif command == 'DATA':
+                self.send_line('354 Fin con <CRLF>.<CRLF>')
+                while self.rfile.readline() not in (b'.\r\n', b''):
+                    pass
+                with fake.lock:
+                    fake.messages += 1
+                self.send_line('250 OK')
+            elif command == 'QUIT':
+                self.send_line('221 Adiós')
+                return
+            else:
+                self.send_line('250 OK')
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeSMTPHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.messages = 0
+        self.open_sessions = []
+
+    def drop_all(self):
+        """Cierra las conexiones abiertas, como un servidor que corta las inactivas."""
+        with self.lock:
+            sessions, self.open_sessions = self.open_sessions, []
+        for session in sessions:
+            session.connection.shutdown(socket.SHUT_RDWR)
+
+def serve(server):
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+@pytest.fixture
+def processor(monkeypatch, tmp_path):
+    # El módulo crea su registro en el directorio actual al importarse
+    monkeypatch.chdir(tmp_path)
+    import email_processor
+    monkeypatch.setattr(email_processor, 'EMAIL_ADDRESS', 'bot@prueba.local')
+    monkeypatch.setattr(email_processor, 'EMAIL_PASSWORD', 'secreto')
+    monkeypatch.setattr(email_processor, 'IMAP_SSL', False)
+    monkeypatch.setattr(email_processor, 'FETCH_MODE', 'idle')
+    return email_processor
+
+@pytest.fixture
+def imap_server(processor, monkeypatch):
+    server = serve(FakeIMAPServer())
+    monkeypatch.setattr(processor, 'IMAP_SERVER', '127.0.0.1')
+    monkeypatch.setattr(processor, 'IMAP_PORT', server.server_address[1])
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def smtp_server():
+    server = serve(FakeSMTPServer())
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def test_idle_wakes_up_when_mail_arrives(processor, imap_server):
+    mail = processor.connect_imap()
+    try:
+        threading.Timer(0.2, lambda: imap_server.idling.wait(5) and imap_server.notify()).start()
+        started = time.monotonic()
+        assert processor.wait_for_new_mail(mail, 10)
+        assert time.monotonic() - started < 5
+    finally:
+        processor.close_imap(mail)
+
+def test_idle_sees_notice_sent_with_the_continuation(processor, imap_server):
+    # El aviso llega en el búfer junto a '+ idling', donde select() no lo ve
+    imap_server.idle_notice = b'* 1 EXISTS\r\n'
+    mail = processor.connect_imap()
+    try:
+        started = time.monotonic()
+        assert processor.wait_for_new_mail(mail, 10)
+        assert time.monotonic() - started < 5
+    finally:
+        processor.close_imap(mail)
+
+def test_idle_returns_false_on_timeout(processor, imap_server):
+    mail = processor.connect_imap()
+    try:
+        assert not processor.wait_for_new_mail(mail, 0.3)
+    finally:
+        processor.close_imap(mail)
+
+def make_message(number):
+    message = MIMEText(f'Correo {number}')
+    message['Subject'] = f'Prueba {number}'
+    return message.as_string()
+
+def test_smtp_pool_reuses_connection(processor, smtp_server):
+    pool = processor.SMTPPool('127.0.0.1', smtp_server.server_address[1], 'none')
+    try:
+        for number in range(3):
+            pool.sendmail('bot@prueba.local', 'usuario@prueba.local', make_message(number))
+    finally:
+        pool.close()
+    assert smtp_server.messages == 3
+    assert smtp_server.connections == 1
+
+def test_smtp_pool_resends_when_server_closed_connection(processor, smtp_server):
+    pool = processor.SMTPPool('127.0.0.1', smtp_server.server_address[1], 'none')
+    try:
+        pool.sendmail('bot@prueba.local', 'usuario@prueba.local', make_message(1))
+        smtp_server.drop_all()
+        pool.sendmail('bot@prueba.local', 'usuario@prueba.local', make_message(2))
+    finally:
+        pool.close()
+    assert smtp_server.messages == 2
+    assert smtp_server.connections == 2
+
+class Stop(Exception):
+    pass
+
+def test_reconnect_backoff_restarts_only_after_a_working_session(processor, imap_server,
+                                                                  monkeypatch):
+    # Las dos primeras sesiones se pierden antes de comprobar el buzón; la
+    # tercera lo comprueba y se corta mientras espera en IDLE
+    imap_server.drop_on_search = 2
+    monkeypatch.setattr(processor, 'MIN_SESSION_TIME', 3600)
+    monkeypatch.setattr(processor, 'IDLE_TIMEOUT', 30)
+    attempts = []
+
+    def record_wait(attempt):
+        attempts.append(attempt)
+        if len(attempts) == 3:
+            raise Stop
+        return 0
+    monkeypatch.setattr(processor, 'reconnect_wait', record_wait)
+
+    def drop_when_idle():
+        if imap_server.checked.wait(10) and imap_server.idling.wait(10):
+            imap_server.drop()
+    threading.Thread(target=drop_when_idle, daemon=True).start()
+
+    with pytest.raises(Stop):
+        processor.run_email_processor()
+
+    assert len(imap_server.sessions) == 3
+    assert attempts == [1, 2, 1]
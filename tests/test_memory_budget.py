@@ -0,0 +1,56 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import watermark_engine
+
+# Presupuesto en el que no cabe ninguna de las imágenes de prueba
+TINY_BUDGET = 64 * 1024
+
+def make_image(mode, fmt):
+    rng = np.random.default_rng(7)
+    pixels = rng.integers(0, 256, (300, 400, 3), dtype=np.uint8)
+    img = Image.fromarray(pixels)
+    if mode == 'P':
+        img = img.quantize(64)
+    elif mode != 'RGB':
+        img = img.convert(mode)
+    buffer = io.BytesIO()
+    img.save(buffer, fmt)
+    return buffer.getvalue()
+
+def watermark(data, memory_budget):
+    output = io.BytesIO()
+    with Image.open(io.BytesIO(data)) as img:
+        watermark_engine.create_watermark(img, output, 'presupuesto', composite_mode='numpy',
+                                          memory_budget=memory_budget, output_format='png')
+    return output.getvalue()
+
+@pytest.fixture
+def spill_folder(tmp_path, monkeypatch):
+    monkeypatch.setattr(watermark_engine, 'SPILL_FOLDER', str(tmp_path))
+    frames = []
+    original = watermark_engine.spilled_frame
+    def counted_frame(mode, size):
+        frames.append(mode)
+        return original(mode, size)
+    monkeypatch.setattr(watermark_engine, 'spilled_frame', counted_frame)
+    return frames
+
+@pytest.mark.parametrize('mode, fmt', [('RGB', 'JPEG'), ('RGBA', 'PNG'), ('P', 'PNG'), ('L', 'PNG')])
+def test_spilled_decode_matches_in_memory(spill_folder, mode, fmt):
+    data = make_image(mode, fmt)
+    expected = watermark(data, None)
+    assert watermark(data, TINY_BUDGET) == expected
+    # La imagen se decodificó sobre disco (y, si no era RGB, también su conversión)
+    assert spill_folder == [mode] + ([] if mode == 'RGB' else ['RGB'])
+
+def test_falls_back_to_memory_without_pillow_internals(spill_folder, monkeypatch):
+    def unavailable(*args):
+        raise AttributeError("map_buffer")
+    monkeypatch.setattr(watermark_engine.Image.core, 'map_buffer', unavailable, raising=False)
+    for mode, fmt in [('RGB', 'JPEG'), ('P', 'PNG')]:
+        data = make_image(mode, fmt)
+        assert watermark(data, TINY_BUDGET) == watermark(data, None)
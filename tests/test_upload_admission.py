@@ -0,0 +1,130 @@
+import io
+import threading
+import time
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import app as api
+import progressive_upload
+from admission import AdmissionController
+from result_cache import ResultCache
+
+MAX_RENDERS = 2
+UPLOADS = 6
+
+class SlowStream:
+    """Cuerpo de una petición que llega poco a poco, como desde una conexión lenta."""
+
+    def __init__(self, data, chunk_size=16 * 1024, delay=0.005):
+        self.data = io.BytesIO(data)
+        self.chunk_size = chunk_size
+        self.delay = delay
+
+    def read(self, size=-1):
+        time.sleep(self.delay)
+        if size is None or size < 0 or size > self.chunk_size:
+            size = self.chunk_size
+        return self.data.read(size)
+
+    def readline(self, size=-1):
+        return self.data.readline(size)
+
+def make_jpeg(seed):
+    rng = np.random.default_rng(seed)
+    pixels = rng.integers(0, 256, (900, 1200, 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, 'JPEG', quality=90)
+    return buffer.getvalue()
+
+@pytest.fixture
+def limited_api(monkeypatch):
+    monkeypatch.setattr(api, 'admission', AdmissionController(MAX_RENDERS, UPLOADS, 60))
+    monkeypatch.setattr(api, 'result_cache', ResultCache(0))
+    return api
+
+def test_parallel_slow_uploads_hold_at_most_max_renders_frames(limited_api, monkeypatch):
+    # Imágenes decodificadas (mientras llegan o al terminar la subida) que
+    # siguen vivas: desde que se reserva su memoria hasta que acaba la petición
+    lock = threading.Lock()
+    live = {'now': 0, 'max': 0}
+    holding = threading.local()
+
+    def frame_allocated():
+        if getattr(holding, 'frame', False):
+            return False
+        holding.frame = True
+        with lock:
+            live['now'] += 1
+            live['max'] = max(live['max'], live['now'])
+        return True
+
+    def frame_released():
+        if getattr(holding, 'frame', False):
+            holding.frame = False
+            with lock:
+                live['now'] -= 1
+
+    original_open = progressive_upload.ProgressiveDecoder._open
+    def counted_open(self):
+        opened = original_open(self)
+        if opened:
+            frame_allocated()
+        return opened
+    monkeypatch.setattr(progressive_upload.ProgressiveDecoder, '_open', counted_open)
+
+    original_render = api.render_image
+    def counted_render(img, *args, **kwargs):
+        # Las imágenes que no se decodificaron mientras llegaban se decodifican
+        # aquí y se liberan al terminar, dentro del turno
+        allocated = frame_allocated()
+        try:
+            return original_render(img, *args, **kwargs)
+        finally:
+            if allocated:
+                frame_released()
+    monkeypatch.setattr(api, 'render_image', counted_render)
+
+    original_view = api.app.view_functions['watermark_image']
+    def counted_view():
+        # Las decodificadas mientras llegaban conservan su turno hasta el final
+        try:
+            return original_view()
+        finally:
+            frame_released()
+    monkeypatch.setitem(api.app.view_functions, 'watermark_image', counted_view)
+
+    images = [make_jpeg(seed) for seed in range(UPLOADS)]
+    statuses = [None] * UPLOADS
+
+    def upload(index):
+        client = api.app.test_client()
+        response = client.post(f'/watermark?code=test{index}', content_type='image/jpeg',
+                               environ_overrides={'wsgi.input': SlowStream(images[index]),
+                                                  'CONTENT_LENGTH': str(len(images[index]))})
+        statuses[index] = response.status_code
+
+    threads = [threading.Thread(target=upload, args=(index,)) for index in range(UPLOADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert statuses == [200] * UPLOADS
+    assert 0 < live['max'] <= MAX_RENDERS
+    assert api.admission.active == 0
+
+def test_result_is_cached_after_the_image_is_released(monkeypatch):
+    # Una imagen pequeña se abre desde la subida completa, y cerrarla dentro del
+    # turno cierra también la subida; el resultado se guarda igualmente en caché
+    monkeypatch.setattr(api, 'result_cache', ResultCache(16 * 1024 * 1024))
+    buffer = io.BytesIO()
+    Image.new('RGB', (80, 60), 'white').save(buffer, 'PNG')
+    image = buffer.getvalue()
+    client = api.app.test_client()
+    first = client.post('/watermark?code=cached', data=image, content_type='image/png')
+    second = client.post('/watermark?code=cached', data=image, content_type='image/png')
+    assert first.status_code == second.status_code == 200
+    assert second.get_data() == first.get_data()
+    assert api.result_cache.get(first.get_etag()[0]) == first.get_data()
@@ -0,0 +1,111 @@
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+class Overloaded(Exception):
+    """Se lanza cuando una petición no puede entrar porque el servicio está saturado."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Servicio saturado, reintenta en {retry_after} s")
+        self.retry_after = retry_after
+
+class AdmissionController:
+    """
+    Limita cuántas imágenes se procesan a la vez en un worker y cuántas
+    peticiones pueden esperar turno.
+
+    Las peticiones que no caben en la cola, o que esperan más de queue_timeout,
+    se rechazan enseguida con un tiempo de reintento estimado a partir de la
+    duración media de los últimos procesamientos.
+    """
+
+    def __init__(self, max_concurrent, max_queued, queue_timeout):
+        """
+        Args:
+            max_concurrent: Imágenes que se procesan a la vez
+            max_queued: Peticiones que pueden esperar turno (además de las que
+                se están procesando)
+            queue_timeout: Segundos máximos de espera en la cola
+        """
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+
+        self._slots = threading.Semaphore(max_concurrent)
+        self._lock = threading.Lock()
+        self.active = 0
+        self.waiting = 0
+        # Media móvil exponencial de la duración de un procesamiento (segundos)
+        self._average = 1.0
+
+    def saturated(self):
+        """True si todos los turnos están ocupados y la cola está llena."""
+        with self._lock:
+            return self.active >= self.max_concurrent and self.waiting >= self.max_queued
+
+    def retry_after(self):
+        """Estima en cuántos segundos (enteros, al menos 1) habrá turno libre."""
+        with self._lock:
+            pending = self.waiting + 1
+            return max(1, math.ceil(self._average * pending / self.max_concurrent))
+
+    @contextmanager
+    def slot(self, block=False):
+        """
+        Espera un turno para procesar una imagen.
+
+        Args:
+            block: Si es True, espera sin límite y sin contar para la cola (para
+                peticiones ya admitidas, como las imágenes de un lote)
+
+        Raises:
+            Overloaded: Si la cola está llena o se supera queue_timeout
+        """
+        if block:
+            self._slots.acquire()
+        else:
+            with self._lock:
+                if self.active >= self.max_concurrent and self.waiting >= self.max_queued:
+                    acquired = False
+                else:
+                    self.waiting += 1
+                    acquired = None
+            if acquired is None:
+                try:
+                    acquired = self._slots.acquire(timeout=self.queue_timeout)
+                finally:
+                    with self._lock:
+                        self.waiting -= 1
+            if not acquired:
+                raise Overloaded(self.retry_after())
+
+        with self._hold():
+            yield
+
+    def try_slot(self):
+        """
+        Toma un turno si hay alguno libre, sin esperar ni pasar por la cola.
+
+        Returns:
+            Context manager que hay que usar con with para liberar el turno, o
+            None si no hay ninguno libre
+        """
+        if not self._slots.acquire(blocking=False):
+            return None
+        return self._hold()
+
+    @contextmanager
+    def _hold(self):
+        """Ocupa un turno ya adquirido y lo libera al salir."""
+        with self._lock:
+            self.active += 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.active -= 1
+                self._average = 0.8 * self._average + 0.2 * elapsed
+            self._slots.release()
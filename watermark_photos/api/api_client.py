@@ -0,0 +1,231 @@
+import os
+import time
+import random
+import logging
+import threading
+from collections import deque
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+
+# Códigos con los que la API indica que se reintente más tarde
+RETRY_STATUS_CODES = (429, 503)
+
+# Reintentos máximos y espera máxima (en segundos) entre reintentos
+MAX_RETRIES = 5
+MAX_RETRY_WAIT = 60
+
+# Espera si la respuesta no trae Retry-After
+DEFAULT_RETRY_WAIT = 5
+
+# Espera base (en segundos) del backoff exponencial de los reintentos sin
+# Retry-After (errores de conexión, 503 de un proxy...)
+BACKOFF_BASE = 1
+
+# Fracción máxima que se añade al azar a la espera de Retry-After, para que los
+# clientes a los que se pidió la misma espera no vuelvan todos a la vez
+RETRY_AFTER_JITTER = 0.2
+
+# Control adaptativo: si una respuesta tarda más de LATENCY_TOLERANCE veces la
+# mínima de las últimas LATENCY_WINDOW (por MB enviado), se reduce el límite de
+# peticiones en curso multiplicándolo por LATENCY_DECREASE; con 429 o 503 se
+# reduce a la mitad
+LATENCY_TOLERANCE = 2.0
+LATENCY_WINDOW = 50
+LATENCY_DECREASE = 0.8
+
+# Formato de salida que se pide a la API según la extensión de la imagen, para
+# que el archivo resultante conserve la extensión. La API devuelve JPEG por
+# defecto, así que las demás (BMP, TIFF...) se guardan como .jpg
+OUTPUT_FORMAT_EXTENSIONS = {'.jpg': 'jpeg', '.jpeg': 'jpeg', '.png': 'png', '.webp': 'webp'}
+
+def output_format_for(filename):
+    """
+    Formato de salida que se pide a la API para una imagen.
+
+    Returns:
+        tuple: (valor de 'output_format', extensión del archivo resultante)
+    """
+    ext = os.path.splitext(filename)[1]
+    output_format = OUTPUT_FORMAT_EXTENSIONS.get(ext.lower())
+    if output_format is None:
+        return 'jpeg', '.jpg'
+    return output_format, ext
+
+def retry_after_seconds(response, default=DEFAULT_RETRY_WAIT):
+    """
+    Lee la cabecera Retry-After de una respuesta (en segundos o como fecha HTTP).
+
+    Args:
+        response: Respuesta de requests (o cualquier objeto con .headers)
+        default: Segundos si la cabecera falta o no se puede interpretar
+
+    Returns:
+        float: Segundos que hay que esperar, entre 0 y MAX_RETRY_WAIT
+    """
+    value = response.headers.get('Retry-After')
+    seconds = default
+    if value:
+        try:
+            seconds = float(value)
+        except ValueError:
+            try:
+                retry_at = parsedate_to_datetime(value)
+                seconds = (retry_at - datetime.now(timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                pass
+    return min(max(seconds, 0), MAX_RETRY_WAIT)
+
+def retry_wait(response, attempt):
+    """
+    Segundos de espera antes de un reintento, con jitter.
+
+    Args:
+        response: Respuesta que pidió el reintento (None si hubo un error de conexión)
+        attempt: Número del reintento (desde 1)
+
+    Returns:
+        float: Lo que indique Retry-After más hasta un RETRY_AFTER_JITTER más o,
+        sin cabecera, un backoff exponencial con la mitad de la espera al azar
+    """
+    if response is not None and response.headers.get('Retry-After'):
+        wait = retry_after_seconds(response)
+        return min(wait * (1 + random.uniform(0, RETRY_AFTER_JITTER)), MAX_RETRY_WAIT)
+    backoff = min(BACKOFF_BASE * 2 ** (attempt - 1), MAX_RETRY_WAIT)
+    return backoff / 2 + random.uniform(0, backoff / 2)
+
+def should_retry(response, attempt, max_retries=MAX_RETRIES):
+    """True si la API pidió reintentar y quedan reintentos."""
+    return response.status_code in RETRY_STATUS_CODES and attempt < max_retries
+
+def rewind_files(files):
+    """Vuelve al principio los archivos de una petición para poder reenviarlos."""
+    for value in files.values():
+        fileobj = value[1] if isinstance(value, tuple) else value
+        if hasattr(fileobj, 'seek'):
+            fileobj.seek(0)
+
+def post_with_retry(session, url, files, data, max_retries=MAX_RETRIES, limiter=None, size=None,
+                    **kwargs):
+    """
+    Envía una imagen a la API respetando Retry-After cuando está saturada.
+
+    Los 429 y 503 y los errores de conexión se reintentan con backoff y jitter
+    (ver retry_wait).
+
+    Args:
+        session: Sesión de requests (o el propio módulo requests)
+        url: URL del endpoint
+        files: Archivos de la petición, como en requests.post
+        data: Campos del formulario
+        max_retries: Reintentos máximos
+        limiter: AdaptiveLimiter opcional que regula las peticiones en curso
+        size: Bytes enviados, para que el limiter compare latencias de
+            imágenes de distinto tamaño
+        **kwargs: Argumentos adicionales para session.post (timeout, ...)
+
+    Returns:
+        La última respuesta recibida
+
+    Raises:
+        requests.RequestException: Si el último intento falla por un error de conexión
+    """
+    attempt = 0
+    while True:
+        if limiter:
+            limiter.acquire()
+        start = time.monotonic()
+        try:
+            response = session.post(url, files=files, data=data, **kwargs)
+        except OSError as e:
+            # Las excepciones de requests heredan de IOError
+            if limiter:
+                limiter.release(None, time.monotonic() - start)
+            if attempt >= max_retries:
+                raise
+            response = None
+            reason = f"Error de conexión con la API ({str(e)})"
+        else:
+            if limiter:
+                limiter.release(response, time.monotonic() - start, size)
+            if not should_retry(response, attempt, max_retries):
+                return response
+            reason = f"API saturada ({response.status_code})"
+        attempt += 1
+        wait = retry_wait(response, attempt)
+        logging.warning(f"{reason}; reintento {attempt}/{max_retries} en {wait:.1f} s")
+        time.sleep(wait)
+        rewind_files(files)
+
+class AdaptiveLimiter:
+    """
+    Límite adaptativo de peticiones en curso a la API (AIMD).
+
+    Cada respuesta rápida sube el límite en 1/límite (uno por ronda de
+    respuestas) hasta max_in_flight. Un 429 o 503 o un error de conexión lo
+    reducen a la mitad, y una respuesta lenta (ver LATENCY_TOLERANCE) lo reduce
+    un poco; solo si la petición se envió después de la última reducción,
+    porque las que ya estaban en curso reflejan la misma saturación. Si la API
+    envía Retry-After, ningún hilo envía nada hasta que pase ese tiempo.
+    """
+
+    def __init__(self, max_in_flight, initial=None):
+        """
+        Args:
+            max_in_flight: Peticiones en curso máximas
+            initial: Límite inicial (max_in_flight por defecto)
+        """
+        self.max_in_flight = max_in_flight
+        self.limit = float(initial or max_in_flight)
+        self.in_flight = 0
+
+        self._condition = threading.Condition()
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._resume_at = 0.0
+        self._last_decrease = 0.0
+
+    def acquire(self):
+        """Espera hasta que se pueda enviar otra petición."""
+        with self._condition:
+            while True:
+                wait = self._resume_at - time.monotonic()
+                if wait <= 0 and self.in_flight < int(self.limit):
+                    break
+                self._condition.wait(wait if wait > 0 else None)
+            self.in_flight += 1
+
+    def release(self, response, latency=None, size=None):
+        """
+        Registra el resultado de una petición y ajusta el límite.
+
+        Args:
+            response: Respuesta recibida (None si hubo un error de conexión)
+            latency: Segundos desde que se envió la petición
+            size: Bytes enviados (None si no se conocen)
+        """
+        with self._condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            sent = now - (latency or 0)
+            if response is None:
+                self._decrease(sent, 0.5)
+            elif response.status_code in RETRY_STATUS_CODES:
+                self._decrease(sent, 0.5)
+                self._resume_at = max(self._resume_at, now + retry_after_seconds(response, default=0))
+            elif latency is not None:
+                # Segundos por MB, con un mínimo para que las imágenes pequeñas
+                # (dominadas por la latencia fija) no parezcan lentísimas
+                cost = latency / max((size or 0) / 1024 / 1024, 0.25)
+                slow = self._latencies and cost > LATENCY_TOLERANCE * min(self._latencies)
+                self._latencies.append(cost)
+                if slow:
+                    self._decrease(sent, LATENCY_DECREASE)
+                else:
+                    self.limit = min(self.max_in_flight, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+    def _decrease(self, sent, factor):
+        if sent < self._last_decrease:
+            return
+        self._last_decrease = time.monotonic()
+        self.limit = max(1.0, self.limit * factor)
+        logging.info(f"Peticiones en curso a la API: como mucho {int(self.limit)}")
@@ -1,179 +1,915 @@
-from flask import Flask, request, send_file, jsonify, render_template_string
-from PIL import Image, ImageDraw, ImageFont
+from flask import Flask, Response, request, jsonify, render_template_string, stream_with_context, g, url_for
+from PIL import Image
 import os
 import io
 import uuid
 import time
-import datetime
 import json
-from math import sqrt
+import logging
+import tempfile
+import warnings
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import ExitStack, nullcontext
+
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.wsgi import wrap_file
+
+from admission import AdmissionController, Overloaded
+from jobs import JobQueue, LocalBackend
+from metrics import Metrics
+from profiling import RequestProfiler
+from progressive_upload import PROBE_BYTES, receive_upload
+from render_pool import RenderPool
+from result_cache import ResultCache, content_key
+from stats_store import StatsStore
+from watermark_engine import (create_watermark, format_of, log_font_path, prepare_decode,
+                              render_signature, COMPOSITE_MODE, MEMORY_BUDGET_MB, OUTPUT_FORMATS)
+
+# Configuración de logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+log_font_path()
 
 app = Flask(__name__)
 
-# Crear directorio temporal para archivos
+# Tamaño máximo de una petición (en MB). Flask responde 413 sin leer el resto
+MAX_UPLOAD_MB = int(os.environ.get('WATERMARK_MAX_UPLOAD_MB', 50))
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_MB * 1024 * 1024
+
+# Número máximo de píxeles de una imagen. Se comprueba con la cabecera de la
+# imagen, antes de decodificarla
+MAX_IMAGE_PIXELS = int(os.environ.get('WATERMARK_MAX_PIXELS', 100_000_000))
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+# El aviso de Pillow sobra: las imágenes que superan el límite se rechazan
+warnings.simplefilter('ignore', Image.DecompressionBombWarning)
+
+# Modo de servicio: 'thread' aplica la marca de agua en el hilo de la petición;
+# 'process' solo decodifica en él y entrega los píxeles, por memoria compartida,
+# a un pool de RENDER_PROCESSES procesos
+SERVING_MODE = os.environ.get('WATERMARK_SERVING_MODE', 'thread')
+RENDER_PROCESSES = int(os.environ.get('WATERMARK_RENDER_PROCESSES', os.cpu_count() or 1))
+if SERVING_MODE not in ('thread', 'process'):
+    raise ValueError(f"Modo de servicio no válido: {SERVING_MODE}")
+render_pool = RenderPool(RENDER_PROCESSES) if SERVING_MODE == 'process' else None
+
+# Control de admisión: imágenes que se procesan a la vez en cada worker,
+# peticiones que pueden esperar turno y segundos máximos de espera. En modo
+# 'process' se admiten dos por proceso del pool, para que la decodificación de
+# unas se solape con la marca de agua de otras
+MAX_CONCURRENT_RENDERS = int(os.environ.get(
+    'WATERMARK_MAX_RENDERS', 2 * RENDER_PROCESSES if render_pool else os.cpu_count() or 1))
+MAX_QUEUED_RENDERS = int(os.environ.get('WATERMARK_MAX_QUEUED', 4))
+QUEUE_TIMEOUT = float(os.environ.get('WATERMARK_QUEUE_TIMEOUT', 30))
+admission = AdmissionController(MAX_CONCURRENT_RENDERS, MAX_QUEUED_RENDERS, QUEUE_TIMEOUT)
+
+# Rutas que procesan imágenes y pasan por el control de admisión
+RENDER_PATHS = ('/watermark', '/watermark/batch')
+
+# Directorio para los archivos temporales que se vuelcan a disco
 UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'temp')
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-# Archivo para almacenar estadísticas
+# Número de imágenes de un lote que se procesan a la vez
+BATCH_WORKERS = int(os.environ.get('WATERMARK_BATCH_WORKERS', os.cpu_count() or 1))
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix='watermark-batch')
+
+# Base de datos para almacenar estadísticas (compartida por todos los workers)
+STATS_DB = os.environ.get('WATERMARK_STATS_DB',
+                          os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stats.db'))
+
+# Archivo de estadísticas de versiones anteriores, que se importa una sola vez
 STATS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stats.json')
 
 # Inicializar estadísticas
+stats_store = StatsStore(STATS_DB, legacy_file=STATS_FILE)
+
 def load_stats():
-    if os.path.exists(STATS_FILE):
-        try:
-            with open(STATS_FILE, 'r') as f:
-                return json.load(f)
-        except:
-            pass
-    return {
-        'total_images': 0,
-        'last_processed': None,
-        'processing_history': []
-    }
-
-def save_stats(stats):
-    with open(STATS_FILE, 'w') as f:
-        json.dump(stats, f)
+    """Devuelve las estadísticas agregadas de todos los workers."""
+    return stats_store.snapshot()
 
 def update_stats(filename, code):
-    stats = load_stats()
-    stats['total_images'] += 1
-    now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    stats['last_processed'] = now
-
-    # Limitar el historial a los últimos 10 elementos
-    if len(stats['processing_history']) >= 10:
-        stats['processing_history'] = stats['processing_history'][-9:]
-
-    stats['processing_history'].append({
-        'filename': filename,
-        'code': code,
-        'timestamp': now
+    """Registra una imagen procesada (se guarda por lotes en segundo plano)."""
+    stats_store.record(filename, code)
+
+# Métricas de latencia y tráfico, agregadas entre workers en la misma base de datos
+metrics = Metrics(STATS_DB)
+metrics.counter('watermark_requests_total', "Peticiones atendidas por endpoint y código de estado")
+metrics.histogram('watermark_request_duration_seconds', "Duración total de las peticiones, hasta terminar de enviar la respuesta")
+metrics.histogram('watermark_stage_seconds', "Duración de cada etapa de /watermark (receive, decode, resize, render, composite, encode, send)")
+metrics.counter('watermark_request_bytes_total', "Bytes recibidos en el cuerpo de las peticiones")
+metrics.counter('watermark_response_bytes_total', "Bytes enviados en el cuerpo de las respuestas")
+metrics.gauge('watermark_requests_in_flight', "Peticiones en curso")
+metrics.counter('watermark_cache_requests_total', "Consultas a la caché de resultados (hit, miss o not_modified)")
+metrics.counter('watermark_rejected_total', "Peticiones rechazadas por el control de admisión, por motivo")
+metrics.counter('watermark_jobs_total', "Trabajos asíncronos terminados, por resultado (done o error)")
+
+# Rutas que no se miden (para que consultar las métricas no las altere)
+UNMETERED_PATHS = ('/metrics',)
+
+# Perfilado de /watermark bajo demanda: se perfilan con cProfile las peticiones
+# que traen la cabecera PROFILE_HEADER con WATERMARK_PROFILE_TOKEN y, al azar,
+# una fracción WATERMARK_PROFILE_RATE del resto. Los perfiles se descargan en
+# /admin/profiles con la misma cabecera. Sin token ni muestreo no se perfila nada
+PROFILE_TOKEN = os.environ.get('WATERMARK_PROFILE_TOKEN') or None
+PROFILE_SAMPLE_RATE = float(os.environ.get('WATERMARK_PROFILE_RATE', 0))
+PROFILE_DIR = os.environ.get('WATERMARK_PROFILE_DIR',
+                             os.path.join(tempfile.gettempdir(), 'watermark-profiles'))
+PROFILE_KEEP = int(os.environ.get('WATERMARK_PROFILE_KEEP', 50))
+PROFILE_HEADER = 'X-Profile-Token'
+profiler = RequestProfiler(PROFILE_DIR, PROFILE_TOKEN, PROFILE_SAMPLE_RATE, PROFILE_KEEP)
+
+@app.before_request
+def start_request_metrics():
+    """Anota el inicio de la petición y la cuenta como en curso."""
+    if request.path in UNMETERED_PATHS:
+        return
+    g.request_start = time.perf_counter()
+    g.request_endpoint = request.url_rule.rule if request.url_rule else 'desconocido'
+    metrics.inc('watermark_requests_in_flight')
+
+def overloaded_response(retry_after):
+    """Respuesta 429 con el tiempo tras el que conviene reintentar."""
+    response = jsonify({'error': 'El servicio está saturado, inténtalo de nuevo más tarde',
+                        'retry_after': retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+def too_many_pixels(img):
+    """True si la imagen (abierta, aún sin decodificar) supera MAX_IMAGE_PIXELS."""
+    return img.width * img.height > MAX_IMAGE_PIXELS
+
+def pixels_error(img=None):
+    """Mensaje de error para una imagen con demasiados píxeles."""
+    size = f" ({img.width}x{img.height})" if img is not None else ""
+    return f"La imagen{size} supera el máximo de {MAX_IMAGE_PIXELS} píxeles"
+
+@app.before_request
+def reject_when_saturated():
+    """Rechaza las peticiones de procesamiento sin leer la subida si no caben en la cola."""
+    if request.method == 'POST' and request.path in RENDER_PATHS and admission.saturated():
+        metrics.inc('watermark_rejected_total', reason='queue_full')
+        return overloaded_response(admission.retry_after())
+
+@app.errorhandler(RequestEntityTooLarge)
+def upload_too_large(error):
+    """Respuesta 413 para las subidas que superan MAX_UPLOAD_MB."""
+    metrics.inc('watermark_rejected_total', reason='upload_size')
+    return jsonify({'error': f"La subida supera el máximo de {MAX_UPLOAD_MB} MB"}), 413
+
+@app.after_request
+def finish_request_metrics(response):
+    """Registra las métricas de la petición cuando se termina de enviar la respuesta."""
+    if 'request_start' not in g:
+        return response
+    start = g.pop('request_start')
+    endpoint = g.request_endpoint
+    send_start = time.perf_counter()
+    status = str(response.status_code)
+    request_bytes = request.content_length or 0
+    measure_send = endpoint == '/watermark' and response.status_code == 200
+
+    def on_close():
+        now = time.perf_counter()
+        if measure_send:
+            metrics.observe('watermark_stage_seconds', now - send_start, stage='send')
+        metrics.observe('watermark_request_duration_seconds', now - start, endpoint=endpoint)
+        metrics.inc('watermark_requests_total', endpoint=endpoint, status=status)
+        metrics.inc('watermark_request_bytes_total', request_bytes, endpoint=endpoint)
+        if response.content_length is not None:
+            metrics.inc('watermark_response_bytes_total', response.content_length, endpoint=endpoint)
+        metrics.dec('watermark_requests_in_flight')
+
+    response.call_on_close(on_close)
+    return response
+
+@app.teardown_request
+def abort_request_metrics(error):
+    """Cierra las métricas de una petición que terminó con una excepción sin respuesta."""
+    if 'request_start' in g:
+        g.pop('request_start')
+        metrics.inc('watermark_requests_total', endpoint=g.request_endpoint, status='500')
+        metrics.dec('watermark_requests_in_flight')
+
+@app.before_request
+def start_profile():
+    """Empieza a perfilar la petición si lo pide la cabecera o le toca por muestreo."""
+    if not profiler.enabled or request.path != '/watermark' or request.method != 'POST':
+        return
+    trigger = profiler.trigger(request.headers.get(PROFILE_HEADER))
+    if trigger:
+        profile = profiler.start()
+        if profile is not None:
+            g.profile = (profile, trigger, time.perf_counter())
+
+def save_profile(status):
+    """Termina el perfil de la petición, si lo hay, y devuelve su identificador."""
+    profile, trigger, start = g.pop('profile')
+    details = g.get('profile_details', {})
+    return profiler.stop(profile, {
+        'trigger': trigger,
+        'path': request.path,
+        'status': status,
+        'seconds': time.perf_counter() - start,
+        'filename': details.get('filename'),
+        'code': details.get('code'),
+        'stages': details.get('timings'),
     })
 
-    save_stats(stats)
+@app.after_request
+def finish_profile(response):
+    """Guarda el perfil de la petición e indica su identificador en X-Profile-Id."""
+    if 'profile' in g:
+        profile_id = save_profile(response.status_code)
+        if profile_id:
+            response.headers['X-Profile-Id'] = profile_id
+    return response
+
+@app.teardown_request
+def abort_profile(error):
+    """Guarda el perfil de una petición que terminó con una excepción sin respuesta."""
+    if 'profile' in g:
+        save_profile(500)
+
+def profiles_access_error():
+    """Respuesta de error si la petición no puede acceder a los perfiles (None si puede)."""
+    if not PROFILE_TOKEN:
+        return jsonify({'error': 'El acceso a los perfiles no está activado'}), 404
+    if not profiler.authorized(request.headers.get(PROFILE_HEADER)):
+        return jsonify({'error': 'No autorizado'}), 403
+    return None
+
+@app.route('/admin/profiles', methods=['GET'])
+def list_profiles():
+    """Lista los perfiles guardados, del más reciente al más antiguo."""
+    error = profiles_access_error()
+    if error:
+        return error
+    return jsonify({'profiles': profiler.profiles()})
+
+@app.route('/admin/profiles/<profile_id>', methods=['GET'])
+def get_profile(profile_id):
+    """
+    Descarga un perfil en el formato de pstats (para snakeviz, pstats...) o,
+    con ?format=text, un resumen en texto ordenado por ?sort= (cumulative por
+    defecto) con las ?limit= primeras funciones.
+    """
+    error = profiles_access_error()
+    if error:
+        return error
+    path = profiler.path(profile_id)
+    if path is None:
+        return jsonify({'error': 'El perfil no existe'}), 404
+
+    if request.args.get('format') == 'text':
+        try:
+            summary = profiler.summary(profile_id, request.args.get('sort', 'cumulative'),
+                                       int(request.args.get('limit', 40)))
+        except (KeyError, ValueError):
+            return jsonify({'error': 'Parámetros sort o limit no válidos'}), 400
+        return Response(summary, content_type='text/plain; charset=utf-8')
+
+    profile = open(path, 'rb')
+    profile.seek(0, io.SEEK_END)
+    return buffer_response(profile, 'application/octet-stream', f"{profile_id}.prof")
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Métricas de todos los workers en el formato de texto de Prometheus."""
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+def observe_stages(timings):
+    """Registra los segundos de cada etapa del procesamiento de una imagen."""
+    for stage, seconds in timings.items():
+        metrics.observe('watermark_stage_seconds', seconds, stage=stage)
+
+# Tamaño (en MB) a partir del cual la imagen de salida se vuelca a un archivo
+# temporal en lugar de mantenerse en memoria. 0 = nunca usar el disco
+RESPONSE_SPILL_MB = int(os.environ.get('WATERMARK_RESPONSE_SPILL_MB', 0))
+
+def new_output_buffer():
+    """
+    Crea el búfer en el que se codifica la imagen de salida.
 
-def create_watermark(input_image, output_path, file_code):
+    Returns:
+        Un io.BytesIO, o un SpooledTemporaryFile si RESPONSE_SPILL_MB está activo
+    """
+    if RESPONSE_SPILL_MB > 0:
+        return tempfile.SpooledTemporaryFile(max_size=RESPONSE_SPILL_MB * 1024 * 1024,
+                                             dir=UPLOAD_FOLDER)
+    return io.BytesIO()
+
+# Caché de resultados indexada por el contenido de la imagen, el código y los
+# parámetros de renderizado. El nivel en memoria es propio de cada worker; el
+# nivel en disco (opcional) se comparte entre todos
+RESULT_CACHE_MB = int(os.environ.get('WATERMARK_CACHE_MB', 32))
+RESULT_CACHE_DIR = os.environ.get('WATERMARK_CACHE_DIR')
+RESULT_CACHE_DISK_MB = int(os.environ.get('WATERMARK_CACHE_DISK_MB', 512))
+result_cache = ResultCache(RESULT_CACHE_MB * 1024 * 1024, RESULT_CACHE_DIR,
+                           RESULT_CACHE_DISK_MB * 1024 * 1024 if RESULT_CACHE_DIR else 0)
+
+def result_key(stream, file_code, options):
+    """Devuelve la clave de caché (y ETag) del resultado de una imagen subida."""
+    return content_key(stream, file_code, render_signature(**options))
+
+# Formato de salida correspondiente a cada tipo MIME, para negociar con Accept
+FORMATS_BY_MIMETYPE = {mimetype: name for name, (_, mimetype, _) in OUTPUT_FORMATS.items()}
+
+# Opciones de salida que se aceptan en el formulario y cómo se convierten
+OPTION_FIELDS = {
+    'max_dimension': int,
+    'preset': str,
+    'quality': int,
+    'subsampling': str,
+    'progressive': lambda value: value.lower() in ('1', 'true', 'yes', 'si', 'sí'),
+    'optimize': lambda value: value.lower() in ('1', 'true', 'yes', 'si', 'sí'),
+    'method': int,
+    'compress_level': int,
+    'min_psnr': float,
+}
+
+def parse_options(form, default_format):
     """
-    Aplica una marca de agua a una imagen.
+    Lee del formulario el formato de salida, las opciones del codificador y el
+    tamaño máximo.
 
     Args:
-        input_image: Objeto de imagen PIL
-        output_path: Ruta donde guardar la imagen con marca de agua
-        file_code: Código único para incluir en la marca de agua
+        form: Formulario de la petición
+        default_format: Formato si no se envía 'output_format'
 
     Returns:
-        bool: True si el proceso fue exitoso
+        dict: Argumentos de salida para create_watermark
+
+    Raises:
+        ValueError: Si alguna opción no es válida
     """
-    watermark_text = f"@pedro.rj2 #{file_code}"
+    options = {'output_format': form.get('output_format') or default_format}
+    for name, convert in OPTION_FIELDS.items():
+        value = form.get(name)
+        if value:
+            try:
+                options[name] = convert(value)
+            except ValueError:
+                raise ValueError(f"Valor no válido para '{name}': {value}")
+    # Validar la combinación de opciones antes de procesar nada
+    render_signature(**options)
+    return options
+
+def output_name(file_code, output_format, suffix=''):
+    """Nombre de descarga de una imagen procesada."""
+    return f"{file_code}{suffix}_watermarked{OUTPUT_FORMATS[output_format][2]}"
+
+def buffer_response(buffer, mimetype, download_name):
+    """
+    Crea una respuesta que envía el contenido de un búfer como archivo adjunto.
 
-    # Usar la imagen proporcionada
-    img = input_image
+    El búfer se transmite sin copiarlo, con su Content-Length, y se cierra al
+    terminar de enviar la respuesta.
+    """
+    size = buffer.tell()
+    buffer.seek(0)
+    # Sin direct_passthrough, para que el servidor llame a response.close() al
+    # terminar y se ejecuten las funciones registradas con call_on_close
+    response = Response(wrap_file(request.environ, buffer), mimetype=mimetype)
+    response.content_length = size
+    response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+    response.call_on_close(buffer.close)
+    return response
 
-    # Convertir a RGB si es necesario
-    if img.mode != 'RGB':
-        img = img.convert('RGB')
+def upload_head(stream):
+    """Primeros bytes de una imagen subida, con los que se reconoce si ya se procesó."""
+    stream.seek(0)
+    head = stream.read(PROBE_BYTES)
+    stream.seek(0)
+    return head
 
-    width, height = img.size
+def likely_cached(head):
+    """
+    True si el resultado de la imagen que está llegando probablemente ya está en
+    caché (o el cliente trae su ETag). Entonces no se decodifica mientras llega:
+    se consulta antes la caché y solo se decodifica si no está.
+    """
+    if request.if_none_match:
+        return True
+    return result_cache.enabled and result_cache.has_source(head)
 
-    # Crear una nueva imagen para la marca de agua
-    txt = Image.new('RGBA', img.size, (255, 255, 255, 0))
+def prepare_upload(img, fields):
+    """
+    Prepara una imagen que se decodifica mientras llega: si supera el máximo de
+    píxeles no se decodifica (se rechaza después con 413) y, si no, se reduce con
+    draft y se vuelca a disco igual que en create_watermark.
 
-    # Calcular tamaño de fuente basado en la diagonal de la imagen
-    diagonal = sqrt(width**2 + height**2)
-    font_size = int(diagonal * 0.025)  # 2.5% de la diagonal
+    La imagen decodificada ocupa tanta memoria como un render, así que solo se
+    decodifica mientras llega si hay un turno de admisión libre. El turno se
+    conserva hasta el final de la petición (ver release_decode_slot) y el
+    render lo usa en lugar de pedir otro. Si no hay ninguno, la imagen se
+    decodifica al terminar la subida, dentro de su turno.
 
+    Returns:
+        Tamaño original de la imagen, o False si no hay que decodificarla
+    """
+    if too_many_pixels(img):
+        return False
     try:
-        # Intentar usar Arial
-        font = ImageFont.truetype("arial.ttf", font_size)
-    except:
-        try:
-            # Intentar usar Times New Roman
-            font = ImageFont.truetype("times.ttf", font_size)
-        except:
-            # Si no hay fuentes TrueType, usar la fuente por defecto
-            font = ImageFont.load_default()
-
-    # Crear objeto para dibujar
-    d = ImageDraw.Draw(txt)
-
-    # Calcular dimensiones del texto usando textbbox
-    bbox = d.textbbox((0, 0), watermark_text, font=font)
-    textwidth = bbox[2] - bbox[0]
-    textheight = bbox[3] - bbox[1]
-
-    # Calcular espaciado para el patrón diagonal
-    x_spacing = textwidth + 50
-    y_spacing = textheight + 50
-
-    # Calcular punto de inicio para que el texto comience desde el borde
-    start_x = 0
-    start_y = 0
-
-    # Dibujar marca de agua en patrón diagonal
-    y = start_y
-    while y < height:
-        x = start_x
-        while x < width:
-            # Dibujar texto semi-transparente
-            d.text((x, y), watermark_text, font=font, fill=(128, 128, 128, 30))
-            # Dibujar texto sólido
-            d.text((x+2, y+2), watermark_text, font=font, fill=(64, 64, 64, 30))
-            x += x_spacing
-        y += y_spacing
-
-    # Combinar imagen original con marca de agua
-    watermarked = Image.alpha_composite(img.convert('RGBA'), txt)
-
-    # Guardar resultado
-    watermarked.convert('RGB').save(output_path, 'JPEG', quality=95)
-    return True
+        max_dimension = int(fields.get('max_dimension') or 0)
+    except ValueError:
+        # La opción no válida se rechaza al leer el formulario completo
+        return False
+    slot = admission.try_slot()
+    if slot is None:
+        return False
+    g.decode_slot = ExitStack()
+    g.decode_slot.enter_context(slot)
+    # En modo 'process' la imagen se copia después a memoria compartida, así
+    # que no se decodifica sobre disco
+    return prepare_decode(img, MEMORY_BUDGET_MB * 1024 * 1024, max_dimension,
+                          streaming=COMPOSITE_MODE == 'numpy' and render_pool is None)
+
+@app.teardown_request
+def release_decode_slot(error):
+    """Libera el turno tomado para decodificar la imagen mientras llegaba."""
+    if 'decode_slot' in g:
+        g.pop('decode_slot').close()
 
 @app.route('/watermark', methods=['POST'])
 def watermark_image():
     """
     Endpoint para aplicar marca de agua a una imagen.
 
-    Espera un archivo de imagen en el campo 'image' del formulario.
-    Opcionalmente puede recibir un 'code' personalizado para la marca de agua.
+    Espera un archivo de imagen en el campo 'image' del formulario, o la imagen
+    tal cual como cuerpo de la petición (Content-Type image/*) con las opciones
+    en la URL. Opcionalmente puede recibir un 'code' personalizado para la marca
+    de agua.
+
+    La subida se lee por bloques y los JPEG se decodifican mientras llegan, así
+    que al recibir el último byte solo queda aplicar la marca de agua y codificar.
+    Si la imagen probablemente ya está en caché, no se decodifica hasta comprobarlo.
 
     Returns:
         La imagen con marca de agua o un mensaje de error.
     """
+    receive_start = time.perf_counter()
+    try:
+        upload = receive_upload(request.stream, request.content_type, fields=request.args,
+                                prepare=prepare_upload, defer=likely_cached)
+    except ValueError:
+        return jsonify({'error': 'Formulario no válido'}), 400
+    timings = {'receive': time.perf_counter() - receive_start - upload.decode_time,
+               'decode': upload.decode_time}
+    form = upload.fields
+
     # Verificar si se recibió un archivo
-    if 'image' not in request.files:
+    if upload.filename is None:
         return jsonify({'error': 'No se envió ninguna imagen'}), 400
 
-    file = request.files['image']
-
     # Verificar si el archivo tiene nombre
-    if file.filename == '':
+    if upload.filename == '':
         return jsonify({'error': 'No se seleccionó ninguna imagen'}), 400
 
     # Obtener el código personalizado o generar uno
-    file_code = request.form.get('code', str(uuid.uuid4())[:8])
-
+    file_code = form.get('code', str(uuid.uuid4())[:8])
+    if 'profile' in g:
+        g.profile_details = {'filename': upload.filename, 'code': file_code, 'timings': timings}
+
+    # Formato de salida: el del campo 'output_format' o, si no se indica, el
+    # preferido en la cabecera Accept (JPEG por defecto)
+    best = request.accept_mimetypes.best_match(list(FORMATS_BY_MIMETYPE))
+    default_format = FORMATS_BY_MIMETYPE.get(best, 'jpeg')
     try:
-        # Abrir la imagen con PIL
-        img = Image.open(file.stream)
+        options = parse_options(form, default_format)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
-        # Generar un nombre de archivo único para la salida
-        output_filename = f"{file_code}_watermarked.jpg"
-        output_path = os.path.join(UPLOAD_FOLDER, output_filename)
+    def finish(response):
+        """Añade el ETag y, si el formato depende de Accept, la cabecera Vary."""
+        response.set_etag(etag)
+        if 'output_format' not in form:
+            response.vary.add('Accept')
+        return response
 
-        # Aplicar marca de agua
-        create_watermark(img, output_path, file_code)
+    try:
+        # El resultado depende solo de la imagen, el código y los parámetros de
+        # renderizado, así que su hash sirve como ETag
+        etag = result_key(upload.stream, file_code, options)
+        if request.if_none_match.contains(etag):
+            metrics.inc('watermark_cache_requests_total', result='not_modified')
+            return finish(Response(status=304))
+
+        # Si el resultado ya está en caché, no hace falta ni decodificar la imagen
+        cached = result_cache.get(etag) if result_cache.enabled else None
+        if cached is not None:
+            metrics.inc('watermark_cache_requests_total', result='hit')
+            result_cache.remember_source(upload_head(upload.stream))
+            update_stats(upload.filename, file_code)
+            buffer = io.BytesIO(cached)
+            buffer.seek(0, io.SEEK_END)
+            used_format = format_of(cached)
+            return finish(buffer_response(buffer, OUTPUT_FORMATS[used_format][1],
+                                          output_name(file_code, used_format)))
+
+        # Leer ya el principio de la subida, que se recuerda al guardar el
+        # resultado: cerrar la imagen tras renderizar cierra también la subida
+        source_head = upload_head(upload.stream) if result_cache.enabled else None
+
+        # Usar la imagen ya decodificada o, si no se pudo decodificar mientras
+        # llegaba, abrirla con PIL (solo lee la cabecera) y comprobar su tamaño
+        # antes de decodificarla
+        img = upload.image
+        if img is not None and upload.prepared_fields.get('max_dimension') != form.get('max_dimension'):
+            # max_dimension llegó después de la imagen: decodificarla de nuevo
+            # para que el resultado sea el mismo que con los campos delante
+            img.close()
+            img = None
+        if img is None:
+            try:
+                img = Image.open(upload.stream)
+            except Image.DecompressionBombError:
+                img = None
+            except Image.UnidentifiedImageError:
+                return jsonify({'error': 'El archivo no es una imagen válida'}), 400
+            if img is None or too_many_pixels(img):
+                metrics.inc('watermark_rejected_total', reason='pixels')
+                return jsonify({'error': pixels_error(img)}), 413
+
+        # Solo cuenta como fallo de caché la imagen que se va a renderizar: las
+        # rechazadas por tamaño o por no ser imágenes no llegan a usar la caché
+        metrics.inc('watermark_cache_requests_total', result='miss')
+
+        # Codificar el resultado en memoria (o en un archivo temporal anónimo si
+        # se ha activado el volcado a disco y la salida es muy grande)
+        output = new_output_buffer()
+
+        # Esperar turno (salvo si ya se tomó para decodificar mientras llegaba la
+        # imagen) y aplicar marca de agua por franjas dentro del presupuesto de
+        # memoria
+        with nullcontext() if 'decode_slot' in g else admission.slot():
+            used_format = render_image(img, output, file_code,
+                                       memory_budget=MEMORY_BUDGET_MB * 1024 * 1024,
+                                       timings=timings, original_size=upload.original_size,
+                                       **options)
+            # Liberar la imagen decodificada antes de soltar el turno
+            img.close()
+        observe_stages(timings)
+
+        # Guardar el resultado en caché
+        if result_cache.enabled:
+            size = output.tell()
+            output.seek(0)
+            result_cache.put(etag, output.read())
+            output.seek(size)
+            result_cache.remember_source(source_head)
 
         # Actualizar estadísticas
-        update_stats(file.filename, file_code)
+        update_stats(upload.filename, file_code)
 
         # Devolver la imagen procesada
-        return send_file(output_path, mimetype='image/jpeg', as_attachment=True,
-                         download_name=output_filename)
+        return finish(buffer_response(output, OUTPUT_FORMATS[used_format][1],
+                                      output_name(file_code, used_format)))
+
+    except Overloaded as e:
+        metrics.inc('watermark_rejected_total', reason='queue_timeout')
+        return overloaded_response(e.retry_after)
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+    finally:
+        upload.close()
+
+def render_image(img, output, file_code, memory_budget=None, timings=None, **options):
+    """
+    Aplica la marca de agua a una imagen abierta según el modo de servicio.
+
+    En modo 'process' la imagen se decodifica aquí y la marca de agua se aplica
+    en el pool de procesos (sin presupuesto de memoria: la imagen decodificada
+    está entera en memoria compartida); en modo 'thread', con create_watermark
+    en el propio hilo.
+
+    Returns:
+        str: Formato de salida usado ('jpeg', 'webp' o 'png')
+    """
+    if render_pool is not None:
+        return render_pool.render(img, output, file_code, timings=timings, **options)
+    return create_watermark(img, output, file_code, memory_budget=memory_budget,
+                            timings=timings, **options)
+
+def watermark_upload(stream, file_code, memory_budget, options):
+    """
+    Aplica la marca de agua a un archivo subido y devuelve la imagen resultante.
+
+    Args:
+        stream: Flujo con los bytes de la imagen subida
+        file_code: Código único para incluir en la marca de agua
+        memory_budget: Presupuesto de memoria en bytes para esta imagen
+        options: Opciones de salida (formato, codificador y tamaño máximo)
+
+    Returns:
+        bytes: Imagen con marca de agua codificada
+    """
+    key = result_key(stream, file_code, options) if result_cache.enabled else None
+    cached = result_cache.get(key) if key else None
+    if cached is not None:
+        metrics.inc('watermark_cache_requests_total', result='hit')
+        return cached
+
+    output = io.BytesIO()
+    try:
+        img = Image.open(stream)
+    except Image.DecompressionBombError:
+        raise ValueError(pixels_error())
+    except Image.UnidentifiedImageError:
+        # El mensaje de Pillow incluye el objeto del archivo temporal
+        raise ValueError('El archivo no es una imagen válida')
+    with img:
+        if too_many_pixels(img):
+            raise ValueError(pixels_error(img))
+        if key:
+            metrics.inc('watermark_cache_requests_total', result='miss')
+        # Las imágenes de un lote ya admitido esperan turno sin límite
+        with admission.slot(block=True):
+            render_image(img, output, file_code, memory_budget=memory_budget, **options)
+    data = output.getvalue()
+    if key:
+        result_cache.put(key, data)
+    return data
+
+class ZipStream:
+    """
+    Destino de escritura para zipfile que acumula los bytes escritos para
+    enviarlos por partes. Al no permitir seek, zipfile escribe cada entrada de
+    forma secuencial (con descriptores de datos) y el ZIP se puede transmitir
+    mientras se genera.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        """Devuelve y descarta los bytes acumulados desde la última llamada."""
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def process_batch(items, options):
+    """
+    Procesa las imágenes de un lote de forma concurrente.
+
+    Como mucho hay BATCH_WORKERS imágenes en proceso o pendientes de enviar a la
+    vez, de modo que el lote nunca se guarda completo en memoria.
+
+    Args:
+        items: Lista de tuplas (nombre de archivo, flujo, código)
+        options: Opciones de salida (formato, codificador y tamaño máximo)
+
+    Yields:
+        tuple: (índice, bytes de la imagen o None, error o None) en el orden en que
+            terminan las imágenes
+    """
+    memory_budget = MEMORY_BUDGET_MB * 1024 * 1024 // BATCH_WORKERS
+    pending = {}
+    next_index = 0
+
+    while next_index < len(items) or pending:
+        # Mantener la ventana de imágenes en proceso llena
+        while next_index < len(items) and len(pending) < BATCH_WORKERS:
+            _, stream, file_code = items[next_index]
+            future = batch_executor.submit(watermark_upload, stream, file_code, memory_budget,
+                                           options)
+            pending[future] = next_index
+            next_index += 1
+
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            index = pending.pop(future)
+            try:
+                yield index, future.result(), None
+            except Exception as e:
+                yield index, None, str(e)
+            finally:
+                items[index][1].close()
+
+@app.route('/watermark/batch', methods=['POST'])
+def watermark_batch():
+    """
+    Endpoint para aplicar marca de agua a varias imágenes en una sola petición.
+
+    Espera uno o más archivos en el campo 'image' del formulario y, opcionalmente,
+    un campo 'code' por cada imagen (en el mismo orden). Las imágenes se procesan
+    de forma concurrente y se devuelven a medida que terminan, como un ZIP o,
+    con 'format=multipart' o 'Accept: multipart/mixed', como multipart/mixed.
+
+    Al final se incluye un 'manifest.json' con el resultado de cada imagen; los
+    errores de una imagen se indican ahí sin hacer fallar el lote completo.
+
+    Returns:
+        Las imágenes con marca de agua y el manifiesto, o un mensaje de error.
+    """
+    files = request.files.getlist('image')
+    if not files:
+        return jsonify({'error': 'No se envió ninguna imagen'}), 400
+
+    codes = request.form.getlist('code')
+    items = []
+    for index, file in enumerate(files):
+        file_code = codes[index] if index < len(codes) and codes[index] else str(uuid.uuid4())[:8]
+        # Tomar posesión del flujo de cada archivo: Flask cierra los archivos de
+        # la petición al salir de la vista, antes de enviar la respuesta
+        items.append((file.filename, file.stream, file_code))
+        file.stream = io.BytesIO()
+
+    response_format = request.form.get('format')
+    if response_format is None:
+        best = request.accept_mimetypes.best_match(['application/zip', 'multipart/mixed'])
+        response_format = 'multipart' if best == 'multipart/mixed' else 'zip'
+    if response_format not in ('zip', 'multipart'):
+        return jsonify({'error': f"Formato no válido: {response_format}"}), 400
+
+    try:
+        options = parse_options(request.form, 'jpeg')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    def results_with_manifest():
+        """Recorre los resultados del lote y construye el manifiesto."""
+        manifest = [None] * len(items)
+        used_names = set()
+        for index, data, error in process_batch(items, options):
+            filename, _, file_code = items[index]
+            entry = {'index': index, 'filename': filename, 'code': file_code}
+            if error is None:
+                used_format = format_of(data)
+                output_filename = output_name(file_code, used_format)
+                if output_filename in used_names:
+                    output_filename = output_name(file_code, used_format, f"_{index}")
+                used_names.add(output_filename)
+                entry['output'] = output_filename
+                entry['format'] = used_format
+                update_stats(filename, file_code)
+            else:
+                entry['error'] = error
+            manifest[index] = entry
+            yield entry, data
+        yield {'manifest': manifest}, None
+
+    def generate_zip():
+        stream = ZipStream()
+        with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_STORED) as archive:
+            for entry, data in results_with_manifest():
+                if 'manifest' in entry:
+                    archive.writestr('manifest.json', json.dumps(entry['manifest'], indent=2))
+                elif data is not None:
+                    archive.writestr(entry['output'], data)
+                yield stream.pop()
+        yield stream.pop()
+
+    boundary = uuid.uuid4().hex
+
+    def generate_multipart():
+        for entry, data in results_with_manifest():
+            if 'manifest' in entry:
+                data = json.dumps(entry['manifest'], indent=2).encode('utf-8')
+                headers = 'Content-Type: application/json\r\n' \
+                          'Content-Disposition: attachment; filename="manifest.json"\r\n'
+            elif data is not None:
+                headers = f'Content-Type: {OUTPUT_FORMATS[entry["format"]][1]}\r\n' \
+                          f'Content-Disposition: attachment; filename="{entry["output"]}"\r\n'
+            else:
+                continue
+            yield (f'--{boundary}\r\n{headers}Content-Length: {len(data)}\r\n\r\n').encode('utf-8')
+            yield data
+            yield b'\r\n'
+        yield f'--{boundary}--\r\n'.encode('utf-8')
+
+    if response_format == 'multipart':
+        return Response(stream_with_context(generate_multipart()),
+                        content_type=f'multipart/mixed; boundary={boundary}')
+    return Response(stream_with_context(generate_zip()), mimetype='application/zip',
+                    headers={'Content-Disposition': 'attachment; filename="watermarked.zip"'})
+
+# Trabajos asíncronos: directorio compartido por todos los workers, segundos que
+# se conservan los resultados, hilos que los procesan y trabajos pendientes
+# máximos por worker
+JOBS_FOLDER = os.environ.get('WATERMARK_JOBS_DIR',
+                             os.path.join(os.path.dirname(os.path.abspath(__file__)), 'jobs'))
+JOB_TTL = int(os.environ.get('WATERMARK_JOB_TTL', 3600))
+JOB_WORKERS = int(os.environ.get('WATERMARK_JOB_WORKERS', 1))
+MAX_PENDING_JOBS = int(os.environ.get('WATERMARK_MAX_JOBS', 16))
+jobs = JobQueue(JOBS_FOLDER, ttl=JOB_TTL, max_pending=MAX_PENDING_JOBS,
+                backend=LocalBackend(JOB_WORKERS))
+
+def run_job(stream, job):
+    """Procesa la imagen de un trabajo asíncrono (en un hilo del backend)."""
+    try:
+        data = watermark_upload(stream, job['code'], MEMORY_BUDGET_MB * 1024 * 1024 // JOB_WORKERS,
+                                job['options'])
+    except Exception:
+        metrics.inc('watermark_jobs_total', status='error')
+        raise
+    metrics.inc('watermark_jobs_total', status='done')
+    update_stats(job['filename'], job['code'])
+    return data, {'format': format_of(data)}
+
+def job_response(job):
+    """Estado público de un trabajo, con los enlaces para consultarlo y descargarlo."""
+    response = {key: job[key] for key in ('id', 'status', 'code', 'filename', 'created', 'started',
+                                          'finished', 'expires', 'format', 'size', 'error')
+                if key in job}
+    response['status_url'] = url_for('get_job', job_id=job['id'])
+    if job['status'] == 'done':
+        response['result_url'] = url_for('get_job_result', job_id=job['id'])
+    return response
+
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    """
+    Endpoint para aplicar marca de agua de forma asíncrona.
+
+    Recibe los mismos campos que /watermark, guarda la imagen y responde de
+    inmediato con el identificador del trabajo. La imagen se procesa en segundo
+    plano; el estado se consulta en /jobs/<id> y el resultado se descarga en
+    /jobs/<id>/result hasta que caduca.
+
+    Returns:
+        202 con el estado del trabajo, o un mensaje de error.
+    """
+    if 'image' not in request.files:
+        return jsonify({'error': 'No se envió ninguna imagen'}), 400
+
+    file = request.files['image']
+    if file.filename == '':
+        return jsonify({'error': 'No se seleccionó ninguna imagen'}), 400
+
+    file_code = request.form.get('code', str(uuid.uuid4())[:8])
+    try:
+        options = parse_options(request.form, 'jpeg')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    # Comprobar que es una imagen y su tamaño leyendo solo la cabecera
+    try:
+        img = Image.open(file.stream)
+    except Image.DecompressionBombError:
+        img = None
+    except Image.UnidentifiedImageError:
+        return jsonify({'error': 'El archivo no es una imagen válida'}), 400
+    if img is None or too_many_pixels(img):
+        metrics.inc('watermark_rejected_total', reason='pixels')
+        return jsonify({'error': pixels_error(img)}), 413
+
+    if jobs.full():
+        metrics.inc('watermark_rejected_total', reason='jobs_full')
+        return overloaded_response(admission.retry_after())
+
+    job = jobs.submit(file.stream, run_job, filename=file.filename, code=file_code, options=options)
+    response = jsonify(job_response(job))
+    response.status_code = 202
+    response.headers['Location'] = url_for('get_job', job_id=job['id'])
+    return response
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Estado de un trabajo asíncrono."""
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'El trabajo no existe o ha caducado'}), 404
+    return jsonify(job_response(job))
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def get_job_result(job_id):
+    """Descarga la imagen de un trabajo terminado."""
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'El trabajo no existe o ha caducado'}), 404
+    if job['status'] != 'done':
+        response = jsonify(dict(job_response(job), error=job.get('error', 'El trabajo aún no ha terminado')))
+        response.status_code = 409
+        if job['status'] in ('queued', 'running'):
+            response.headers['Retry-After'] = '1'
+        return response
+
+    try:
+        result = open(jobs.result_path(job_id), 'rb')
+    except (OSError, TypeError):
+        return jsonify({'error': 'El trabajo no existe o ha caducado'}), 404
+    result.seek(0, io.SEEK_END)
+    return buffer_response(result, OUTPUT_FORMATS[job['format']][1],
+                           output_name(job['code'], job['format']))
+
 @app.route('/', methods=['GET'])
 def home():
     """Página de inicio con instrucciones básicas y estadísticas."""
@@ -240,6 +976,14 @@ else:
     print(f"Error: {{response.json()}}")
             </pre>
 
+            <h3>Varias imágenes en una sola petición:</h3>
+            <pre>curl -X POST -F "image=@foto1.jpg" -F "code=codigo1" -F "image=@foto2.jpg" -F "code=codigo2" https://tu-app.fly.dev/watermark/batch -o imagenes_con_marca.zip</pre>
+            <p>Devuelve un ZIP con las imágenes y un <code>manifest.json</code> con el resultado de cada una.</p>
+
+            <h3>Trabajos asíncronos:</h3>
+            <pre>curl -X POST -F "image=@ruta/a/tu/imagen.jpg" https://tu-app.fly.dev/jobs</pre>
+            <p>Responde con el identificador del trabajo; el estado se consulta en <code>/jobs/&lt;id&gt;</code> y la imagen se descarga en <code>/jobs/&lt;id&gt;/result</code>.</p>
+
             <h3>Usando Telegram:</h3>
             <p>Envía una imagen a nuestro bot de Telegram <code>@TuBotDeWatermark</code> y recibirás la imagen con marca de agua como respuesta.</p>
 
@@ -247,26 +991,15 @@ else:
             <ul>
                 <li><code>image</code>: La imagen a la que se aplicará la marca de agua (obligatorio)</li>
                 <li><code>code</code>: Código personalizado para la marca de agua (opcional)</li>
+                <li><code>output_format</code>: <code>jpeg</code>, <code>webp</code>, <code>png</code> o <code>auto</code> (opcional; por defecto según la cabecera <code>Accept</code>)</li>
+                <li><code>max_dimension</code>: Tamaño máximo en píxeles del lado mayor de la imagen de salida (opcional)</li>
+                <li><code>preset</code>: <code>quality</code>, <code>fast</code> o <code>small</code> (opcional)</li>
+                <li><code>quality</code>, <code>subsampling</code>, <code>progressive</code>, <code>optimize</code>, <code>min_psnr</code>: Ajustes del codificador (opcionales)</li>
             </ul>
         </body>
     </html>
     """
 
-# Limpiar archivos temporales periódicamente (en una aplicación real deberías usar un job programado)
-@app.after_request
-def cleanup_old_files(response):
-    """Elimina archivos temporales antiguos después de cada solicitud."""
-    try:
-        # En una aplicación real, deberías usar un criterio más sofisticado
-        # como eliminar archivos más antiguos que cierto tiempo
-        files = os.listdir(UPLOAD_FOLDER)
-        if len(files) > 100:  # Mantener un máximo de 100 archivos
-            for file in sorted(files)[:-100]:
-                os.remove(os.path.join(UPLOAD_FOLDER, file))
-    except Exception:
-        pass  # No interrumpir la respuesta si hay un error en la limpieza
-    return response
-
 if __name__ == '__main__':
     # Usar el puerto proporcionado por el entorno o 8080 por defecto
     port = int(os.environ.get('PORT', 8080))
@@ -0,0 +1,189 @@
+import os
+import csv
+import hashlib
+import logging
+import threading
+
+# Nombre del manifiesto dentro de la carpeta de salida
+MANIFEST_NAME = 'watermark_manifest.csv'
+
+# Registro de versiones anteriores (código,archivo_original), a veces guardado
+# en Latin-1. Se importa una vez al crear el manifiesto y no se modifica nunca
+LEGACY_LOG_NAME = 'watermark_log.csv'
+
+# Columnas del manifiesto. Las dos primeras son las del registro de versiones
+# anteriores
+MANIFEST_FIELDS = ['código', 'archivo_original', 'tamaño', 'modificado', 'sha256', 'archivo_salida']
+
+# Tamaño de los bloques con los que se calcula el hash de una imagen
+HASH_CHUNK_SIZE = 1024 * 1024
+
+def file_hash(path):
+    """SHA-256 en hexadecimal del contenido de un archivo."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def read_legacy_log(path):
+    """
+    Lee el registro de versiones anteriores, sin modificarlo.
+
+    Returns:
+        list: Las filas del registro, como diccionarios
+    """
+    try:
+        with open(path, newline='', encoding='utf-8-sig') as f:
+            return list(csv.DictReader(f))
+    except UnicodeDecodeError:
+        # Guardado en Latin-1 por versiones anteriores
+        with open(path, newline='', encoding='latin-1') as f:
+            return list(csv.DictReader(f))
+
+class BatchManifest:
+    """
+    Registro de las imágenes ya procesadas de una carpeta, para poder reanudar.
+
+    Se guarda en output_dir/watermark_manifest.csv, en UTF-8, con una fila por imagen: código,
+    nombre del archivo original (relativo a la carpeta de entrada), tamaño,
+    fecha de modificación en nanosegundos, SHA-256 y nombre del archivo de
+    salida. Cada imagen se añade en cuanto termina, así que si el proceso se
+    interrumpe, al volver a lanzarlo solo se procesan las que faltan.
+
+    Una imagen se omite si su tamaño y fecha coinciden con los registrados (sin
+    leerla) o, si solo ha cambiado la fecha, si su hash coincide; en ambos casos
+    el archivo de salida registrado tiene que seguir existiendo.
+
+    Si aún no hay manifiesto pero sí un watermark_log.csv de versiones
+    anteriores, sus filas se copian al manifiesto nuevo y el registro antiguo
+    se deja tal cual, con su codificación.
+    """
+
+    def __init__(self, input_dir, output_dir, name=MANIFEST_NAME):
+        """
+        Args:
+            input_dir: Carpeta de las imágenes originales
+            output_dir: Carpeta de salida, donde se guarda el manifiesto
+            name: Nombre del archivo del manifiesto
+        """
+        self.input_dir = input_dir
+        self.output_dir = output_dir
+        self.path = os.path.join(output_dir, name)
+        self.legacy_path = os.path.join(output_dir, LEGACY_LOG_NAME)
+        self.entries = {}
+        self._lock = threading.Lock()
+        self._file = None
+        self._writer = None
+        self._load()
+        # Reescribir el manifiesto compacto y con las columnas actuales antes
+        # de añadir filas
+        self._rewrite()
+
+    def _load(self):
+        """
+        Lee el manifiesto o, si aún no existe, el registro de versiones
+        anteriores. Si hay filas repetidas, vale la última.
+        """
+        if os.path.exists(self.path):
+            with open(self.path, newline='', encoding='utf-8-sig') as f:
+                rows = list(csv.DictReader(f))
+        elif os.path.exists(self.legacy_path):
+            rows = read_legacy_log(self.legacy_path)
+            logging.info(f"Importadas {len(rows)} filas de {self.legacy_path} al manifiesto {self.path}")
+        else:
+            return
+        for row in rows:
+            if row.get('archivo_original'):
+                self.entries[row['archivo_original']] = row
+
+    def _rewrite(self):
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w', newline='', encoding='utf-8-sig') as f:
+            writer = csv.DictWriter(f, fieldnames=MANIFEST_FIELDS, extrasaction='ignore', restval='')
+            writer.writeheader()
+            writer.writerows(self.entries.values())
+        os.replace(temp_path, self.path)
+
+    def is_done(self, filename, output_filename):
+        """
+        True si una imagen ya se procesó y no ha cambiado desde entonces.
+
+        Args:
+            filename: Nombre de la imagen, relativo a la carpeta de entrada
+            output_filename: Nombre que tendría su archivo de salida
+        """
+        entry = self.entries.get(filename)
+        if entry is None or entry.get('archivo_salida') != output_filename:
+            return False
+        if not os.path.exists(os.path.join(self.output_dir, output_filename)):
+            return False
+
+        try:
+            stat = os.stat(os.path.join(self.input_dir, filename))
+        except OSError:
+            return False
+        if str(stat.st_size) != entry.get('tamaño'):
+            return False
+        if str(stat.st_mtime_ns) == entry.get('modificado'):
+            return True
+
+        # Misma longitud y otra fecha (por ejemplo, copiada de nuevo): comparar el contenido
+        if not entry.get('sha256') or file_hash(os.path.join(self.input_dir, filename)) != entry['sha256']:
+            return False
+        with self._lock:
+            entry['modificado'] = str(stat.st_mtime_ns)
+        return True
+
+    def pending(self, items):
+        """
+        Filtra las imágenes que hay que procesar.
+
+        Args:
+            items: Pares (nombre de la imagen, nombre del archivo de salida)
+
+        Returns:
+            list: Los pares de las imágenes nuevas, cambiadas o sin terminar
+        """
+        return [(filename, output_filename) for filename, output_filename in items
+                if not self.is_done(filename, output_filename)]
+
+    def record(self, filename, code, output_filename):
+        """Registra una imagen procesada (se escribe en el manifiesto enseguida)."""
+        input_path = os.path.join(self.input_dir, filename)
+        try:
+            stat = os.stat(input_path)
+            digest = file_hash(input_path)
+        except OSError as e:
+            logging.warning(f"No se pudo registrar {filename} en el manifiesto: {str(e)}")
+            return
+        entry = {
+            'código': code,
+            'archivo_original': filename,
+            'tamaño': str(stat.st_size),
+            'modificado': str(stat.st_mtime_ns),
+            'sha256': digest,
+            'archivo_salida': output_filename,
+        }
+        with self._lock:
+            self.entries[filename] = entry
+            if self._writer is None:
+                self._file = open(self.path, 'a', newline='', encoding='utf-8')
+                self._writer = csv.DictWriter(self._file, fieldnames=MANIFEST_FIELDS)
+            self._writer.writerow(entry)
+            self._file.flush()
+
+    def close(self):
+        """Cierra el manifiesto y lo deja compacto (una fila por imagen)."""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+                self._writer = None
+            self._rewrite()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
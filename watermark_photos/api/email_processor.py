@@ -1,8 +1,13 @@
 import os
 import time
+import random
+import ssl
+import select
 import imaplib
 import email
 import smtplib
+import threading
+from collections import deque
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
@@ -12,6 +17,8 @@ import requests
 import logging
 from datetime import datetime
 
+from api_client import output_format_for, post_with_retry
+
 # Configuración de logging
 logging.basicConfig(
     level=logging.INFO,
@@ -22,40 +29,97 @@ logging.basicConfig(
     ]
 )
 
-# Configuración de correo electrónico
-EMAIL_ADDRESS = "tu_correo@gmail.com"  # Reemplaza con tu dirección de correo
-EMAIL_PASSWORD = "tu_contraseña"  # Reemplaza con tu contraseña o contraseña de aplicación
-IMAP_SERVER = "imap.gmail.com"
-SMTP_SERVER = "smtp.gmail.com"
-SMTP_PORT = 587
+# Configuración de correo electrónico (las variables de entorno, si existen,
+# sustituyen a estos valores; por ejemplo, para probar con un servidor local)
+EMAIL_ADDRESS = os.environ.get('EMAIL_ADDRESS', "tu_correo@gmail.com")  # Reemplaza con tu dirección de correo
+EMAIL_PASSWORD = os.environ.get('EMAIL_PASSWORD', "tu_contraseña")  # Reemplaza con tu contraseña o contraseña de aplicación
+IMAP_SERVER = os.environ.get('EMAIL_IMAP_SERVER', "imap.gmail.com")
+IMAP_PORT = int(os.environ.get('EMAIL_IMAP_PORT', 993))
+# IMAP sobre TLS (True) o sin cifrar (False, solo para servidores locales de prueba)
+IMAP_SSL = os.environ.get('EMAIL_IMAP_SSL', '1') != '0'
+SMTP_SERVER = os.environ.get('EMAIL_SMTP_SERVER', "smtp.gmail.com")
+SMTP_PORT = int(os.environ.get('EMAIL_SMTP_PORT', 587))
+# Cifrado de SMTP: 'starttls', 'ssl' (puerto 465) o 'none' (servidores locales de prueba)
+SMTP_SECURITY = os.environ.get('EMAIL_SMTP_SECURITY', 'starttls')
+
+# Cómo se detectan los correos nuevos: 'idle' espera a que el servidor avise
+# (IMAP IDLE) sobre una sesión que se mantiene abierta; 'poll' comprueba el
+# buzón cada POLL_INTERVAL segundos, también sobre la misma sesión. Si el
+# servidor no admite IDLE, se usa 'poll'
+FETCH_MODE = os.environ.get('EMAIL_FETCH_MODE', 'idle')
+POLL_INTERVAL = int(os.environ.get('EMAIL_POLL_INTERVAL', 60))
+if FETCH_MODE not in ('idle', 'poll'):
+    raise ValueError(f"Modo de lectura de correo no válido: {FETCH_MODE}")
+
+# Segundos tras los que se renueva IDLE. El RFC 2177 pide no pasar de 29
+# minutos; renovarlo antes evita que un router cierre la conexión inactiva
+IDLE_TIMEOUT = int(os.environ.get('EMAIL_IDLE_TIMEOUT', 300))
+
+# Espera máxima (en segundos) entre intentos de reconexión a IMAP
+MAX_RECONNECT_WAIT = 300
+
+# Las esperas entre reconexiones vuelven a empezar solo si la sesión anterior
+# llegó a comprobar el buzón o duró al menos estos segundos. Una sesión que se
+# pierde nada más conectar no cuenta como recuperada
+MIN_SESSION_TIME = int(os.environ.get('EMAIL_MIN_SESSION_TIME', 60))
+
+# Conexiones SMTP abiertas que se reutilizan para las respuestas, y segundos
+# sin uso tras los que se comprueban (NOOP) antes de reutilizarlas
+SMTP_POOL_SIZE = int(os.environ.get('EMAIL_SMTP_POOL_SIZE', 2))
+SMTP_MAX_IDLE = int(os.environ.get('EMAIL_SMTP_MAX_IDLE', 60))
 
 # Configuración de la API
 API_URL = "http://localhost:8080/watermark"  # Cambia a la URL de tu API en producción
 
-def check_emails():
+def connect_imap():
+    """Abre una sesión IMAP con el buzón de entrada seleccionado."""
+    if IMAP_SSL:
+        mail = imaplib.IMAP4_SSL(IMAP_SERVER, IMAP_PORT)
+    else:
+        mail = imaplib.IMAP4(IMAP_SERVER, IMAP_PORT)
+    mail.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
+    mail.select('inbox')
+    return mail
+
+def close_imap(mail):
+    """Cierra una sesión IMAP, ignorando los errores si ya estaba rota."""
+    try:
+        mail.close()
+        mail.logout()
+    except (imaplib.IMAP4.error, OSError):
+        pass
+
+def check_emails(mail=None):
     """
     Verifica los correos electrónicos no leídos, procesa las imágenes adjuntas
     y envía las versiones con marca de agua como respuesta.
+
+    Args:
+        mail: Sesión IMAP abierta que se reutiliza. Si no se indica, se abre
+            una sesión solo para esta comprobación
+
+    Returns:
+        bool: True si se pudo buscar en el buzón, aunque fallara algún correo
     """
+    own_session = mail is None
     try:
         # Conectar al servidor IMAP
-        mail = imaplib.IMAP4_SSL(IMAP_SERVER)
-        mail.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
-        mail.select('inbox')
+        if own_session:
+            mail = connect_imap()
         
         # Buscar correos no leídos
         status, messages = mail.search(None, 'UNSEEN')
         
         if status != 'OK':
             logging.error("Error al buscar correos no leídos")
-            return
+            return False
         
         # Obtener IDs de mensajes
         message_ids = messages[0].split()
         
         if not message_ids:
             logging.info("No hay correos nuevos para procesar")
-            return
+            return True
         
         logging.info(f"Encontrados {len(message_ids)} correos nuevos")
         
@@ -117,13 +181,15 @@ def check_emails():
                     # Enviar la imagen a la API
                     with open(temp_path, 'rb') as img_file:
                         files = {'image': (filename, img_file, f'image/{os.path.splitext(filename)[1][1:]}')}
-                        data = {'code': os.path.splitext(filename)[0]}
+                        output_format, output_extension = output_format_for(filename)
+                        data = {'code': os.path.splitext(filename)[0], 'output_format': output_format}
                         
-                        response = requests.post(API_URL, files=files, data=data)
+                        # Si la API está saturada, esperar lo que indique Retry-After
+                        response = post_with_retry(requests, API_URL, files, data)
                         
                         if response.status_code == 200:
                             # Guardar la imagen procesada temporalmente
-                            output_filename = f"{os.path.splitext(filename)[0]}_watermarked{os.path.splitext(filename)[1]}"
+                            output_filename = f"{os.path.splitext(filename)[0]}_watermarked{output_extension}"
                             output_path = os.path.join(tempfile.gettempdir(), output_filename)
                             
                             with open(output_path, 'wb') as f:
@@ -169,11 +235,132 @@ def check_emails():
                     pass
         
         # Cerrar conexión
-        mail.close()
-        mail.logout()
+        if own_session:
+            close_imap(mail)
+        return True
         
+    except (imaplib.IMAP4.abort, OSError):
+        # Conexión perdida: quien mantiene la sesión se vuelve a conectar
+        if not own_session:
+            raise
+        logging.error("Se perdió la conexión con el servidor IMAP")
     except Exception as e:
         logging.error(f"Error al procesar correos: {str(e)}")
+    return False
+
+class SMTPPool:
+    """
+    Conexiones SMTP ya autenticadas que se reutilizan entre correos.
+
+    Abrir una conexión cuesta la conexión TCP, STARTTLS y el login; con el pool
+    solo se paga la primera vez. Las conexiones que llevan más de max_idle
+    segundos sin usarse se comprueban con NOOP antes de reutilizarlas, y si el
+    servidor cerró una conexión durante el envío, se reintenta con otra nueva.
+    """
+
+    def __init__(self, host, port, security='starttls', username=None, password=None,
+                 size=SMTP_POOL_SIZE, max_idle=SMTP_MAX_IDLE):
+        """
+        Args:
+            host: Servidor SMTP
+            port: Puerto del servidor
+            security: 'starttls', 'ssl' o 'none'
+            username: Usuario (None = sin autenticación)
+            password: Contraseña
+            size: Conexiones que se mantienen abiertas como mucho
+            max_idle: Segundos sin uso tras los que se comprueba una conexión
+        """
+        if security not in ('starttls', 'ssl', 'none'):
+            raise ValueError(f"Cifrado SMTP no válido: {security}")
+        self.host = host
+        self.port = port
+        self.security = security
+        self.username = username
+        self.password = password
+        self.size = size
+        self.max_idle = max_idle
+        self._lock = threading.Lock()
+        self._idle = deque()
+
+    def _connect(self):
+        if self.security == 'ssl':
+            server = smtplib.SMTP_SSL(self.host, self.port)
+        else:
+            server = smtplib.SMTP(self.host, self.port)
+            if self.security == 'starttls':
+                server.starttls()
+        if self.username:
+            server.login(self.username, self.password)
+        return server
+
+    def _acquire(self):
+        """Devuelve una conexión abierta (reutilizada si es posible) y si es reutilizada."""
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                server, released = self._idle.pop()
+            if time.monotonic() - released < self.max_idle:
+                return server, True
+            try:
+                if server.noop()[0] == 250:
+                    return server, True
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._discard(server)
+        return self._connect(), False
+
+    def _release(self, server):
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append((server, time.monotonic()))
+                return
+        self._discard(server)
+
+    @staticmethod
+    def _discard(server):
+        try:
+            server.quit()
+        except (smtplib.SMTPException, OSError):
+            server.close()
+
+    def _send(self, server, from_address, to_address, text):
+        """Envía un correo por una conexión y la devuelve al pool, o la cierra si se rompió."""
+        try:
+            server.sendmail(from_address, to_address, text)
+        except smtplib.SMTPServerDisconnected:
+            server.close()
+            raise
+        except smtplib.SMTPException:
+            # El servidor rechazó este correo; la conexión sigue siendo válida.
+            # SMTPException hereda de OSError, así que va antes
+            self._release(server)
+            raise
+        except OSError:
+            server.close()
+            raise
+        self._release(server)
+
+    def sendmail(self, from_address, to_address, text):
+        """Envía un correo, como smtplib.SMTP.sendmail."""
+        server, reused = self._acquire()
+        try:
+            self._send(server, from_address, to_address, text)
+        except smtplib.SMTPServerDisconnected:
+            if not reused:
+                raise
+            # El servidor cerró la conexión reutilizada: reintentar con una nueva
+            self._send(self._connect(), from_address, to_address, text)
+
+    def close(self):
+        """Cierra todas las conexiones abiertas."""
+        with self._lock:
+            idle = list(self._idle)
+            self._idle.clear()
+        for server, _ in idle:
+            self._discard(server)
+
+smtp_pool = SMTPPool(SMTP_SERVER, SMTP_PORT, SMTP_SECURITY, EMAIL_ADDRESS, EMAIL_PASSWORD)
 
 def send_email(to_address, subject, body, attachments):
     """
@@ -207,38 +394,188 @@ def send_email(to_address, subject, body, attachments):
             msg.attach(part)
             attachment.close()
         
-        # Conectar al servidor SMTP
-        server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
-        server.starttls()
-        server.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
-        
-        # Enviar correo
+        # Enviar correo por una conexión SMTP ya abierta (o una nueva)
         text = msg.as_string()
-        server.sendmail(EMAIL_ADDRESS, to_address, text)
-        
-        # Cerrar conexión
-        server.quit()
+        smtp_pool.sendmail(EMAIL_ADDRESS, to_address, text)
         
         return True
     except Exception as e:
         logging.error(f"Error al enviar correo a {to_address}: {str(e)}")
         return False
 
+def is_mail_notice(line):
+    """True si una respuesta no etiquetada avisa de cambios en el buzón ('* 5 EXISTS' o '* 3 RECENT')."""
+    return line.startswith(b'*') and line.rstrip().endswith((b'EXISTS', b'RECENT'))
+
+def take_mail_notices(mail):
+    """
+    Retira los avisos de correo nuevo que imaplib guardó al leer otras respuestas.
+
+    Returns:
+        bool: True si el servidor avisó de cambios en el buzón
+    """
+    notices = [mail.untagged_responses.pop(name, None) for name in ('EXISTS', 'RECENT')]
+    return any(notices)
+
+def has_buffered_data(mail):
+    """
+    True si hay respuestas del servidor que se pueden leer sin esperar.
+
+    imaplib lee el socket a través de un archivo con búfer (y, con TLS, el
+    socket guarda datos ya descifrados), así que una respuesta que llegó junto
+    a la anterior no la ve select(). Se mira el búfer con el socket en modo no
+    bloqueante, sin usar timeouts, que dejarían inservible el archivo.
+    """
+    sock = mail.socket()
+    timeout = sock.gettimeout()
+    sock.setblocking(False)
+    try:
+        return bool(mail.file.peek(1))
+    except (BlockingIOError, ssl.SSLWantReadError):
+        return False
+    finally:
+        sock.settimeout(timeout)
+
+def read_idle_line(mail, event):
+    """Lee una línea durante IDLE, comprobando que la sesión sigue abierta."""
+    line = mail.readline()
+    if not line:
+        raise imaplib.IMAP4.abort(f"El servidor cerró la conexión {event}")
+    if line.startswith(b'* BYE'):
+        raise imaplib.IMAP4.abort(line.decode(errors='replace').strip())
+    return line
+
+def wait_for_new_mail(mail, timeout):
+    """
+    Espera con IMAP IDLE (RFC 2177) a que llegue algún correo al buzón.
+
+    imaplib no implementa IDLE en las versiones de Python que se usan aquí,
+    así que se envía el comando a mano sobre la sesión abierta.
+
+    Args:
+        mail: Sesión IMAP con el buzón seleccionado
+        timeout: Segundos máximos de espera
+
+    Returns:
+        bool: True si el servidor avisó de cambios en el buzón
+    """
+    tag = mail._new_tag()
+    mail.send(tag + b' IDLE\r\n')
+
+    # Antes de aceptar IDLE, el servidor puede enviar avisos pendientes
+    changed = False
+    line = read_idle_line(mail, "al iniciar IDLE")
+    while not line.startswith(b'+'):
+        if line.startswith(tag):
+            raise imaplib.IMAP4.error(f"El servidor rechazó IDLE: {line.decode(errors='replace').strip()}")
+        changed = changed or is_mail_notice(line)
+        line = read_idle_line(mail, "al iniciar IDLE")
+
+    sock = mail.socket()
+    deadline = time.monotonic() + timeout
+    while not changed:
+        # Lo que llegó junto a la respuesta anterior ya está en el búfer
+        if not has_buffered_data(mail):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([sock], [], [], remaining)[0]:
+                break
+        changed = is_mail_notice(read_idle_line(mail, "durante IDLE"))
+
+    # Terminar IDLE y esperar la respuesta al comando
+    mail.send(b'DONE\r\n')
+    while True:
+        line = read_idle_line(mail, "al terminar IDLE")
+        if line.startswith(tag):
+            return changed
+        changed = changed or is_mail_notice(line)
+
+def serve_mailbox(mail, on_check=None):
+    """
+    Procesa los correos nuevos de una sesión abierta hasta que se pierde la conexión.
+
+    Args:
+        mail: Sesión IMAP con el buzón seleccionado
+        on_check: Función opcional a la que se llama tras cada comprobación
+            correcta del buzón
+    """
+    use_idle = FETCH_MODE == 'idle'
+    if use_idle and 'IDLE' not in mail.capabilities:
+        logging.warning("El servidor IMAP no admite IDLE; se comprobará el buzón "
+                        f"cada {POLL_INTERVAL} segundos")
+        use_idle = False
+
+    while True:
+        # Descartar los avisos anteriores: los correos que anuncian se buscan ahora
+        take_mail_notices(mail)
+        if check_emails(mail) and on_check is not None:
+            on_check()
+        if use_idle:
+            if take_mail_notices(mail):
+                # Llegó un correo mientras se procesaban los anteriores
+                logging.info("Nuevo correo recibido")
+                continue
+            # Esperar a que el servidor avise de un correo nuevo
+            if wait_for_new_mail(mail, IDLE_TIMEOUT):
+                logging.info("Nuevo correo recibido")
+        else:
+            logging.info(f"Esperando {POLL_INTERVAL} segundos antes de verificar nuevamente...")
+            time.sleep(POLL_INTERVAL)
+            # NOOP mantiene viva la sesión y actualiza el estado del buzón
+            mail.noop()
+
+def reconnect_wait(attempt):
+    """
+    Segundos de espera antes de reconectar: backoff exponencial hasta
+    MAX_RECONNECT_WAIT, con la mitad de la espera al azar.
+
+    Args:
+        attempt: Número del intento de reconexión (desde 1)
+    """
+    backoff = min(2 ** (attempt - 1), MAX_RECONNECT_WAIT)
+    return backoff / 2 + random.uniform(0, backoff / 2)
+
 def run_email_processor():
     """
     Ejecuta el procesador de correos en un bucle infinito.
+
+    Mantiene una única sesión IMAP abierta y se vuelve a conectar, con esperas
+    crecientes y algo de azar, si la conexión se pierde. Las esperas vuelven a
+    empezar tras una sesión que comprobó el buzón o duró MIN_SESSION_TIME.
     """
-    logging.info("Iniciando procesador de correos electrónicos")
-    
-    while True:
-        try:
-            check_emails()
-        except Exception as e:
-            logging.error(f"Error en el ciclo principal: {str(e)}")
-        
-        # Esperar antes de verificar nuevamente
-        logging.info("Esperando 60 segundos antes de verificar nuevamente...")
-        time.sleep(60)
+    logging.info(f"Iniciando procesador de correos electrónicos (modo {FETCH_MODE})")
+
+    attempt = 0
+    try:
+        while True:
+            mail = None
+            connected_at = None
+            checked = threading.Event()
+            try:
+                mail = connect_imap()
+                connected_at = time.monotonic()
+                logging.info(f"Conectado a {IMAP_SERVER}:{IMAP_PORT}")
+                serve_mailbox(mail, on_check=checked.set)
+            except (imaplib.IMAP4.error, OSError) as e:
+                logging.error(f"Error en la conexión IMAP: {str(e)}")
+            except Exception as e:
+                logging.error(f"Error en el ciclo principal: {str(e)}")
+            finally:
+                if mail is not None:
+                    close_imap(mail)
+
+            # Una sesión que funcionó da la conexión por recuperada; si se
+            # pierde nada más conectar, las esperas siguen creciendo
+            if checked.is_set() or (connected_at is not None
+                                    and time.monotonic() - connected_at >= MIN_SESSION_TIME):
+                attempt = 0
+
+            # Esperar antes de reconectar
+            attempt += 1
+            wait = reconnect_wait(attempt)
+            logging.info(f"Reconectando en {wait:.0f} segundos...")
+            time.sleep(wait)
+    finally:
+        smtp_pool.close()
 
 if __name__ == "__main__":
     run_email_processor()
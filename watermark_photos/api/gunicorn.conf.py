@@ -0,0 +1,22 @@
+import os
+
+# Configuración de gunicorn para la API (gunicorn -c gunicorn.conf.py app:app)
+
+bind = os.environ.get('WATERMARK_BIND', '0.0.0.0:8080')
+
+# Con varios hilos por worker las peticiones que no caben en la cola de
+# procesamiento se rechazan enseguida con 429 en lugar de acumularse sin límite
+# en el socket
+worker_class = 'gthread'
+threads = int(os.environ.get('WATERMARK_HTTP_THREADS', 8))
+timeout = int(os.environ.get('WATERMARK_TIMEOUT', 120))
+
+# Workers de gunicorn. En modo 'process' (WATERMARK_SERVING_MODE) basta con uno:
+# la marca de agua se reparte entre los núcleos en el pool de procesos
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+
+def post_worker_init(worker):
+    """Arranca el pool de procesos de cada worker antes de aceptar peticiones."""
+    from app import render_pool
+    if render_pool is not None:
+        render_pool.start()
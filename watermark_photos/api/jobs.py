@@ -0,0 +1,182 @@
+import os
+import re
+import json
+import time
+import uuid
+import shutil
+import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Formato de los identificadores de trabajo (uuid4 en hexadecimal)
+JOB_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+# Segundos entre limpiezas de trabajos caducados
+CLEANUP_INTERVAL = 60
+
+class LocalBackend:
+    """
+    Cola de trabajos en el propio proceso: se ejecutan en un pool de hilos, sin
+    Redis ni otros servicios externos. Otro backend solo necesita un método
+    submit(fn, *args) que ejecute fn(*args) en segundo plano.
+    """
+
+    def __init__(self, workers=1):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='watermark-job')
+
+    def submit(self, fn, *args):
+        self._executor.submit(fn, *args)
+
+class JobQueue:
+    """
+    Trabajos de marca de agua asíncronos.
+
+    El estado, la imagen de entrada y el resultado de cada trabajo se guardan en
+    archivos dentro de folder, así que cualquier worker de gunicorn puede
+    consultar un trabajo aunque lo haya encolado otro. Los trabajos terminados
+    se borran cuando pasan ttl segundos, y los que no terminan (por ejemplo,
+    porque el worker se reinició) cuando pasan ttl segundos desde su creación.
+    """
+
+    def __init__(self, folder, ttl=3600, max_pending=16, backend=None):
+        """
+        Args:
+            folder: Directorio donde se guardan los trabajos
+            ttl: Segundos que se conservan los trabajos terminados
+            max_pending: Trabajos pendientes máximos en este worker
+            backend: Backend que ejecuta los trabajos (por defecto LocalBackend)
+        """
+        self.folder = folder
+        self.ttl = ttl
+        self.max_pending = max_pending
+        self.backend = backend or LocalBackend()
+
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._last_cleanup = 0
+        os.makedirs(folder, exist_ok=True)
+
+    def _path(self, job_id, kind):
+        return os.path.join(self.folder, f"{job_id}.{kind}")
+
+    def _write_status(self, job):
+        """Guarda el estado de un trabajo de forma atómica."""
+        fd, temp_path = tempfile.mkstemp(dir=self.folder, prefix='.')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(job, f)
+        os.replace(temp_path, self._path(job['id'], 'json'))
+
+    def full(self):
+        """True si este worker ya tiene max_pending trabajos pendientes."""
+        with self._lock:
+            return self._pending >= self.max_pending
+
+    def submit(self, stream, run, **info):
+        """
+        Encola un trabajo.
+
+        Args:
+            stream: Flujo con la imagen de entrada (se copia a disco)
+            run: Función run(input_file, job) que procesa el trabajo y devuelve
+                (bytes del resultado, diccionario con datos para el estado)
+            **info: Datos que se guardan en el estado del trabajo
+
+        Returns:
+            dict: Estado inicial del trabajo
+        """
+        self._maybe_cleanup()
+        job = dict(info, id=uuid.uuid4().hex, status='queued', created=time.time())
+
+        stream.seek(0)
+        with open(self._path(job['id'], 'input'), 'wb') as f:
+            shutil.copyfileobj(stream, f)
+        self._write_status(job)
+
+        with self._lock:
+            self._pending += 1
+        # El trabajo en curso modifica su propia copia del estado
+        self.backend.submit(self._run, dict(job), run)
+        return job
+
+    def _run(self, job, run):
+        """Ejecuta un trabajo y guarda su resultado y su estado."""
+        input_path = self._path(job['id'], 'input')
+        try:
+            job.update(status='running', started=time.time())
+            self._write_status(job)
+
+            with open(input_path, 'rb') as f:
+                data, extra = run(f, job)
+
+            fd, temp_path = tempfile.mkstemp(dir=self.folder, prefix='.')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, self._path(job['id'], 'result'))
+            job.update(extra, status='done', size=len(data))
+        except Exception as e:
+            logging.error(f"Error en el trabajo {job['id']}: {str(e)}")
+            job.update(status='error', error=str(e))
+        finally:
+            with self._lock:
+                self._pending -= 1
+            try:
+                os.remove(input_path)
+            except OSError:
+                pass
+
+        job.update(finished=time.time(), expires=time.time() + self.ttl)
+        self._write_status(job)
+
+    def get(self, job_id):
+        """
+        Devuelve el estado de un trabajo.
+
+        Returns:
+            dict o None si no existe o ya ha caducado
+        """
+        self._maybe_cleanup()
+        if not JOB_ID_PATTERN.match(job_id):
+            return None
+        try:
+            with open(self._path(job_id, 'json')) as f:
+                job = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if self._expired(job, time.time()):
+            return None
+        return job
+
+    def result_path(self, job_id):
+        """Ruta del resultado de un trabajo terminado (None si no está disponible)."""
+        job = self.get(job_id)
+        if job is None or job['status'] != 'done':
+            return None
+        return self._path(job_id, 'result')
+
+    def _expired(self, job, now):
+        return now > job.get('expires', job['created'] + self.ttl)
+
+    def _maybe_cleanup(self):
+        """Borra los trabajos caducados, como mucho una vez cada CLEANUP_INTERVAL."""
+        now = time.time()
+        with self._lock:
+            if now - self._last_cleanup < CLEANUP_INTERVAL:
+                return
+            self._last_cleanup = now
+
+        for name in os.listdir(self.folder):
+            job_id, _, kind = name.partition('.')
+            if kind != 'json':
+                continue
+            try:
+                with open(os.path.join(self.folder, name)) as f:
+                    job = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if self._expired(job, now):
+                for kind in ('result', 'input', 'json'):
+                    try:
+                        os.remove(self._path(job_id, kind))
+                    except OSError:
+                        pass
@@ -0,0 +1,285 @@
+import os
+import json
+import time
+import atexit
+import sqlite3
+import logging
+import threading
+
+# Límites (en segundos) de los intervalos de los histogramas de latencia
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Fila que acumula los contadores e histogramas de los workers terminados
+RETIRED_WORKER = 'retired'
+
+class Metrics:
+    """
+    Métricas de la API (contadores, indicadores e histogramas) en formato Prometheus.
+
+    Cada worker de gunicorn actualiza sus métricas en memoria, sin E/S, y un hilo
+    en segundo plano publica una instantánea por segundo en una tabla SQLite
+    compartida. Al leer /metrics se suman las instantáneas de todos los workers:
+    los contadores e histogramas de workers ya terminados se conservan y los
+    indicadores solo cuentan para los workers que siguen vivos.
+
+    Cada worker, al arrancar, suma las filas de los workers terminados en una
+    sola fila y las borra, así que la tabla no crece aunque gunicorn recicle
+    workers (max_requests).
+    """
+
+    def __init__(self, path, flush_interval=1.0, stale_after=30):
+        """
+        Args:
+            path: Ruta de la base de datos SQLite compartida
+            flush_interval: Segundos entre publicaciones de la instantánea
+            stale_after: Segundos sin publicar tras los que un worker se
+                considera terminado para los indicadores
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.stale_after = stale_after
+
+        # Definición de cada métrica: nombre -> (tipo, ayuda, intervalos)
+        self._definitions = {}
+        # Valores: nombre -> {etiquetas: valor o [recuentos por intervalo, suma, total]}
+        self._values = {}
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._worker_id = None
+        self._conn = None
+        self._conn_pid = None
+
+        atexit.register(self.flush)
+
+    def counter(self, name, help_text):
+        """Define un contador (solo aumenta)."""
+        self._definitions[name] = ('counter', help_text, None)
+        self._values.setdefault(name, {})
+
+    def gauge(self, name, help_text):
+        """Define un indicador (puede subir y bajar)."""
+        self._definitions[name] = ('gauge', help_text, None)
+        self._values.setdefault(name, {})
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        """Define un histograma con los intervalos indicados."""
+        self._definitions[name] = ('histogram', help_text, tuple(buckets))
+        self._values.setdefault(name, {})
+
+    def _ensure_worker(self):
+        """Arranca la publicación periódica en el proceso actual (también tras un fork)."""
+        if self._worker_id is None or not self._worker_id.startswith(f"{os.getpid()}-"):
+            # Lo heredado del proceso padre lo publica el propio padre
+            for values in self._values.values():
+                values.clear()
+            self._worker_id = f"{os.getpid()}-{time.time():.6f}"
+            threading.Thread(target=self._run_flusher, name='metrics-flusher', daemon=True).start()
+
+    def inc(self, name, value=1, **labels):
+        """Suma value a un contador o indicador."""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._ensure_worker()
+            values = self._values[name]
+            values[key] = values.get(key, 0) + value
+
+    def dec(self, name, value=1, **labels):
+        """Resta value a un indicador."""
+        self.inc(name, -value, **labels)
+
+    def observe(self, name, value, **labels):
+        """Registra una observación en un histograma."""
+        buckets = self._definitions[name][2]
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._ensure_worker()
+            values = self._values[name]
+            if key not in values:
+                values[key] = [[0] * len(buckets), 0.0, 0]
+            bucket_counts, _, _ = entry = values[key]
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    bucket_counts[index] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def _connection(self):
+        """Devuelve la conexión SQLite del proceso actual, creándola tras un fork."""
+        if self._conn is None or self._conn_pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS metrics (
+                    worker TEXT PRIMARY KEY,
+                    updated REAL NOT NULL,
+                    data TEXT NOT NULL
+                )''')
+            self._conn = conn
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    def _serialize(self):
+        """Convierte los valores de este worker a JSON."""
+        with self._lock:
+            return serialize_values(self._values)
+
+    def flush(self):
+        """Publica la instantánea de este worker en la base de datos compartida."""
+        if self._worker_id is None or not self._worker_id.startswith(f"{os.getpid()}-"):
+            # Este proceso todavía no ha registrado nada propio
+            return
+        data = self._serialize()
+        with self._db_lock:
+            self._connection().execute(
+                'INSERT OR REPLACE INTO metrics (worker, updated, data) VALUES (?, ?, ?)',
+                (self._worker_id, time.time(), data))
+
+    def _retire_dead_workers(self):
+        """
+        Suma los contadores e histogramas de los workers terminados en la fila
+        RETIRED_WORKER y borra sus filas (sus indicadores ya no cuentan).
+
+        Un worker está terminado si lleva más de stale_after segundos sin
+        publicar y su proceso ya no existe.
+        """
+        now = time.time()
+        with self._db_lock:
+            conn = self._connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = conn.execute('SELECT worker, updated, data FROM metrics').fetchall()
+                dead = [(worker, data) for worker, updated, data in rows
+                        if worker not in (RETIRED_WORKER, self._worker_id)
+                        and now - updated > self.stale_after and not worker_alive(worker)]
+                if dead:
+                    totals = {name: {} for name in self._definitions}
+                    for worker, _, data in rows:
+                        if worker == RETIRED_WORKER:
+                            self._merge(totals, data)
+                    for _, data in dead:
+                        self._merge(totals, data, gauges=False)
+                    conn.execute(
+                        'INSERT OR REPLACE INTO metrics (worker, updated, data) VALUES (?, ?, ?)',
+                        (RETIRED_WORKER, now, serialize_values(totals)))
+                    conn.executemany('DELETE FROM metrics WHERE worker = ?',
+                                     [(worker,) for worker, _ in dead])
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        if dead:
+            logging.info(f"Métricas de {len(dead)} workers terminados acumuladas")
+
+    def _run_flusher(self):
+        try:
+            self._retire_dead_workers()
+        except Exception as e:
+            logging.error(f"Error al acumular las métricas de workers terminados: {str(e)}")
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"Error al publicar las métricas: {str(e)}")
+
+    def collect(self):
+        """
+        Suma las instantáneas de todos los workers.
+
+        Returns:
+            dict: nombre -> {etiquetas: valor agregado}
+        """
+        self.flush()
+        with self._db_lock:
+            rows = self._connection().execute('SELECT updated, data FROM metrics').fetchall()
+        now = time.time()
+
+        totals = {name: {} for name in self._definitions}
+        for updated, data in rows:
+            self._merge(totals, data, gauges=now - updated <= self.stale_after)
+        return totals
+
+    def _merge(self, totals, data, gauges=True):
+        """
+        Suma a totals los valores de una instantánea.
+
+        Args:
+            totals: nombre -> {etiquetas: valor agregado}
+            data: Instantánea de un worker, en JSON
+            gauges: Si se suman también los indicadores
+        """
+        for name, entries in json.loads(data).items():
+            if name not in self._definitions:
+                continue
+            kind = self._definitions[name][0]
+            if kind == 'gauge' and not gauges:
+                continue
+            values = totals[name]
+            for key, value in entries:
+                key = tuple(tuple(pair) for pair in key)
+                if kind == 'histogram':
+                    if key not in values:
+                        values[key] = [[0] * len(value[0]), 0.0, 0]
+                    current = values[key]
+                    current[0] = [a + b for a, b in zip(current[0], value[0])]
+                    current[1] += value[1]
+                    current[2] += value[2]
+                else:
+                    values[key] = values.get(key, 0) + value
+
+    def render(self):
+        """Devuelve todas las métricas en el formato de texto de Prometheus."""
+        lines = []
+        for name, values in self.collect().items():
+            kind, help_text, buckets = self._definitions[name]
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key, value in sorted(values.items()):
+                if kind == 'histogram':
+                    bucket_counts, total_sum, count = value
+                    cumulative = 0
+                    for bound, bucket_count in zip(buckets, bucket_counts):
+                        cumulative += bucket_count
+                        lines.append(f"{name}_bucket{format_labels(key, le=bound)} {cumulative}")
+                    lines.append(f"{name}_bucket{format_labels(key, le='+Inf')} {count}")
+                    lines.append(f"{name}_sum{format_labels(key)} {total_sum}")
+                    lines.append(f"{name}_count{format_labels(key)} {count}")
+                else:
+                    lines.append(f"{name}{format_labels(key)} {value}")
+        return '\n'.join(lines) + '\n'
+
+def serialize_values(values):
+    """Convierte los valores de las métricas (nombre -> {etiquetas: valor}) a JSON."""
+    return json.dumps({
+        name: [[list(key), value] for key, value in entries.items()]
+        for name, entries in values.items()
+    })
+
+def worker_alive(worker_id):
+    """True si el proceso de un worker (identificador 'pid-arranque') sigue en marcha."""
+    try:
+        pid = int(worker_id.split('-')[0])
+    except ValueError:
+        return False
+    if pid == os.getpid():
+        # Un worker anterior con el mismo PID (por ejemplo, antes de reiniciar el contenedor)
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Existe, pero es de otro usuario
+        return True
+    return True
+
+def format_labels(key, **extra):
+    """Formatea las etiquetas de una métrica como {clave="valor",...}."""
+    pairs = list(key) + list(extra.items())
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for _, value in pairs)
+    return '{' + ','.join(f'{label}="{value}"' for (label, _), value in zip(pairs, escaped)) + '}'
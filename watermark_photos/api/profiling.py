@@ -0,0 +1,163 @@
+import os
+import io
+import hmac
+import json
+import time
+import uuid
+import pstats
+import random
+import cProfile
+import logging
+import threading
+
+class RequestProfiler:
+    """
+    Perfiles de cProfile de peticiones concretas, bajo demanda o por muestreo.
+
+    Una petición se perfila si trae la cabecera con el token de perfilado o, al
+    azar, con probabilidad sample_rate. Cada perfil se guarda en el directorio
+    (compartido por los workers de gunicorn) junto a un JSON con los datos de la
+    petición, y solo se conservan los keep más recientes.
+
+    Solo se perfila una petición a la vez por proceso: desde Python 3.12 cProfile
+    no se limita al hilo que lo activa, y dos perfiles a la vez se mezclarían.
+    Con todo desactivado, comprobar si hay que perfilar cuesta una comparación.
+    """
+
+    def __init__(self, directory, token=None, sample_rate=0.0, keep=50):
+        """
+        Args:
+            directory: Directorio donde se guardan los perfiles
+            token: Secreto para pedir un perfil y descargarlos (None = no se
+                pueden pedir ni descargar)
+            sample_rate: Fracción de peticiones que se perfilan al azar
+            keep: Número de perfiles que se conservan
+        """
+        self.directory = directory
+        self.token = token
+        self.sample_rate = sample_rate
+        self.keep = keep
+        self.enabled = bool(token) or sample_rate > 0
+        self._lock = threading.Lock()
+        if self.enabled:
+            os.makedirs(directory, exist_ok=True)
+
+    def authorized(self, token):
+        """True si token coincide con el token de perfilado."""
+        return bool(self.token) and token is not None and hmac.compare_digest(token, self.token)
+
+    def trigger(self, token):
+        """
+        Decide si una petición se perfila.
+
+        Args:
+            token: Valor de la cabecera de perfilado (None si no viene)
+
+        Returns:
+            str: Motivo ('header' o 'sample'), o None si no se perfila
+        """
+        if token is not None and self.authorized(token):
+            return 'header'
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return 'sample'
+        return None
+
+    def start(self):
+        """
+        Empieza a perfilar el hilo actual.
+
+        Returns:
+            cProfile.Profile, o None si ya se está perfilando otra petición
+        """
+        if not self._lock.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Otra herramienta de perfilado ya está activa
+            self._lock.release()
+            return None
+        return profile
+
+    def stop(self, profile, info):
+        """
+        Deja de perfilar y guarda el perfil.
+
+        Args:
+            profile: Perfil devuelto por start
+            info: Diccionario con los datos de la petición que se guardan junto al perfil
+
+        Returns:
+            str: Identificador del perfil
+        """
+        try:
+            profile.disable()
+        finally:
+            self._lock.release()
+
+        profile_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        try:
+            profile.dump_stats(os.path.join(self.directory, f"{profile_id}.prof"))
+            with open(os.path.join(self.directory, f"{profile_id}.json"), 'w') as f:
+                json.dump(dict(info, id=profile_id, created=time.time()), f)
+            self._prune()
+        except OSError as e:
+            logging.error(f"Error al guardar el perfil {profile_id}: {str(e)}")
+            return None
+        logging.info(f"Perfil {profile_id} guardado ({info.get('trigger')})")
+        return profile_id
+
+    def _prune(self):
+        """Borra los perfiles más antiguos si hay más de keep."""
+        ids = [name[:-5] for name in os.listdir(self.directory) if name.endswith('.json')]
+        ids.sort(key=self._modified)
+        for profile_id in ids[:-self.keep] if self.keep > 0 else ids:
+            for extension in ('.prof', '.json'):
+                try:
+                    os.remove(os.path.join(self.directory, profile_id + extension))
+                except FileNotFoundError:
+                    pass
+
+    def _modified(self, profile_id):
+        try:
+            return os.path.getmtime(os.path.join(self.directory, f"{profile_id}.json"))
+        except OSError:
+            return 0
+
+    def profiles(self):
+        """Datos de los perfiles guardados, del más reciente al más antiguo."""
+        result = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    result.append(json.load(f))
+            except (OSError, ValueError):
+                # Otro worker lo está escribiendo o lo acaba de borrar
+                continue
+        result.sort(key=lambda info: info.get('created', 0), reverse=True)
+        return result
+
+    def path(self, profile_id):
+        """
+        Ruta del archivo de un perfil.
+
+        Returns:
+            str: Ruta del .prof, o None si el perfil no existe
+        """
+        if not profile_id.replace('-', '').isalnum():
+            return None
+        path = os.path.join(self.directory, f"{profile_id}.prof")
+        return path if os.path.exists(path) else None
+
+    def summary(self, profile_id, sort='cumulative', limit=40):
+        """Resumen en texto de un perfil (como pstats), o None si no existe."""
+        path = self.path(profile_id)
+        if path is None:
+            return None
+        output = io.StringIO()
+        stats = pstats.Stats(path, stream=output)
+        stats.sort_stats(sort).print_stats(limit)
+        return output.getvalue()
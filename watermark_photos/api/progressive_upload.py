@@ -0,0 +1,292 @@
+import io
+import time
+import logging
+import tempfile
+
+from PIL import Image
+from werkzeug.datastructures import MultiDict
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+
+# Tamaño de los bloques que se leen de la petición
+RECEIVE_CHUNK_SIZE = 64 * 1024
+
+# Bytes de una subida que se guardan en memoria antes de pasar a disco
+UPLOAD_SPOOL_BYTES = 512 * 1024
+
+# Bytes máximos que se acumulan esperando a que la cabecera de la imagen esté
+# completa. Si no basta, la imagen se decodifica al final, como antes
+MAX_HEADER_BYTES = 1024 * 1024
+
+# Bytes del principio de la imagen con los que se decide si se decodifica
+# mientras llega (ver ProgressiveDecoder)
+PROBE_BYTES = 64 * 1024
+
+class ProgressiveDecoder:
+    """
+    Decodifica una imagen a medida que llegan sus bytes.
+
+    Funciona como ImageFile.Parser de Pillow, pero llama a prepare(img) en cuanto
+    conoce la cabecera, antes de decodificar nada, para poder rechazar la imagen
+    o reducirla con draft. Solo decodifica de forma incremental los formatos que
+    Pillow admite así (JPEG, BMP...); con el resto, o si algo falla, se rinde y
+    la imagen se decodifica al final desde la subida completa.
+
+    Con defer, los primeros PROBE_BYTES se retienen hasta decidir si merece la
+    pena decodificar (por ejemplo, si el resultado probablemente ya está en
+    caché, no).
+    """
+
+    def __init__(self, prepare=None, defer=None):
+        """
+        Args:
+            prepare: Función prepare(img) que se llama con la imagen abierta y
+                sin decodificar. Si devuelve False, no se decodifica aquí
+            defer: Función defer(head) que se llama con los primeros PROBE_BYTES
+                de la imagen (o con toda, si es más pequeña). Si devuelve True,
+                no se decodifica aquí
+        """
+        self.prepare = prepare
+        self.defer = defer
+        self.image = None
+        self.active = True
+
+        self._probe = bytearray() if defer else None
+
+        self._header = bytearray()
+        self._pending = b''
+        self._decoder = None
+        self._offset = 0
+        self._finished = False
+
+    def _give_up(self):
+        self.active = False
+        self.image = None
+        self._decoder = None
+        self._pending = b''
+        self._probe = None
+
+    def feed(self, data):
+        """Añade bytes de la imagen y decodifica todo lo que se pueda."""
+        if not self.active or self._finished:
+            return
+        if self._probe is not None:
+            self._probe += data
+            if len(self._probe) < PROBE_BYTES:
+                return
+            data = self._end_probe()
+            if data is None:
+                return
+        if self._decoder is None:
+            self._header += data
+            if not self._open():
+                return
+            data = bytes(self._header)
+            self._header = None
+        self._decode(data)
+
+    def _end_probe(self):
+        """
+        Decide con el principio de la imagen si se decodifica.
+
+        Returns:
+            bytes: Los bytes retenidos hasta ahora, o None si no se decodifica
+        """
+        data = bytes(self._probe)
+        self._probe = None
+        if self.defer(data[:PROBE_BYTES]):
+            self._give_up()
+            return None
+        return data
+
+    def _open(self):
+        """Intenta abrir la imagen con los bytes recibidos. Devuelve True si empieza a decodificarla."""
+        try:
+            img = Image.open(io.BytesIO(bytes(self._header)))
+        except Exception:
+            # Cabecera todavía incompleta (o no es una imagen)
+            if len(self._header) > MAX_HEADER_BYTES:
+                self._give_up()
+            return False
+
+        # Como en ImageFile.Parser, solo se decodifican por partes los formatos
+        # con una única tesela y sin lectura propia. El load_read de JPEG solo
+        # completa archivos truncados, así que JPEG también se admite (Parser
+        # lo excluye y acumula la imagen entera)
+        incremental = (len(img.tile) == 1 and not hasattr(img, 'load_seek')
+                       and (img.format == 'JPEG' or not hasattr(img, 'load_read')))
+        if not incremental or (self.prepare and self.prepare(img) is False):
+            self._give_up()
+            return False
+
+        try:
+            img.load_prepare()
+            decoder_name, extents, offset, args = img.tile[0]
+            img.tile = []
+            self._decoder = Image._getdecoder(img.mode, decoder_name, args, img.decoderconfig)
+            self._decoder.setimage(img.im, extents)
+        except Exception as e:
+            logging.info(f"No se puede decodificar la imagen por partes: {str(e)}")
+            self._give_up()
+            return False
+        self._offset = offset
+        self.image = img
+        return True
+
+    def _decode(self, data):
+        data = self._pending + data
+        if self._offset:
+            # Saltar lo que queda de cabecera hasta los datos de la imagen
+            skip = min(len(data), self._offset)
+            data = data[skip:]
+            self._offset -= skip
+            if self._offset or not data:
+                self._pending = b''
+                return
+
+        consumed, error = self._decoder.decode(data)
+        if consumed < 0:
+            self._finished = True
+            self._pending = b''
+            if error < 0:
+                logging.info(f"Error al decodificar la imagen por partes ({error})")
+                self._give_up()
+            return
+        self._pending = data[consumed:]
+
+    def close(self):
+        """
+        Termina de decodificar.
+
+        Returns:
+            Imagen PIL decodificada, o None si hay que decodificarla desde la
+            subida completa
+        """
+        if self.active and self._probe:
+            # Imagen más pequeña que PROBE_BYTES
+            data = self._end_probe()
+            if data is not None:
+                self.feed(data)
+        if self.active and self._decoder is not None and not self._finished:
+            self._decode(b'')
+            if not self._finished:
+                # La imagen estaba incompleta
+                self._give_up()
+        image = self.image if self.active and self._finished else None
+        self._give_up()
+        return image
+
+class Upload:
+    """Imagen recibida en una petición, ya decodificada si ha sido posible."""
+
+    def __init__(self):
+        # Campos del formulario (o de la URL, si el cuerpo es la imagen)
+        self.fields = MultiDict()
+        # Nombre del archivo ('' si el campo de la imagen llegó vacío)
+        self.filename = None
+        # Bytes de la imagen, al principio del archivo
+        self.stream = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES)
+        # Imagen decodificada mientras llegaba (None si no se pudo)
+        self.image = None
+        # Tamaño original de la imagen decodificada (ver prepare_decode)
+        self.original_size = None
+        # Campos recibidos cuando se empezó a decodificar la imagen (en un
+        # formulario pueden llegar más campos después de la imagen)
+        self.prepared_fields = None
+        # Segundos de decodificación tras recibir el último byte
+        self.decode_time = 0.0
+
+    def close(self):
+        self.stream.close()
+
+def receive_upload(stream, content_type, fields=None, field_name='image', prepare=None,
+                   defer=None, chunk_size=RECEIVE_CHUNK_SIZE):
+    """
+    Lee una subida por bloques y decodifica la imagen mientras llega.
+
+    Acepta un formulario multipart (la imagen en el campo field_name) o un
+    cuerpo image/* con la imagen tal cual.
+
+    Args:
+        stream: Flujo con el cuerpo de la petición
+        content_type: Cabecera Content-Type de la petición
+        fields: Campos iniciales (por ejemplo, los de la URL)
+        field_name: Campo del formulario con la imagen
+        prepare: Función prepare(img, fields) que se llama con la imagen abierta,
+            antes de decodificarla, y los campos recibidos hasta ese momento. Si
+            devuelve False, la imagen no se decodifica mientras llega. Puede
+            devolver el tamaño original (ver prepare_decode)
+        defer: Función defer(head) que decide con el principio de la imagen si
+            no se decodifica mientras llega (ver ProgressiveDecoder)
+
+    Returns:
+        Upload: La subida (upload.filename es None si no llegó ninguna imagen)
+
+    Raises:
+        ValueError: Si el formulario está mal formado
+    """
+    upload = Upload()
+    if fields:
+        upload.fields.update(fields)
+
+    def prepare_image(img):
+        result = prepare(img, upload.fields) if prepare else None
+        if result is False:
+            return False
+        upload.prepared_fields = upload.fields.copy()
+        upload.original_size = result if isinstance(result, tuple) else img.size
+        return True
+
+    mimetype, options = parse_options_header(content_type or '')
+    decoder = ProgressiveDecoder(prepare_image, defer)
+    if mimetype.startswith('image/'):
+        upload.filename = upload.fields.get('filename', 'imagen')
+        for chunk in iter(lambda: stream.read(chunk_size), b''):
+            upload.stream.write(chunk)
+            decoder.feed(chunk)
+    elif mimetype == 'multipart/form-data' and options.get('boundary'):
+        _receive_multipart(stream, options['boundary'].encode('latin-1'), upload, decoder,
+                           field_name, chunk_size)
+    else:
+        # Ni imagen ni formulario: no hay nada que leer
+        return upload
+
+    start = time.perf_counter()
+    upload.image = decoder.close()
+    upload.decode_time = time.perf_counter() - start
+    upload.stream.seek(0)
+    return upload
+
+def _receive_multipart(stream, boundary, upload, decoder, field_name, chunk_size):
+    """Lee un formulario multipart, guardando los campos y pasando la imagen al decodificador."""
+    parser = MultipartDecoder(boundary)
+    field = None
+    target = False
+    while True:
+        # Un bloque vacío indica al parser que la petición ha terminado
+        chunk = stream.read(chunk_size)
+        parser.receive_data(chunk or None)
+
+        event = parser.next_event()
+        while not isinstance(event, (Epilogue, NeedData)):
+            if isinstance(event, File):
+                # Solo se procesa el primer archivo del campo de la imagen
+                target = event.name == field_name and upload.filename is None
+                if target:
+                    upload.filename = event.filename or ''
+            elif isinstance(event, Field):
+                field = (event.name, bytearray())
+                target = False
+            elif isinstance(event, Data):
+                if target:
+                    upload.stream.write(event.data)
+                    decoder.feed(event.data)
+                elif field is not None:
+                    field[1].extend(event.data)
+                    if not event.more_data:
+                        upload.fields.add(field[0], field[1].decode('utf-8', 'replace'))
+                        field = None
+            event = parser.next_event()
+
+        if isinstance(event, Epilogue) or not chunk:
+            return
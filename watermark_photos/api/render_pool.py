@@ -0,0 +1,138 @@
+import io
+import os
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+from PIL import Image
+
+from watermark_engine import apply_watermark, decode_image, frame_bytes
+
+def map_shared(shm, mode, size):
+    """Crea el almacenamiento (ImagingCore) de una imagen sobre un bloque de memoria compartida."""
+    return Image.core.map_buffer(shm.buf, size, 'raw', 0, (mode, 0, 1))
+
+def _render_shared(name, size, file_code, scale, options):
+    """
+    Aplica la marca de agua a una imagen RGB que está en memoria compartida.
+
+    Se ejecuta en un proceso del pool: mapea el bloque sin copiarlo, mezcla la
+    marca de agua en su lugar y devuelve solo la imagen ya codificada.
+
+    Returns:
+        tuple: (bytes de la imagen, formato usado, tiempos de cada etapa)
+    """
+    # Al conectarse al bloque, el proceso lo registra en el resource_tracker
+    # compartido con el proceso que lo creó, que es quien lo libera
+    shm = shared_memory.SharedMemory(name=name)
+    img = Image.new('RGB', (0, 0))._new(map_shared(shm, 'RGB', size))
+    try:
+        output = io.BytesIO()
+        timings = {}
+        used_format = apply_watermark(img, output, file_code, scale=scale, threads=1,
+                                      timings=timings, **options)
+        return output.getvalue(), used_format, timings
+    finally:
+        img.close()
+        shm.close()
+
+class RenderPool:
+    """
+    Pool de procesos que aplican la marca de agua a imágenes ya decodificadas.
+
+    El hilo de la petición decodifica la imagen directamente sobre un bloque de
+    memoria compartida (o la copia ahí una vez si hay que convertirla o
+    reducirla) y el proceso del pool lo mapea sin copiarlo. Por la tubería del
+    pool solo viajan el nombre del bloque, el tamaño y las opciones, y de vuelta
+    la imagen ya codificada, así que la marca de agua y la codificación se
+    reparten entre núcleos sin el GIL y sin serializar píxeles.
+    """
+
+    def __init__(self, processes):
+        """
+        Args:
+            processes: Número de procesos del pool
+        """
+        self.processes = processes
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    def _get_executor(self):
+        """Devuelve el pool del proceso actual, creándolo si hace falta (también tras un fork)."""
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                # 'spawn' evita heredar los hilos y los locks del worker de gunicorn
+                context = multiprocessing.get_context('spawn')
+                self._executor = ProcessPoolExecutor(max_workers=self.processes,
+                                                     mp_context=context)
+                self._pid = os.getpid()
+            return self._executor
+
+    def start(self):
+        """Arranca los procesos del pool para que la primera petición no espere por ellos."""
+        executor = self._get_executor()
+        for future in [executor.submit(os.getpid) for _ in range(self.processes)]:
+            future.result()
+
+    def render(self, input_image, output, file_code, max_dimension=None, timings=None,
+               original_size=None, **options):
+        """
+        Aplica la marca de agua a una imagen usando el pool.
+
+        Args:
+            input_image: Imagen PIL, idealmente sin decodificar (se cierra al
+                terminar)
+            output: Archivo donde se escribe la imagen codificada
+            file_code: Código único para incluir en la marca de agua
+            max_dimension: Lado mayor máximo de la imagen de salida
+            timings: Diccionario opcional en el que se guardan los segundos de
+                cada etapa, como en create_watermark
+            original_size: Tamaño original si la imagen ya se ha decodificado
+                mientras llegaba (ver prepare_decode)
+            **options: Opciones de salida y del codificador de create_watermark
+
+        Returns:
+            str: Formato de salida usado ('jpeg', 'webp' o 'png')
+        """
+        if timings is None:
+            timings = {}
+        blocks = []
+
+        def allocate(mode, size):
+            shm = shared_memory.SharedMemory(create=True, size=frame_bytes(mode, size))
+            blocks.append(shm)
+            return map_shared(shm, mode, size)
+
+        img = None
+        try:
+            img, _, scale = decode_image(input_image, max_dimension=max_dimension,
+                                         timings=timings, allocate=allocate,
+                                         original_size=original_size)
+            future = self._get_executor().submit(_render_shared, blocks[-1].name, img.size,
+                                                 file_code, scale, options)
+            try:
+                data, used_format, worker_timings = future.result()
+            except BrokenProcessPool:
+                # Un proceso murió (por ejemplo, por falta de memoria): el
+                # siguiente intento crea un pool nuevo
+                with self._lock:
+                    self._executor = None
+                raise
+            timings.update(worker_timings)
+            output.write(data)
+            return used_format
+        finally:
+            # Soltar las imágenes que apuntan a los bloques antes de liberarlos
+            input_image.close()
+            if img is not None:
+                img.close()
+            for shm in blocks:
+                try:
+                    shm.close()
+                except BufferError:
+                    logging.warning(f"Bloque de memoria compartida {shm.name} todavía en uso")
+                shm.unlink()
@@ -0,0 +1,207 @@
+import os
+import json
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+
+# Tamaño de los bloques con los que se calcula el hash de una subida
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Principios de imagen que se recuerdan (ver ResultCache.has_source)
+SOURCE_INDEX_SIZE = 4096
+
+def content_key(stream, file_code, params):
+    """
+    Calcula la clave de un resultado a partir de la imagen de entrada, el código
+    y los parámetros de renderizado.
+
+    Args:
+        stream: Flujo con los bytes de la imagen (se vuelve a dejar al principio)
+        file_code: Código de la marca de agua
+        params: Diccionario con los parámetros que determinan el resultado
+
+    Returns:
+        str: Hash SHA-256 en hexadecimal
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps({'code': file_code, 'params': params}, sort_keys=True).encode('utf-8'))
+    digest.update(b'\0')
+    stream.seek(0)
+    for chunk in iter(lambda: stream.read(HASH_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+class ResultCache:
+    """
+    Caché de imágenes ya procesadas, indexada por contenido.
+
+    Tiene un nivel en memoria y, opcionalmente, otro en disco, cada uno con un
+    tamaño máximo en bytes: al superarlo se descartan los resultados usados
+    hace más tiempo. El nivel en disco se comparte entre los workers de
+    gunicorn (cada resultado es un archivo con la clave como nombre) y los
+    resultados que se leen de él se suben al nivel en memoria.
+    """
+
+    def __init__(self, memory_bytes, disk_dir=None, disk_bytes=0):
+        """
+        Args:
+            memory_bytes: Tamaño máximo del nivel en memoria (0 = desactivado)
+            disk_dir: Directorio del nivel en disco (None = desactivado)
+            disk_bytes: Tamaño máximo del nivel en disco
+        """
+        self.memory_bytes = memory_bytes
+        self.disk_dir = disk_dir if disk_bytes > 0 else None
+        self.disk_bytes = disk_bytes
+
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._disk = OrderedDict()
+        self._disk_size = 0
+        self._sources = OrderedDict()
+
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._scan_disk()
+
+    @property
+    def enabled(self):
+        """True si al menos uno de los dos niveles está activo."""
+        return self.memory_bytes > 0 or self.disk_dir is not None
+
+    def _scan_disk(self):
+        """Carga el índice del nivel en disco, del resultado más antiguo al más reciente."""
+        entries = []
+        for name in os.listdir(self.disk_dir):
+            path = os.path.join(self.disk_dir, name)
+            if name.startswith('.'):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._disk[name] = size
+            self._disk_size += size
+        self._evict_disk()
+
+    def get(self, key):
+        """
+        Devuelve el resultado guardado para una clave.
+
+        Returns:
+            bytes o None si no está en ningún nivel
+        """
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                return data
+
+        data = self._read_disk(key)
+        if data is not None:
+            self._put_memory(key, data)
+        return data
+
+    def put(self, key, data):
+        """Guarda un resultado en los dos niveles (si cabe en cada uno)."""
+        self._put_memory(key, data)
+        self._write_disk(key, data)
+
+    def remember_source(self, head):
+        """Anota que se ha guardado o servido un resultado de una imagen que empieza por head."""
+        source = hashlib.sha256(head).digest()
+        with self._lock:
+            self._sources[source] = True
+            self._sources.move_to_end(source)
+            if len(self._sources) > SOURCE_INDEX_SIZE:
+                self._sources.popitem(last=False)
+
+    def has_source(self, head):
+        """
+        True si hace poco se guardó o sirvió un resultado de una imagen que
+        empieza por head.
+
+        Es solo una pista, propia de cada worker, para no decodificar mientras
+        llega una imagen que probablemente está en caché; la clave completa se
+        comprueba después con get.
+        """
+        source = hashlib.sha256(head).digest()
+        with self._lock:
+            return source in self._sources
+
+    def _put_memory(self, key, data):
+        if len(data) > self.memory_bytes:
+            return
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return
+            self._memory[key] = data
+            self._memory_size += len(data)
+            while self._memory_size > self.memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_size -= len(evicted)
+
+    def _read_disk(self, key):
+        if not self.disk_dir:
+            return None
+        path = os.path.join(self.disk_dir, key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # Marcar el archivo como usado para que otros workers lo conserven
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self._forget_disk(key)
+            return None
+
+        with self._lock:
+            if key not in self._disk:
+                self._disk_size += len(data)
+            self._disk[key] = len(data)
+            self._disk.move_to_end(key)
+        return data
+
+    def _write_disk(self, key, data):
+        if not self.disk_dir or len(data) > self.disk_bytes:
+            return
+        with self._lock:
+            if key in self._disk:
+                return
+        try:
+            # Escribir en un archivo temporal y renombrarlo para que otro worker
+            # nunca lea un resultado a medias
+            fd, temp_path = tempfile.mkstemp(dir=self.disk_dir, prefix='.')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, os.path.join(self.disk_dir, key))
+        except OSError as e:
+            logging.error(f"No se pudo guardar el resultado en la caché de disco: {str(e)}")
+            return
+
+        with self._lock:
+            if key not in self._disk:
+                self._disk[key] = len(data)
+                self._disk_size += len(data)
+            self._evict_disk()
+
+    def _forget_disk(self, key):
+        size = self._disk.pop(key, None)
+        if size is not None:
+            self._disk_size -= size
+
+    def _evict_disk(self):
+        """Borra los resultados usados hace más tiempo hasta respetar el tamaño máximo."""
+        while self._disk_size > self.disk_bytes and self._disk:
+            key, size = self._disk.popitem(last=False)
+            self._disk_size -= size
+            try:
+                os.remove(os.path.join(self.disk_dir, key))
+            except OSError:
+                pass
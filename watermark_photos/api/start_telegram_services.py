@@ -18,6 +18,9 @@ logging.basicConfig(
 def start_services():
     """
     Inicia la API y el bot de Telegram como procesos separados.
+
+    Con TELEGRAM_WATERMARK_MODE=engine el bot aplica la marca de agua con el
+    motor en su propio pool de procesos, así que solo se inicia el bot.
     """
     try:
         # Obtener la ruta del directorio actual
@@ -37,13 +40,17 @@ def start_services():
         # Comando para iniciar el bot de Telegram
         telegram_cmd = [sys.executable, os.path.join(current_dir, 'telegram_bot.py')]
 
-        # Iniciar la API
-        logging.info("Iniciando la API...")
-        api_process = subprocess.Popen(api_cmd)
+        api_process = None
+        if os.environ.get('TELEGRAM_WATERMARK_MODE') == 'engine':
+            logging.info("El bot usará el motor directamente; no se inicia la API")
+        else:
+            # Iniciar la API
+            logging.info("Iniciando la API...")
+            api_process = subprocess.Popen(api_cmd)
 
-        # Esperar a que la API esté lista
-        logging.info("Esperando a que la API esté lista...")
-        time.sleep(5)
+            # Esperar a que la API esté lista
+            logging.info("Esperando a que la API esté lista...")
+            time.sleep(5)
 
         # Iniciar el bot de Telegram
         logging.info("Iniciando el bot de Telegram...")
@@ -54,7 +61,8 @@ def start_services():
         # Manejar la terminación de los procesos
         def signal_handler(sig, frame):
             logging.info("Deteniendo servicios...")
-            api_process.terminate()
+            if api_process:
+                api_process.terminate()
             telegram_process.terminate()
             sys.exit(0)
 
@@ -65,7 +73,7 @@ def start_services():
         # Mantener el script en ejecución
         while True:
             # Verificar si alguno de los procesos ha terminado
-            if api_process.poll() is not None:
+            if api_process and api_process.poll() is not None:
                 logging.error("La API se ha detenido inesperadamente. Reiniciando...")
                 api_process = subprocess.Popen(api_cmd)
 
@@ -77,14 +85,14 @@ def start_services():
 
     except KeyboardInterrupt:
         logging.info("Deteniendo servicios...")
-        if 'api_process' in locals():
+        if locals().get('api_process'):
             api_process.terminate()
         if 'telegram_process' in locals():
             telegram_process.terminate()
 
     except Exception as e:
         logging.error(f"Error al iniciar servicios: {str(e)}")
-        if 'api_process' in locals():
+        if locals().get('api_process'):
             api_process.terminate()
         if 'telegram_process' in locals():
             telegram_process.terminate()
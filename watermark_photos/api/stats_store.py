@@ -0,0 +1,212 @@
+import os
+import json
+import time
+import atexit
+import sqlite3
+import logging
+import datetime
+import threading
+
+class StatsStore:
+    """
+    Estadísticas de uso compartidas entre los workers de gunicorn.
+
+    Cada worker acumula en memoria las imágenes procesadas y las vuelca por lotes
+    a una base de datos SQLite en modo WAL, en la que cada volcado es una única
+    transacción. Así no hay actualizaciones perdidas entre workers y las
+    peticiones no hacen E/S de disco síncrona. Las lecturas agregan lo volcado
+    por todos los workers.
+    """
+
+    def __init__(self, path, flush_interval=1.0, flush_size=100, history_size=10,
+                 retention=10000, legacy_file=None):
+        """
+        Args:
+            path: Ruta de la base de datos SQLite
+            flush_interval: Segundos máximos que un evento espera en memoria
+            flush_size: Eventos pendientes a partir de los cuales se vuelca ya
+            history_size: Número de imágenes recientes que se muestran
+            retention: Número de eventos que se conservan en el registro
+            legacy_file: stats.json antiguo del que importar los datos la
+                primera vez que se crea la base de datos
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.history_size = history_size
+        self.retention = retention
+        self.legacy_file = legacy_file
+
+        # _lock protege los eventos pendientes; _db_lock, el uso de la conexión
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._pending = []
+        self._flusher_pid = None
+        self._conn = None
+        self._conn_pid = None
+        self._wakeup = threading.Event()
+
+        # Volcar lo pendiente al terminar el proceso
+        atexit.register(self.close)
+
+    def _connection(self):
+        """Devuelve la conexión del proceso actual, creándola tras un fork."""
+        if self._conn is None or self._conn_pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS events (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    created REAL NOT NULL,
+                    timestamp TEXT NOT NULL,
+                    filename TEXT,
+                    code TEXT
+                )''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS totals (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    total_images INTEGER NOT NULL,
+                    last_processed TEXT
+                )''')
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if conn.execute('SELECT 1 FROM totals').fetchone() is None:
+                    self._import_legacy(conn)
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+
+            self._conn = conn
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    def _import_legacy(self, conn):
+        """Inicializa los totales, importando el stats.json antiguo si existe."""
+        stats = {'total_images': 0, 'last_processed': None, 'processing_history': []}
+        if self.legacy_file and os.path.exists(self.legacy_file):
+            try:
+                with open(self.legacy_file, 'r') as f:
+                    stats.update(json.load(f))
+                logging.info(f"Estadísticas importadas de {self.legacy_file}")
+            except Exception as e:
+                logging.error(f"No se pudieron importar las estadísticas antiguas: {str(e)}")
+
+        conn.execute('INSERT INTO totals (id, total_images, last_processed) VALUES (1, ?, ?)',
+                     (stats['total_images'], stats['last_processed']))
+        for item in stats['processing_history']:
+            created = datetime.datetime.strptime(item['timestamp'], '%Y-%m-%d %H:%M:%S').timestamp()
+            conn.execute('INSERT INTO events (created, timestamp, filename, code) VALUES (?, ?, ?, ?)',
+                         (created, item['timestamp'], item['filename'], item['code']))
+
+    def _start_flusher(self):
+        """Arranca el hilo que vuelca periódicamente los eventos pendientes."""
+        def run():
+            while True:
+                self._wakeup.wait(self.flush_interval)
+                self._wakeup.clear()
+                try:
+                    self.flush()
+                except Exception as e:
+                    logging.error(f"Error al volcar las estadísticas: {str(e)}")
+
+        threading.Thread(target=run, name='stats-flusher', daemon=True).start()
+
+    def record(self, filename, code):
+        """Registra una imagen procesada. No hace E/S: el evento se vuelca por lotes."""
+        now = time.time()
+        timestamp = datetime.datetime.fromtimestamp(now).strftime('%Y-%m-%d %H:%M:%S')
+        with self._lock:
+            if self._flusher_pid != os.getpid():
+                # Primer evento de este proceso (o de un worker recién creado con
+                # fork): lo heredado del proceso padre ya lo vuelca el padre
+                self._pending = []
+                self._flusher_pid = os.getpid()
+                self._start_flusher()
+            self._pending.append((now, timestamp, filename, code))
+            if len(self._pending) >= self.flush_size:
+                self._wakeup.set()
+
+    def flush(self):
+        """Vuelca a la base de datos los eventos pendientes de este worker."""
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return
+
+        with self._db_lock:
+            self._write(pending)
+
+    def _write(self, pending):
+        """Escribe un lote de eventos y actualiza los totales en una transacción."""
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany('INSERT INTO events (created, timestamp, filename, code) VALUES (?, ?, ?, ?)',
+                             pending)
+            conn.execute('''
+                UPDATE totals SET total_images = total_images + ?,
+                                  last_processed = max(coalesce(last_processed, ''), ?)
+                WHERE id = 1''', (len(pending), pending[-1][1]))
+            # Conservar solo los últimos eventos para que el registro no crezca sin límite
+            conn.execute('DELETE FROM events WHERE id <= (SELECT max(id) FROM events) - ?',
+                         (self.retention,))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            with self._lock:
+                self._pending = pending + self._pending
+            raise
+
+    def snapshot(self):
+        """
+        Devuelve las estadísticas agregadas de todos los workers.
+
+        Returns:
+            dict: 'total_images', 'last_processed' y 'processing_history' (las
+                imágenes más recientes, de la más antigua a la más nueva)
+        """
+        self.flush()
+        with self._db_lock:
+            conn = self._connection()
+            total_images, last_processed = conn.execute(
+                'SELECT total_images, last_processed FROM totals WHERE id = 1').fetchone()
+            rows = conn.execute(
+                'SELECT timestamp, filename, code FROM events ORDER BY id DESC LIMIT ?',
+                (self.history_size,)).fetchall()
+
+        return {
+            'total_images': total_images,
+            'last_processed': last_processed,
+            'processing_history': [
+                {'filename': filename, 'code': code, 'timestamp': timestamp}
+                for timestamp, filename, code in reversed(rows)
+            ]
+        }
+
+    def events(self, since=None):
+        """
+        Devuelve los eventos conservados en el registro, del más antiguo al más nuevo.
+
+        Args:
+            since: Marca de tiempo (epoch) a partir de la cual devolver eventos
+
+        Returns:
+            list: Diccionarios con 'created', 'timestamp', 'filename' y 'code'
+        """
+        self.flush()
+        with self._db_lock:
+            rows = self._connection().execute(
+                'SELECT created, timestamp, filename, code FROM events WHERE created >= ? ORDER BY id',
+                (since or 0,)).fetchall()
+        return [
+            {'created': created, 'timestamp': timestamp, 'filename': filename, 'code': code}
+            for created, timestamp, filename, code in rows
+        ]
+
+    def close(self):
+        """Vuelca los eventos pendientes antes de terminar el proceso."""
+        if self._pending:
+            self.flush()
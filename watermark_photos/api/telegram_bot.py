@@ -1,11 +1,23 @@
+import io
 import os
+import asyncio
 import logging
-import tempfile
-import requests
+import mimetypes
+import httpx
 import sys
-from telegram import Update, Bot
+import warnings
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from PIL import Image, UnidentifiedImageError
+from telegram import InputMediaPhoto, Update
+from telegram.error import BadRequest
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 
+from api_client import retry_wait, should_retry
+from watermark_engine import MEMORY_BUDGET_MB, log_font_path, watermark_bytes
+
 # Configuración de logging
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -23,9 +35,63 @@ except ImportError:
     logger.error("Ejemplo: cp config.example.py config.py y edita el archivo con tu token")
     sys.exit(1)
 
-# Directorio temporal para archivos
-TEMP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'temp')
-os.makedirs(TEMP_DIR, exist_ok=True)
+# Actualizaciones (mensajes) que se atienden a la vez. Mientras una imagen se
+# descarga o se procesa, el bot sigue atendiendo al resto de usuarios
+CONCURRENT_UPDATES = int(os.environ.get('TELEGRAM_CONCURRENT_UPDATES', 8))
+
+# Segundos máximos de espera por la respuesta de la API
+API_TIMEOUT = float(os.environ.get('TELEGRAM_API_TIMEOUT', 120))
+
+# Cómo se aplica la marca de agua: 'api' envía las imágenes a API_URL; 'engine'
+# usa el motor directamente en un pool de ENGINE_WORKERS procesos, sin pasar
+# por HTTP (para cuando el bot corre en la misma máquina que la API)
+WATERMARK_MODE = os.environ.get('TELEGRAM_WATERMARK_MODE', 'api')
+ENGINE_WORKERS = int(os.environ.get('TELEGRAM_ENGINE_WORKERS', os.cpu_count() or 1))
+if WATERMARK_MODE not in ('api', 'engine'):
+    raise ValueError(f"Modo de marca de agua no válido: {WATERMARK_MODE}")
+
+# Mismo límite de píxeles que la API (WATERMARK_MAX_PIXELS). En modo 'engine'
+# se comprueba con la cabecera de la imagen antes de enviarla al pool
+MAX_IMAGE_PIXELS = int(os.environ.get('WATERMARK_MAX_PIXELS', 100_000_000))
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+warnings.simplefilter('ignore', Image.DecompressionBombWarning)
+
+# Presupuesto de memoria de cada imagen en el pool del motor, repartido entre
+# sus procesos como en los lotes de la API
+ENGINE_MEMORY_BUDGET = MEMORY_BUDGET_MB * 1024 * 1024 // ENGINE_WORKERS
+
+# Segundos sin recibir más fotos de un álbum tras los que se procesa entero
+ALBUM_WAIT = float(os.environ.get('TELEGRAM_ALBUM_WAIT', 1.0))
+
+def create_engine():
+    """Crea el pool de procesos del motor de la marca de agua."""
+    # 'spawn' evita copiar en los procesos el estado del bucle de eventos
+    return ProcessPoolExecutor(max_workers=ENGINE_WORKERS,
+                               mp_context=multiprocessing.get_context('spawn'))
+
+async def open_clients(application: Application) -> None:
+    """
+    Crea el cliente HTTP compartido con la API, con una conexión por
+    actualización en curso, o el pool de procesos del motor.
+    """
+    if WATERMARK_MODE == 'engine':
+        log_font_path()
+        application.bot_data['engine'] = create_engine()
+    else:
+        application.bot_data['http'] = httpx.AsyncClient(
+            timeout=httpx.Timeout(API_TIMEOUT, connect=10),
+            limits=httpx.Limits(max_connections=CONCURRENT_UPDATES,
+                                max_keepalive_connections=CONCURRENT_UPDATES)
+        )
+    # Álbumes que se están recibiendo, por media_group_id
+    application.bot_data['albums'] = {}
+
+async def close_clients(application: Application) -> None:
+    """Cierra el cliente HTTP o el pool de procesos al detener el bot."""
+    if 'engine' in application.bot_data:
+        application.bot_data.pop('engine').shutdown(cancel_futures=True)
+    if 'http' in application.bot_data:
+        await application.bot_data.pop('http').aclose()
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Envía un mensaje cuando se emite el comando /start."""
@@ -47,64 +113,203 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         "/help - Muestra este mensaje de ayuda"
     )
 
-async def process_image(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Procesa una imagen y devuelve la versión con marca de agua."""
-    # Informar al usuario que estamos procesando la imagen
-    processing_message = await update.message.reply_text("Procesando imagen... ⏳")
+async def post_image(client, image, filename, code, processing_message):
+    """
+    Envía una imagen a la API sin bloquear el bucle de eventos.
+
+    Si la API está saturada, espera lo que indique Retry-After (con jitter) y
+    reintenta, mientras el resto de conversaciones siguen avanzando.
+
+    Returns:
+        httpx.Response: La última respuesta de la API
+    """
+    mimetype = mimetypes.guess_type(filename)[0] or 'image/jpeg'
+    files = {'image': (filename, image, mimetype)}
+    data = {'code': code}
+
+    attempt = 0
+    response = await client.post(API_URL, files=files, data=data)
+    while should_retry(response, attempt):
+        attempt += 1
+        try:
+            await processing_message.edit_text(f"Servicio ocupado, reintentando en breve ({attempt})... ⏳")
+        except BadRequest:
+            # Telegram rechaza dejar el mensaje igual (en un álbum, otra imagen
+            # puede haberlo cambiado ya al mismo texto); no impide reintentar
+            pass
+        await asyncio.sleep(retry_wait(response, attempt))
+        response = await client.post(API_URL, files=files, data=data)
+    return response
+
+def pixels_error(image):
+    """
+    Comprueba con la cabecera, sin decodificarla, si una imagen supera MAX_IMAGE_PIXELS.
+
+    Returns:
+        str: Mensaje de error para el usuario, o None si la imagen cabe
+    """
+    try:
+        with Image.open(io.BytesIO(image)) as img:
+            width, height = img.size
+    except Image.DecompressionBombError:
+        # Pillow ya rechaza al abrirlas las que doblan el límite
+        return f"La imagen supera el máximo de {MAX_IMAGE_PIXELS} píxeles"
+    if width * height > MAX_IMAGE_PIXELS:
+        return f"La imagen ({width}x{height}) supera el máximo de {MAX_IMAGE_PIXELS} píxeles"
+    return None
+
+async def render_with_engine(context, image, code):
+    """
+    Aplica la marca de agua en el pool de procesos, sin bloquear el bucle de eventos.
+
+    Si un proceso del pool muere (por ejemplo, por falta de memoria), el pool
+    queda inservible: se sustituye por uno nuevo para las siguientes imágenes.
+
+    Returns:
+        bytes: La imagen con marca de agua
+    """
+    engine = context.bot_data['engine']
+    loop = asyncio.get_running_loop()
+    try:
+        result, _ = await loop.run_in_executor(
+            engine, functools.partial(watermark_bytes, image, code,
+                                      memory_budget=ENGINE_MEMORY_BUDGET))
+    except BrokenProcessPool:
+        # Otra imagen que falló a la vez puede haberlo sustituido ya
+        if context.bot_data.get('engine') is engine:
+            logger.warning("El pool de procesos del motor se ha roto; se crea uno nuevo")
+            context.bot_data['engine'] = create_engine()
+            engine.shutdown(wait=False)
+        raise
+    return result
 
+async def watermark_message(message, context, processing_message):
+    """
+    Descarga la imagen de un mensaje y le aplica la marca de agua, en memoria.
+
+    Returns:
+        tuple: (bytes de la imagen con marca de agua, None) o (None, mensaje de error)
+    """
     try:
         # Obtener el archivo de imagen
-        photo = update.message.photo[-1] if update.message.photo else update.message.document
+        photo = message.photo[-1] if message.photo else message.document
         file = await context.bot.get_file(photo.file_id)
+        code = photo.file_id[:8]  # Usar parte del file_id como código
 
-        # Generar un nombre de archivo único
         file_extension = os.path.splitext(file.file_path)[1] or ".jpg"
         if not file_extension.startswith("."):
             file_extension = "." + file_extension
 
-        temp_input_path = os.path.join(TEMP_DIR, f"input_{photo.file_id}{file_extension}")
-        temp_output_path = os.path.join(TEMP_DIR, f"output_{photo.file_id}{file_extension}")
+        # Descargar la imagen en memoria
+        image = bytes(await file.download_as_bytearray())
 
-        # Descargar la imagen
-        await file.download_to_drive(temp_input_path)
+        if WATERMARK_MODE == 'engine':
+            # Rechazar las imágenes demasiado grandes antes de decodificarlas,
+            # como la API con su 413
+            error = pixels_error(image)
+            if error:
+                return None, error
+            return await render_with_engine(context, image, code), None
 
         # Enviar la imagen a la API para procesarla
-        with open(temp_input_path, 'rb') as img_file:
-            files = {'image': (f"telegram_image{file_extension}", img_file, f'image/{file_extension[1:]}')}
-            data = {'code': photo.file_id[:8]}  # Usar parte del file_id como código
-
-            response = requests.post(API_URL, files=files, data=data)
-
-            if response.status_code == 200:
-                # Guardar la imagen procesada
-                with open(temp_output_path, 'wb') as f:
-                    f.write(response.content)
-
-                # Enviar la imagen procesada al usuario
-                await update.message.reply_photo(
-                    photo=open(temp_output_path, 'rb'),
-                    caption="Aquí tienes tu imagen con marca de agua 🖼️"
-                )
-
-                # Eliminar el mensaje de procesamiento
-                await processing_message.delete()
-            else:
-                # Informar del error
-                await processing_message.edit_text(
-                    f"❌ Error al procesar la imagen: {response.status_code} - {response.text}"
-                )
-
-        # Limpiar archivos temporales
-        try:
-            os.remove(temp_input_path)
-            os.remove(temp_output_path)
-        except:
-            pass
+        response = await post_image(context.bot_data['http'], image, f"telegram_image{file_extension}",
+                                    code, processing_message)
+        if response.status_code == 200:
+            return response.content, None
+        return None, f"{response.status_code} - {response.text}"
+
+    except UnidentifiedImageError:
+        return None, "El archivo no es una imagen válida"
+
+    except BrokenProcessPool:
+        logger.error("Un proceso del motor terminó de forma inesperada")
+        return None, "No se pudo procesar la imagen, inténtalo de nuevo"
 
     except Exception as e:
         logger.error(f"Error al procesar imagen: {str(e)}")
+        return None, str(e)
+
+async def process_image(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Procesa una imagen y devuelve la versión con marca de agua."""
+    if update.message.media_group_id:
+        await collect_album(update, context)
+        return
+
+    # Informar al usuario que estamos procesando la imagen
+    processing_message = await update.message.reply_text("Procesando imagen... ⏳")
+
+    result, error = await watermark_message(update.message, context, processing_message)
+    try:
+        if result is not None:
+            # Enviar la imagen procesada al usuario directamente desde memoria
+            await update.message.reply_photo(
+                photo=result,
+                caption="Aquí tienes tu imagen con marca de agua 🖼️"
+            )
+
+            # Eliminar el mensaje de procesamiento
+            await processing_message.delete()
+        else:
+            # Informar del error
+            await processing_message.edit_text(f"❌ Error al procesar la imagen: {error}")
+
+    except Exception as e:
+        logger.error(f"Error al enviar la imagen: {str(e)}")
         await processing_message.edit_text(f"❌ Error al procesar la imagen: {str(e)}")
 
+async def collect_album(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Reúne las fotos de un álbum, que Telegram envía como mensajes separados.
+
+    El primer mensaje espera hasta que pasan ALBUM_WAIT segundos sin que
+    lleguen más y procesa el álbum entero; el resto solo se añaden a él.
+    """
+    albums = context.bot_data['albums']
+    group_id = update.message.media_group_id
+    if group_id in albums:
+        albums[group_id].append(update.message)
+        return
+
+    messages = albums[group_id] = [update.message]
+    received = 0
+    while received != len(messages):
+        received = len(messages)
+        await asyncio.sleep(ALBUM_WAIT)
+    del albums[group_id]
+    await process_album(messages, context)
+
+async def process_album(messages, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Procesa las fotos de un álbum a la vez y las devuelve en un solo álbum."""
+    first = messages[0]
+    processing_message = await first.reply_text(f"Procesando {len(messages)} imágenes... ⏳")
+
+    results = await asyncio.gather(*(watermark_message(message, context, processing_message)
+                                     for message in messages))
+    images = [result for result, _ in results if result is not None]
+    errors = [error for _, error in results if error is not None]
+
+    try:
+        caption = "Aquí tienes tus imágenes con marca de agua 🖼️"
+        if len(images) > 1:
+            # Un álbum admite como mucho 10 elementos, como los que envía Telegram
+            await first.reply_media_group(
+                media=[InputMediaPhoto(image, caption=caption if index == 0 else None)
+                       for index, image in enumerate(images)]
+            )
+        elif images:
+            await first.reply_photo(photo=images[0], caption=caption)
+
+        if errors:
+            await processing_message.edit_text(
+                f"❌ No se pudieron procesar {len(errors)} de {len(messages)} imágenes: {errors[0]}"
+            )
+        else:
+            await processing_message.delete()
+
+    except Exception as e:
+        logger.error(f"Error al enviar el álbum: {str(e)}")
+        await processing_message.edit_text(f"❌ Error al procesar las imágenes: {str(e)}")
+
 async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Maneja documentos (archivos) enviados al bot."""
     # Verificar si el documento es una imagen
@@ -118,8 +323,17 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 def main() -> None:
     """Inicia el bot."""
-    # Crear la aplicación
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    # Crear la aplicación. Las actualizaciones se atienden de forma concurrente,
+    # así que las peticiones a Telegram necesitan también varias conexiones
+    application = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .connection_pool_size(CONCURRENT_UPDATES * 2)
+        .post_init(open_clients)
+        .post_shutdown(close_clients)
+        .build()
+    )
 
     # Registrar manejadores de comandos
     application.add_handler(CommandHandler("start", start))
@@ -0,0 +1,975 @@
+from PIL import Image, ImageDraw, ImageFont
+import numpy as np
+import io
+import os
+import logging
+import mmap
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from math import sqrt
+
+# Directorio donde se vuelcan las imágenes que no caben en memoria
+SPILL_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'temp')
+
+# Separación (en píxeles) entre repeticiones del texto de la marca de agua
+WATERMARK_SPACING = 50
+
+# Formatos de salida: nombre -> (formato de Pillow, tipo MIME, extensión)
+OUTPUT_FORMATS = {
+    'jpeg': ('JPEG', 'image/jpeg', '.jpg'),
+    'webp': ('WEBP', 'image/webp', '.webp'),
+    'png': ('PNG', 'image/png', '.png'),
+}
+
+# Formato de salida que corresponde a cada extensión de archivo
+FORMAT_EXTENSIONS = {'.jpg': 'jpeg', '.jpeg': 'jpeg', '.webp': 'webp', '.png': 'png'}
+
+# Formatos entre los que se elige el más pequeño con output_format='auto'
+AUTO_FORMATS = ('jpeg', 'webp')
+
+# Ajustes del codificador de cada formato según el preset:
+# - quality: máxima calidad (el JPEG de calidad 95 de siempre)
+# - fast: codificación más rápida y archivos algo más pequeños
+# - small: archivos más pequeños a cambio de más tiempo de codificación
+ENCODER_PRESETS = {
+    'quality': {
+        'jpeg': {'quality': 95},
+        'webp': {'quality': 90, 'method': 4},
+        'png': {'compress_level': 6},
+    },
+    'fast': {
+        'jpeg': {'quality': 85, 'subsampling': '4:2:0'},
+        'webp': {'quality': 80, 'method': 0},
+        'png': {'compress_level': 1},
+    },
+    'small': {
+        'jpeg': {'quality': 80, 'subsampling': '4:2:0', 'optimize': True, 'progressive': True},
+        'webp': {'quality': 75, 'method': 6},
+        'png': {'compress_level': 9, 'optimize': True},
+    },
+}
+DEFAULT_PRESET = os.environ.get('WATERMARK_PRESET', 'quality')
+
+# Opciones del codificador que se pueden cambiar respecto al preset, por formato
+ENCODER_OPTIONS = {
+    'jpeg': ('quality', 'subsampling', 'progressive', 'optimize'),
+    'webp': ('quality', 'method'),
+    'png': ('compress_level', 'optimize'),
+}
+
+# Submuestreos de croma válidos para JPEG
+JPEG_SUBSAMPLINGS = ('4:4:4', '4:2:2', '4:2:0')
+
+# Rango de calidades en el que se busca la más baja que cumple min_psnr
+PSNR_QUALITY_RANGE = (30, 95)
+
+# Filas por franja al comparar imágenes para calcular el PSNR
+PSNR_BAND_ROWS = 512
+
+# Número máximo de teselas de marca de agua que se mantienen en caché
+TILE_CACHE_SIZE = 32
+
+# Número máximo de tamaños de fuente cargados que se mantienen en caché
+FONT_CACHE_SIZE = 16
+
+# Fuentes candidatas para la marca de agua, en orden de preferencia. Se pueden
+# anteponer otras rutas con la variable de entorno WATERMARK_FONT_PATHS
+# (separadas por el separador de rutas del sistema, ':' en Linux)
+FONT_CANDIDATES = [
+    "arial.ttf",
+    "times.ttf",
+    # Fuente incluida en la imagen de Docker (paquete fonts-liberation)
+    "/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf",
+    "/usr/share/fonts/truetype/liberation2/LiberationSans-Regular.ttf",
+    "LiberationSans-Regular.ttf",
+]
+
+def find_font_path(candidates=None):
+    """
+    Busca la primera fuente TrueType disponible entre las candidatas.
+
+    Args:
+        candidates: Lista de rutas o nombres de fuente (por defecto FONT_CANDIDATES
+            precedida por las rutas de WATERMARK_FONT_PATHS)
+
+    Returns:
+        str: Ruta de la fuente encontrada, o None si no hay ninguna disponible
+    """
+    if candidates is None:
+        configured = os.environ.get('WATERMARK_FONT_PATHS', '')
+        candidates = [path for path in configured.split(os.pathsep) if path] + FONT_CANDIDATES
+
+    for candidate in candidates:
+        try:
+            ImageFont.truetype(candidate, 10)
+            return candidate
+        except OSError:
+            continue
+    return None
+
+# Resolver la fuente una sola vez al arrancar
+FONT_PATH = find_font_path()
+
+def log_font_path():
+    """
+    Registra la fuente que usará la marca de agua.
+
+    No se hace al importar el módulo: el registro aún no estaría configurado
+    (y logging lo configuraría por su cuenta, con el nivel WARNING), así que
+    la llaman la API, el bot y el script local al arrancar.
+    """
+    if FONT_PATH:
+        logging.info(f"Fuente de la marca de agua: {FONT_PATH}")
+    else:
+        logging.warning("No se encontró ninguna fuente TrueType; se usará la fuente de mapa de bits por defecto")
+
+def render_signature(output_format='jpeg', preset=None, min_psnr=None, max_dimension=None,
+                     **overrides):
+    """
+    Devuelve los parámetros de los que depende el resultado de create_watermark,
+    además de la imagen y el código, para identificar resultados en cachés.
+
+    Args:
+        output_format, preset, min_psnr, max_dimension, **overrides: Opciones
+            de salida, como en create_watermark
+
+    Returns:
+        dict: Fuente, separación, tamaño máximo y ajustes del codificador de
+            cada formato posible
+    """
+    if max_dimension is not None and max_dimension < 1:
+        raise ValueError("El tamaño máximo debe ser un número positivo de píxeles")
+    formats = AUTO_FORMATS if output_format == 'auto' else (output_format,)
+    return {
+        'max_dimension': max_dimension,
+        'font': FONT_PATH,
+        'spacing': WATERMARK_SPACING,
+        'encoders': {
+            name: encoder_settings(name, preset, strict=output_format != 'auto', **overrides)
+            for name in formats
+        },
+        'min_psnr': min_psnr,
+    }
+
+@lru_cache(maxsize=FONT_CACHE_SIZE)
+def load_font(font_size):
+    """
+    Carga la fuente de la marca de agua con el tamaño indicado.
+
+    Las fuentes cargadas se guardan en caché por tamaño, ya que el tamaño depende
+    de la diagonal de la imagen y solo aparecen unos pocos valores distintos.
+    """
+    if FONT_PATH:
+        return ImageFont.truetype(FONT_PATH, font_size)
+    # Si no hay fuentes TrueType, usar la fuente por defecto
+    return ImageFont.load_default()
+
+@lru_cache(maxsize=TILE_CACHE_SIZE)
+def render_watermark_tile(watermark_text, font_size, spacing=WATERMARK_SPACING):
+    """
+    Renderiza una única vez el texto de la marca de agua (con su sombra) en una
+    tesela RGBA del tamaño de una celda del patrón.
+
+    Las teselas se guardan en una caché LRU acotada, así que los códigos repetidos
+    y los tamaños de imagen habituales no vuelven a rasterizar el texto.
+
+    Args:
+        watermark_text: Texto de la marca de agua
+        font_size: Tamaño de la fuente en píxeles
+        spacing: Separación entre repeticiones del texto
+
+    Returns:
+        Image: Tesela RGBA compartida (no debe modificarse)
+    """
+    font = load_font(font_size)
+
+    # Calcular dimensiones del texto
+    bbox = font.getbbox(watermark_text)
+    textwidth = bbox[2] - bbox[0]
+    textheight = bbox[3] - bbox[1]
+
+    # El tamaño de la tesela es el espaciado del patrón diagonal
+    x_spacing = textwidth + spacing
+    y_spacing = textheight + spacing
+
+    tile = Image.new('RGBA', (x_spacing, y_spacing), (255, 255, 255, 0))
+    d = ImageDraw.Draw(tile)
+
+    # Dibujar también las copias de las celdas anteriores para que el texto que
+    # sobresalga de su celda continúe en la siguiente, igual que en el patrón
+    for y in (-y_spacing, 0):
+        for x in (-x_spacing, 0):
+            # Dibujar texto semi-transparente
+            d.text((x, y), watermark_text, font=font, fill=(128, 128, 128, 30))
+            # Dibujar texto sólido
+            d.text((x+2, y+2), watermark_text, font=font, fill=(64, 64, 64, 30))
+
+    return tile
+
+def build_watermark_layer(size, tile):
+    """
+    Crea la capa RGBA de la marca de agua repitiendo la tesela sobre el lienzo.
+
+    Args:
+        size: Tamaño (ancho, alto) de la capa
+        tile: Tesela RGBA generada por render_watermark_tile
+
+    Returns:
+        Image: Capa RGBA con el patrón de la marca de agua
+    """
+    width, height = size
+    x_spacing, y_spacing = tile.size
+
+    # Componer primero una franja con una fila de teselas y repetirla hacia abajo
+    strip = Image.new('RGBA', (width, y_spacing), (255, 255, 255, 0))
+    for x in range(0, width, x_spacing):
+        strip.paste(tile, (x, 0))
+
+    layer = Image.new('RGBA', size, (255, 255, 255, 0))
+    for y in range(0, height, y_spacing):
+        layer.paste(strip, (0, y))
+    return layer
+
+# Modo de composición por defecto: 'numpy' mezcla la marca de agua directamente
+# en el búfer RGB de la imagen; 'pillow' usa Image.alpha_composite sobre copias RGBA
+COMPOSITE_MODE = os.environ.get('WATERMARK_COMPOSITE_MODE', 'numpy')
+
+# Máximo de filas de imagen que se mezclan en cada paso del modo 'numpy'
+BLEND_BAND_ROWS = 256
+
+@lru_cache(maxsize=TILE_CACHE_SIZE)
+def tile_blend_arrays(watermark_text, font_size, spacing=WATERMARK_SPACING):
+    """
+    Prepara la tesela de la marca de agua para mezclarla con NumPy.
+
+    Returns:
+        tuple: (inverse, color, spans) con 255 - alfa y el color premultiplicado
+            por su alfa (más 128 para redondear) como arrays uint16 de forma
+            (alto, ancho, 3), y los tramos (inicio, fin) de filas con texto
+    """
+    tile = np.asarray(render_watermark_tile(watermark_text, font_size, spacing), dtype=np.uint16)
+    alpha = np.repeat(tile[:, :, 3:], 3, axis=2)
+    color = tile[:, :, :3] * alpha + 128
+    inverse = 255 - alpha
+
+    # Agrupar las filas con texto en tramos contiguos; las filas totalmente
+    # transparentes no necesitan mezclarse
+    spans = []
+    start = None
+    for row, has_ink in enumerate(list(tile[:, :, 3].any(axis=1)) + [False]):
+        if has_ink and start is None:
+            start = row
+        elif not has_ink and start is not None:
+            spans.append((start, row))
+            start = None
+
+    inverse.flags.writeable = False
+    color.flags.writeable = False
+    return inverse, color, spans
+
+# Hilos por defecto para mezclar las franjas de una misma imagen en paralelo
+# (0 = uno por núcleo de CPU)
+BLEND_THREADS = int(os.environ.get('WATERMARK_THREADS', 1))
+
+@lru_cache(maxsize=None)
+def get_band_executor(threads):
+    """Devuelve el pool de hilos compartido para mezclar franjas en paralelo."""
+    return ThreadPoolExecutor(max_workers=threads, thread_name_prefix='watermark-band')
+
+def blend_band(img, box, inverse, color, full_width):
+    """
+    Mezcla la marca de agua en una franja de la imagen.
+
+    Pillow y NumPy liberan el GIL durante el recorte, la aritmética y el pegado,
+    por lo que varias franjas se pueden mezclar a la vez desde distintos hilos.
+
+    Args:
+        img: Imagen PIL en modo RGB (se modifica)
+        box: Rectángulo (izquierda, arriba, derecha, abajo) de la franja
+        inverse, color: Filas de la tesela que corresponden a la franja
+        full_width: Columnas cubiertas por teselas completas
+    """
+    width = box[2]
+    tile_width = inverse.shape[1]
+
+    # out = (img * (255 - alfa) + color * alfa) / 255, redondeado.
+    # La tesela se repite a lo ancho por difusión, sin copiarla
+    band = np.asarray(img.crop(box), dtype=np.uint16)
+    periodic = band[:, :full_width].reshape(band.shape[0], -1, tile_width, 3)
+    periodic *= inverse[:, np.newaxis]
+    periodic += color[:, np.newaxis]
+    band[:, full_width:] *= inverse[:, :width - full_width]
+    band[:, full_width:] += color[:, :width - full_width]
+    band += band >> 8
+    band >>= 8
+    img.paste(Image.fromarray(band.astype(np.uint8)), box)
+
+def blend_watermark_numpy(img, inverse, color, spans, band_rows=BLEND_BAND_ROWS, threads=1):
+    """
+    Mezcla la marca de agua sobre una imagen RGB modificándola en su lugar.
+
+    La imagen se recorre por franjas horizontales, de modo que solo se reservan
+    búferes del tamaño de una franja en lugar de varias copias RGBA completas.
+    El resultado coincide con Image.alpha_composite con un margen de ±1.
+
+    Args:
+        img: Imagen PIL en modo RGB (se modifica)
+        inverse, color, spans: Tesela preparada por tile_blend_arrays
+        band_rows: Máximo de filas que se procesan en cada paso
+        threads: Número de hilos que mezclan franjas en paralelo
+    """
+    width, height = img.size
+    tile_height, tile_width = inverse.shape[:2]
+    # Columnas cubiertas por teselas completas; el resto se mezcla aparte
+    full_width = width - width % tile_width
+
+    bands = []
+    for period_top in range(0, height, tile_height):
+        for span_start, span_end in spans:
+            for start in range(span_start, span_end, band_rows):
+                top = period_top + start
+                if top >= height:
+                    break
+                bottom = min(period_top + min(start + band_rows, span_end), height)
+                rows = slice(start, start + bottom - top)
+                bands.append(((0, top, width, bottom), inverse[rows], color[rows], full_width))
+
+    if threads <= 1:
+        for band in bands:
+            blend_band(img, *band)
+        return
+
+    # Las franjas no se solapan, así que se escriben en su sitio sin más unión
+    # que esperar a que terminen todas
+    if img.readonly:
+        raise ValueError("La imagen debe poder modificarse para mezclarla en paralelo")
+    executor = get_band_executor(threads)
+    for future in [executor.submit(blend_band, img, *band) for band in bands]:
+        future.result()
+
+# Presupuesto de memoria (en MB) por imagen en el modo por franjas. Si la imagen
+# decodificada no cabe, sus píxeles se vuelcan a un archivo temporal mapeado
+MEMORY_BUDGET_MB = int(os.environ.get('WATERMARK_MEMORY_BUDGET_MB', 256))
+
+# Bytes de memoria de trabajo por píxel de cada franja en el modo 'numpy'
+BAND_BYTES_PER_PIXEL = 17
+
+# Mínimo de filas por franja, aunque el presupuesto sea muy ajustado
+MIN_BAND_ROWS = 16
+
+# Modos de imagen que se pueden decodificar sobre un búfer mapeado en disco
+MAPPABLE_MODES = ('L', 'P', 'RGB', 'RGBA', 'CMYK')
+
+# Errores con los que se abandona el volcado a disco y se sigue en memoria. El
+# volcado usa partes internas de Pillow (Image.core.map_buffer, Image._new y
+# asignar img.im), probadas con Pillow 10.0 y 12.3, que otra versión podría
+# cambiar; OSError cubre además un disco lleno
+SPILL_ERRORS = (AttributeError, TypeError, ValueError, OSError)
+
+def frame_bytes(mode, size):
+    """Bytes que ocupa en memoria una imagen decodificada por Pillow."""
+    width, height = size
+    return width * height * (1 if mode in ('1', 'L', 'P') else 4)
+
+def spilled_frame(mode, size):
+    """
+    Crea el almacenamiento de una imagen sobre un archivo temporal mapeado.
+
+    Las páginas de la imagen quedan respaldadas por disco en lugar de por memoria
+    anónima, así que el sistema puede desalojarlas y la memoria residente queda
+    limitada por las franjas que se están procesando.
+
+    Returns:
+        ImagingCore: Núcleo de imagen de Pillow respaldado por el archivo
+    """
+    os.makedirs(SPILL_FOLDER, exist_ok=True)
+    with tempfile.TemporaryFile(dir=SPILL_FOLDER) as f:
+        f.truncate(frame_bytes(mode, size))
+        buffer = mmap.mmap(f.fileno(), 0)
+    return Image.core.map_buffer(buffer, size, 'raw', 0, (mode, 0, 1))
+
+def spill_to_disk(img, memory_budget):
+    """
+    Si una imagen abierta (y su conversión a RGB) no cabe en el presupuesto de
+    memoria y todavía no se ha decodificado, hace que se decodifique sobre un
+    archivo temporal mapeado.
+
+    Returns:
+        tuple: (bytes que ocuparía la imagen en memoria, si supera el presupuesto)
+    """
+    width, height = img.size
+    resident = frame_bytes(img.mode, img.size)
+    if img.mode != 'RGB':
+        resident += frame_bytes('RGB', img.size)
+    spill = resident + MIN_BAND_ROWS * width * BAND_BYTES_PER_PIXEL > memory_budget
+
+    if spill and getattr(img, 'tile', None) and img.mode in MAPPABLE_MODES:
+        try:
+            img.im = spilled_frame(img.mode, img.size)
+        except SPILL_ERRORS as e:
+            logging.warning(f"No se pudo decodificar sobre disco ({str(e)}); se decodifica en memoria")
+        else:
+            logging.info(f"Imagen de {width}x{height} fuera del presupuesto de memoria; "
+                         "se decodifica sobre disco")
+    return resident, spill
+
+def spilled_image(mode, size):
+    """
+    Crea una imagen vacía sobre un archivo temporal mapeado.
+
+    Returns:
+        Imagen PIL, o None si no se puede crear (ver SPILL_ERRORS)
+    """
+    try:
+        return Image.new(mode, (0, 0))._new(spilled_frame(mode, size))
+    except SPILL_ERRORS as e:
+        logging.warning(f"No se pudo crear la imagen {mode} sobre disco ({str(e)}); se crea en memoria")
+        return None
+
+def prepare_streaming(input_image, memory_budget):
+    """
+    Decodifica y convierte a RGB una imagen respetando un presupuesto de memoria.
+
+    Si la imagen (y su conversión a RGB) no cabe en el presupuesto, se decodifica
+    sobre un archivo temporal mapeado y la conversión se hace franja a franja.
+
+    Args:
+        input_image: Imagen PIL, idealmente aún sin decodificar (Image.open)
+        memory_budget: Presupuesto de memoria en bytes
+
+    Returns:
+        tuple: (img, band_rows) con la imagen RGB y las filas por franja
+    """
+    img = input_image
+    width, height = img.size
+
+    resident, spill = spill_to_disk(img, memory_budget)
+    img.load()
+
+    if img.mode != 'RGB':
+        # Convertir a RGB por franjas para no crear una copia intermedia completa
+        rgb = spilled_image('RGB', img.size) if spill else None
+        if rgb is None:
+            rgb = Image.new('RGB', img.size)
+        for top in range(0, height, BLEND_BAND_ROWS):
+            box = (0, top, width, min(top + BLEND_BAND_ROWS, height))
+            rgb.paste(img.crop(box).convert('RGB'), box)
+        img = rgb
+
+    available = memory_budget - (0 if spill else resident)
+    band_rows = available // (width * BAND_BYTES_PER_PIXEL)
+    return img, max(MIN_BAND_ROWS, min(BLEND_BAND_ROWS, band_rows))
+
+def format_for_path(path):
+    """
+    Devuelve el formato de salida que corresponde a la extensión de una ruta.
+
+    Returns:
+        str o None si la extensión no es de un formato de salida
+    """
+    return FORMAT_EXTENSIONS.get(os.path.splitext(str(path))[1].lower())
+
+def format_of(data):
+    """Identifica el formato de salida de una imagen ya codificada por sus primeros bytes."""
+    if data[:3] == b'\xff\xd8\xff':
+        return 'jpeg'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'png'
+    return None
+
+def encoder_settings(output_format, preset=None, strict=True, **overrides):
+    """
+    Calcula los ajustes del codificador para un formato de salida.
+
+    Args:
+        output_format: 'jpeg', 'webp' o 'png'
+        preset: 'quality', 'fast' o 'small' (por defecto DEFAULT_PRESET)
+        strict: Si es False, se ignoran las opciones que no se aplican al
+            formato en lugar de lanzar un error
+        **overrides: Opciones que sustituyen a las del preset (quality,
+            subsampling, progressive, optimize, method, compress_level); las
+            que valen None se ignoran
+
+    Returns:
+        tuple: (formato de Pillow, argumentos para Image.save)
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Formato de salida no válido: {output_format}")
+    preset = preset or DEFAULT_PRESET
+    if preset not in ENCODER_PRESETS:
+        raise ValueError(f"Preset no válido: {preset}")
+
+    settings = dict(ENCODER_PRESETS[preset][output_format])
+    for name, value in overrides.items():
+        if value is None:
+            continue
+        if name not in ENCODER_OPTIONS[output_format]:
+            if strict:
+                raise ValueError(f"La opción '{name}' no se aplica al formato {output_format}")
+            continue
+        settings[name] = value
+
+    if not 1 <= settings.get('quality', 1) <= 100:
+        raise ValueError("La calidad debe estar entre 1 y 100")
+    if settings.get('subsampling', JPEG_SUBSAMPLINGS[0]) not in JPEG_SUBSAMPLINGS:
+        raise ValueError(f"Submuestreo no válido: {settings['subsampling']}")
+    return OUTPUT_FORMATS[output_format][0], settings
+
+def encode_to_bytes(img, output_format, preset=None, **overrides):
+    """Codifica una imagen en memoria con los ajustes de encoder_settings."""
+    pil_format, settings = encoder_settings(output_format, preset, **overrides)
+    buffer = io.BytesIO()
+    img.save(buffer, pil_format, **settings)
+    return buffer.getvalue()
+
+def measure_psnr(reference, data):
+    """
+    Calcula el PSNR (en dB) de una imagen codificada respecto a la original.
+
+    La comparación se hace por franjas para no duplicar la imagen completa en
+    memoria como números de coma flotante.
+
+    Args:
+        reference: Imagen PIL RGB original
+        data: Bytes de la imagen codificada
+
+    Returns:
+        float: PSNR en decibelios (infinito si son idénticas)
+    """
+    width, height = reference.size
+    squared_error = 0.0
+    with Image.open(io.BytesIO(data)) as decoded:
+        decoded = decoded.convert('RGB')
+        for top in range(0, height, PSNR_BAND_ROWS):
+            box = (0, top, width, min(top + PSNR_BAND_ROWS, height))
+            diff = (np.asarray(decoded.crop(box), dtype=np.int16)
+                    - np.asarray(reference.crop(box), dtype=np.int16))
+            squared_error += float(np.square(diff, dtype=np.int32).sum(dtype=np.int64))
+    mse = squared_error / (width * height * 3)
+    if mse == 0:
+        return float('inf')
+    return 10 * np.log10(255 ** 2 / mse)
+
+def smallest_meeting_psnr(img, output_format, min_psnr, preset=None, **overrides):
+    """
+    Busca la calidad más baja con la que la imagen codificada alcanza min_psnr.
+
+    Hace una búsqueda binaria en PSNR_QUALITY_RANGE (unas 6 codificaciones). Si
+    ni la calidad máxima del rango lo alcanza, se usa esa calidad. PNG no tiene
+    pérdidas, así que se codifica una sola vez.
+
+    Returns:
+        bytes: La imagen codificada
+    """
+    if 'quality' not in ENCODER_OPTIONS[output_format]:
+        return encode_to_bytes(img, output_format, preset, **overrides)
+
+    overrides.pop('quality', None)
+    low, high = PSNR_QUALITY_RANGE
+    best = None
+    while low <= high:
+        quality = (low + high) // 2
+        data = encode_to_bytes(img, output_format, preset, quality=quality, **overrides)
+        if measure_psnr(img, data) >= min_psnr:
+            best = data
+            high = quality - 1
+        else:
+            low = quality + 1
+    if best is None:
+        best = encode_to_bytes(img, output_format, preset, quality=PSNR_QUALITY_RANGE[1], **overrides)
+    return best
+
+def encode_image(img, output_path, output_format=None, preset=None, min_psnr=None, **overrides):
+    """
+    Guarda la imagen con marca de agua en el formato y con los ajustes pedidos.
+
+    Args:
+        img: Imagen PIL RGB
+        output_path: Ruta o archivo de salida
+        output_format: 'jpeg', 'webp', 'png' o 'auto' (el más pequeño de
+            AUTO_FORMATS). Por defecto, el de la extensión de output_path o JPEG
+        preset: Preset del codificador (ver ENCODER_PRESETS)
+        min_psnr: Si se indica, se usa la calidad más baja que alcanza este PSNR
+            en dB (requiere codificar varias veces)
+        **overrides: Opciones del codificador que sustituyen a las del preset
+
+    Returns:
+        str: Formato de salida usado
+    """
+    if output_format is None:
+        is_path = isinstance(output_path, (str, os.PathLike))
+        output_format = (is_path and format_for_path(output_path)) or 'jpeg'
+
+    if output_format != 'auto' and min_psnr is None:
+        # Caso habitual: un solo formato, codificado directamente en la salida
+        pil_format, settings = encoder_settings(output_format, preset, **overrides)
+        img.save(output_path, pil_format, **settings)
+        return output_format
+
+    formats = AUTO_FORMATS if output_format == 'auto' else (output_format,)
+    strict = output_format != 'auto'
+    best_format, best_data = None, None
+    for name in formats:
+        options = {key: value for key, value in overrides.items()
+                   if strict or key in ENCODER_OPTIONS[name]}
+        if min_psnr is None:
+            data = encode_to_bytes(img, name, preset, **options)
+        else:
+            data = smallest_meeting_psnr(img, name, min_psnr, preset, **options)
+        if best_data is None or len(data) < len(best_data):
+            best_format, best_data = name, data
+
+    if hasattr(output_path, 'write'):
+        output_path.write(best_data)
+    else:
+        with open(output_path, 'wb') as f:
+            f.write(best_data)
+    return best_format
+
+def record_stage(timings, stage, start):
+    """Suma en timings los segundos transcurridos desde start y devuelve el instante actual."""
+    now = time.perf_counter()
+    timings[stage] = timings.get(stage, 0) + now - start
+    return now
+
+def output_size_for(size, max_dimension=None):
+    """Tamaño de salida de una imagen: el original o el reducido a max_dimension."""
+    if max_dimension and max(size) > max_dimension:
+        scale = max_dimension / max(size)
+        return (max(1, round(size[0] * scale)), max(1, round(size[1] * scale)))
+    return size
+
+def prepare_decode(img, memory_budget=None, max_dimension=None, streaming=True):
+    """
+    Prepara una imagen abierta, aún sin decodificar, antes de empezar a decodificarla.
+
+    Sirve para decodificar la imagen a medida que llega (ImageFile.Parser): se
+    llama en cuanto se conoce la cabecera y deja la imagen como la dejaría
+    decode_image antes de cargarla.
+
+    Args:
+        img: Imagen PIL recién abierta
+        memory_budget, max_dimension, streaming: Como en decode_image
+
+    Returns:
+        tuple: Tamaño original de la imagen, que hay que pasar a decode_image
+            como original_size
+    """
+    original_size = img.size
+    output_size = output_size_for(img.size, max_dimension)
+    if output_size != img.size:
+        img.draft(img.mode, output_size)
+    if memory_budget and streaming:
+        spill_to_disk(img, memory_budget)
+    return original_size
+
+def decode_image(input_image, memory_budget=None, max_dimension=None, streaming=True,
+                 timings=None, allocate=None, original_size=None):
+    """
+    Decodifica una imagen a RGB al tamaño de salida.
+
+    Args:
+        input_image: Objeto de imagen PIL, idealmente aún sin decodificar
+        memory_budget: Presupuesto de memoria en bytes (ver create_watermark)
+        max_dimension: Lado mayor máximo de la imagen de salida
+        streaming: Si se puede decodificar por franjas dentro del presupuesto
+            (solo en el modo de composición 'numpy')
+        timings: Diccionario en el que se guardan los segundos de 'decode' y
+            'resize'
+        allocate: Función opcional allocate(mode, size) que devuelve el
+            almacenamiento (ImagingCore) de la imagen decodificada, por ejemplo
+            en memoria compartida. Si la imagen no necesita conversión ni
+            reducción, se decodifica directamente sobre él; si no, se copia una
+            vez al final. Con allocate no se aplica el presupuesto de memoria
+        original_size: Tamaño de la imagen antes de reducirla con draft, si ya
+            se ha preparado con prepare_decode
+
+    Returns:
+        tuple: (imagen RGB, filas por franja, escala respecto al ancho original)
+    """
+    if timings is None:
+        timings = {}
+    start = time.perf_counter()
+
+    img = input_image
+    original_size = original_size or img.size
+    band_rows = BLEND_BAND_ROWS
+
+    # Tamaño de salida: el original o el reducido a max_dimension
+    output_size = output_size_for(original_size, max_dimension)
+    if img.size != output_size:
+        # Decodificar a escala reducida si el formato lo permite (JPEG); el
+        # tamaño resultante nunca es menor que el de salida
+        img.draft(img.mode, output_size)
+
+    in_place = False
+    if allocate is not None:
+        if img.mode == 'RGB' and img.size == output_size and getattr(img, 'tile', None):
+            # Decodificar directamente sobre el almacenamiento indicado
+            img.im = allocate('RGB', img.size)
+            in_place = True
+        img.load()
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+    elif memory_budget and streaming:
+        # Modo por franjas: decodificar y convertir dentro del presupuesto
+        img, band_rows = prepare_streaming(img, memory_budget)
+    else:
+        img.load()
+        if img.mode != 'RGB':
+            # Convertir a RGB si es necesario
+            img = img.convert('RGB')
+    start = record_stage(timings, 'decode', start)
+
+    if img.size != output_size:
+        # Reducción restante a máxima calidad
+        img = img.resize(output_size, Image.LANCZOS)
+        start = record_stage(timings, 'resize', start)
+
+    if allocate is not None and not in_place:
+        # La conversión o la reducción crearon una imagen nueva: copiarla
+        target = Image.new('RGB', (0, 0))._new(allocate('RGB', img.size))
+        target.paste(img)
+        img = target
+
+    return img, band_rows, img.width / original_size[0]
+
+def apply_watermark(img, output_path, file_code, band_rows=BLEND_BAND_ROWS, scale=1.0,
+                    composite_mode=None, threads=None, timings=None, output_format=None,
+                    preset=None, min_psnr=None, **encode_options):
+    """
+    Aplica la marca de agua a una imagen RGB ya decodificada y la codifica.
+
+    Args:
+        img: Imagen PIL RGB (en modo 'numpy' se modifica en su lugar)
+        output_path: Ruta o archivo donde guardar la imagen con marca de agua
+        file_code: Código único para incluir en la marca de agua
+        band_rows: Máximo de filas por franja (ver decode_image)
+        scale: Escala de la imagen respecto a la original, para reducir la
+            separación de la marca de agua en la misma proporción
+        composite_mode, threads, timings, output_format, preset, min_psnr,
+            **encode_options: Como en create_watermark
+
+    Returns:
+        str: Formato de salida usado ('jpeg', 'webp' o 'png')
+    """
+    watermark_text = f"@pedro.rj2 #{file_code}"
+    composite_mode = composite_mode or COMPOSITE_MODE
+    if threads is None:
+        threads = BLEND_THREADS
+    threads = threads or os.cpu_count() or 1
+
+    if timings is None:
+        timings = {}
+    start = time.perf_counter()
+
+    width, height = img.size
+
+    # Calcular tamaño de fuente basado en la diagonal de la imagen de salida, y
+    # reducir la separación en la misma proporción que la imagen para que el
+    # resultado sea igual que marcar a tamaño completo y reducir después
+    diagonal = sqrt(width**2 + height**2)
+    font_size = max(1, int(diagonal * 0.025))  # 2.5% de la diagonal
+    spacing = max(1, round(WATERMARK_SPACING * scale))
+
+    if composite_mode == 'numpy':
+        # Mezclar la marca de agua directamente sobre el búfer RGB. Con varios
+        # hilos hay varias franjas en memoria a la vez, así que se reparten
+        # el presupuesto
+        if threads > 1:
+            band_rows = max(MIN_BAND_ROWS, band_rows // threads)
+            if img.readonly:
+                img = img.copy()
+        blend = tile_blend_arrays(watermark_text, font_size, spacing)
+        start = record_stage(timings, 'render', start)
+        blend_watermark_numpy(img, *blend, band_rows=band_rows, threads=threads)
+        watermarked = img
+    elif composite_mode == 'pillow':
+        # Obtener la tesela ya renderizada y repetirla en patrón diagonal
+        tile = render_watermark_tile(watermark_text, font_size, spacing)
+        txt = build_watermark_layer(img.size, tile)
+        start = record_stage(timings, 'render', start)
+
+        # Combinar imagen original con marca de agua
+        watermarked = Image.alpha_composite(img.convert('RGBA'), txt).convert('RGB')
+    else:
+        raise ValueError(f"Modo de composición no válido: {composite_mode}")
+    start = record_stage(timings, 'composite', start)
+
+    # Guardar resultado (el codificador escribe la salida por bloques)
+    used_format = encode_image(watermarked, output_path, output_format, preset, min_psnr,
+                               **encode_options)
+    record_stage(timings, 'encode', start)
+    return used_format
+
+def create_watermark(input_image, output_path, file_code, composite_mode=None,
+                     memory_budget=None, threads=None, timings=None, max_dimension=None,
+                     output_format=None, preset=None, min_psnr=None, original_size=None,
+                     **encode_options):
+    """
+    Aplica una marca de agua a una imagen.
+
+    Args:
+        input_image: Objeto de imagen PIL (en modo 'numpy', si ya es RGB se
+            modifica en su lugar)
+        output_path: Ruta o archivo donde guardar la imagen con marca de agua
+        file_code: Código único para incluir en la marca de agua
+        composite_mode: 'numpy' o 'pillow' (por defecto COMPOSITE_MODE)
+        memory_budget: Presupuesto de memoria en bytes. Si se indica, la imagen
+            se decodifica, se convierte y se marca por franjas sin superarlo
+            (solo en modo 'numpy')
+        threads: Hilos que mezclan franjas de la imagen en paralelo (por defecto
+            BLEND_THREADS; 0 = uno por núcleo de CPU; solo en modo 'numpy')
+        timings: Diccionario opcional en el que se guardan los segundos de cada
+            etapa: 'decode', 'resize', 'render', 'composite' y 'encode'
+        max_dimension: Si se indica, la imagen se reduce para que su lado mayor
+            no lo supere. En JPEG se decodifica directamente a 1/2, 1/4 u 1/8
+            del tamaño y solo el resto de la reducción se hace con LANCZOS. La
+            marca de agua se calcula sobre el tamaño de salida
+        output_format: 'jpeg', 'webp', 'png' o 'auto' (por defecto, el de la
+            extensión de output_path o JPEG)
+        preset: Preset del codificador: 'quality', 'fast' o 'small'
+        min_psnr: Calidad mínima en dB; se elige la salida más pequeña que la
+            alcanza
+        original_size: Tamaño original si la imagen ya se preparó con
+            prepare_decode (por ejemplo, al decodificarla mientras llegaba)
+        **encode_options: Opciones del codificador que sustituyen a las del
+            preset (quality, subsampling, progressive, optimize...)
+
+    Returns:
+        str: Formato de salida usado ('jpeg', 'webp' o 'png')
+    """
+    composite_mode = composite_mode or COMPOSITE_MODE
+    if timings is None:
+        timings = {}
+
+    img, band_rows, scale = decode_image(input_image, memory_budget, max_dimension,
+                                         streaming=composite_mode == 'numpy', timings=timings,
+                                         original_size=original_size)
+    return apply_watermark(img, output_path, file_code, band_rows, scale,
+                           composite_mode=composite_mode, threads=threads, timings=timings,
+                           output_format=output_format, preset=preset, min_psnr=min_psnr,
+                           **encode_options)
+
+def default_output_path(input_path, output_format=None):
+    """
+    Devuelve la ruta de salida por defecto: '<nombre>_watermark<ext>'.
+
+    La extensión es la del formato de salida o, si no se indica, la de la
+    imagen original cuando es un formato de salida válido ('.jpg' si no lo es,
+    por ejemplo con BMP o TIFF).
+    """
+    name, ext = os.path.splitext(input_path)
+    if output_format in OUTPUT_FORMATS:
+        ext = OUTPUT_FORMATS[output_format][2]
+    elif format_for_path(input_path) is None:
+        ext = OUTPUT_FORMATS['jpeg'][2]
+    return f"{name}_watermark{ext}"
+
+def watermark_file(input_path, output_path, file_code, **options):
+    """
+    Aplica la marca de agua a un archivo de imagen y guarda el resultado.
+
+    Nunca lanza excepciones: los errores se devuelven en el resultado para que
+    un fallo en un archivo no interrumpa el procesamiento de un lote.
+
+    Args:
+        input_path: Ruta de la imagen original
+        output_path: Ruta donde guardar la imagen con marca de agua
+        file_code: Código único para incluir en la marca de agua
+        **options: Opciones adicionales para create_watermark
+
+    Returns:
+        dict: Resultado con 'input_path', 'output_path', 'code' y 'error'
+            (None si el proceso fue exitoso)
+    """
+    result = {
+        'input_path': input_path,
+        'output_path': output_path,
+        'code': file_code,
+        'error': None
+    }
+    try:
+        with Image.open(input_path) as img:
+            create_watermark(img, output_path, file_code, **options)
+    except Exception as e:
+        result['error'] = str(e)
+    return result
+
+def watermark_bytes(data, file_code, **options):
+    """
+    Aplica la marca de agua a una imagen codificada que está en memoria.
+
+    Pensada para ejecutarse en un pool de procesos: recibe y devuelve solo
+    bytes, sin archivos intermedios.
+
+    Args:
+        data: Bytes de la imagen original
+        file_code: Código único para incluir en la marca de agua
+        **options: Opciones adicionales para create_watermark
+
+    Returns:
+        tuple: (bytes de la imagen con marca de agua, formato de salida usado)
+    """
+    output = io.BytesIO()
+    with Image.open(io.BytesIO(data)) as img:
+        used_format = create_watermark(img, output, file_code, **options)
+    return output.getvalue(), used_format
+
+def watermark_many(paths, codes, workers=None, output_paths=None, on_result=None, **options):
+    """
+    Aplica la marca de agua a muchos archivos en paralelo con un pool de procesos.
+
+    Args:
+        paths: Rutas de las imágenes originales
+        codes: Código de la marca de agua para cada imagen
+        workers: Número de procesos (por defecto, uno por núcleo de CPU)
+        output_paths: Rutas de salida para cada imagen (por defecto, las de
+            default_output_path junto a la original)
+        on_result: Función opcional a la que se llama con cada resultado en
+            cuanto termina, por ejemplo para mostrar el progreso
+        **options: Opciones adicionales para create_watermark
+
+    Returns:
+        list: Un resultado de watermark_file por imagen, en el mismo orden que
+            paths
+    """
+    paths = list(paths)
+    codes = list(codes)
+    if len(codes) != len(paths):
+        raise ValueError("Debe haber un código por cada imagen")
+
+    if output_paths is None:
+        output_paths = [default_output_path(path, options.get('output_format')) for path in paths]
+    output_paths = list(output_paths)
+
+    # Cada proceso ya ocupa un núcleo, así que no se reparten franjas entre hilos
+    options.setdefault('threads', 1)
+
+    results = [None] * len(paths)
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        futures = {
+            executor.submit(watermark_file, path, output_path, code, **options): index
+            for index, (path, output_path, code) in enumerate(zip(paths, output_paths, codes))
+        }
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                # El proceso falló fuera de watermark_file (por ejemplo, se cerró)
+                result = {
+                    'input_path': paths[index],
+                    'output_path': output_paths[index],
+                    'code': codes[index],
+                    'error': str(e)
+                }
+            results[index] = result
+            if on_result:
+                on_result(result)
+
+    return results
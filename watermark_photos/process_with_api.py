@@ -1,17 +1,92 @@
 import os
+import sys
 import requests
-import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from requests.adapters import HTTPAdapter
 
-def process_images_with_api(input_dir, output_dir, api_url="http://localhost:8080/watermark"):
+# Utilidades del cliente de la API (reintentos con Retry-After y control de carga)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'api'))
+from api_client import AdaptiveLimiter, output_format_for, post_with_retry
+from batch_manifest import BatchManifest
+
+# Peticiones en curso máximas. El límite real se adapta a la latencia de la
+# API y a sus respuestas 429/503 (ver AdaptiveLimiter)
+API_CONCURRENCY = int(os.environ.get('WATERMARK_API_CONCURRENCY', 4))
+
+# Segundos máximos de espera por cada petición
+API_TIMEOUT = float(os.environ.get('WATERMARK_API_TIMEOUT', 120))
+
+def create_session(concurrency):
+    """Sesión HTTP con keep-alive y una conexión reutilizable por cada petición en curso."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def output_filename(filename):
+    """Nombre del archivo de salida de una imagen."""
+    name = os.path.splitext(filename)[0]
+    return f"{name}_watermarked{output_format_for(filename)[1]}"
+
+def process_image_with_api(session, limiter, input_path, output_path, api_url):
+    """
+    Envía una imagen a la API y guarda el resultado.
+
+    Returns:
+        bool: True si la imagen se procesó correctamente
+    """
+    filename = os.path.basename(input_path)
+    name, ext = os.path.splitext(filename)
+    try:
+        print(f"Procesando: {filename}")
+
+        # Abrir el archivo de imagen
+        with open(input_path, 'rb') as img_file:
+            # Preparar los datos para la solicitud
+            files = {'image': (filename, img_file, f'image/{ext[1:]}')}
+            data = {'code': name,  # Usar el nombre del archivo como código
+                    'output_format': output_format_for(filename)[0]}
+
+            # Enviar la solicitud a la API (con reintentos y esperando lo que
+            # indique Retry-After si está saturada)
+            response = post_with_retry(session, api_url, files, data, limiter=limiter,
+                                       size=os.path.getsize(input_path), timeout=API_TIMEOUT)
+
+        # Verificar si la solicitud fue exitosa
+        if response.status_code == 200:
+            # Guardar la imagen procesada
+            with open(output_path, 'wb') as f:
+                f.write(response.content)
+
+            print(f"✓ Completado: {filename} -> {os.path.basename(output_path)}")
+            return True
+
+        print(f"✗ Error en la API: {response.status_code} - {response.text}")
+        return False
+
+    except Exception as e:
+        print(f"✗ Error procesando {filename}: {str(e)}")
+        return False
+
+def process_images_with_api(input_dir, output_dir, api_url="http://localhost:8080/watermark",
+                            concurrency=API_CONCURRENCY):
     """
     Procesa todas las imágenes en la carpeta de entrada usando la API de marca de agua
     y guarda los resultados en la carpeta de salida.
+
+    Las imágenes se envían en paralelo por una sesión con keep-alive. En lugar
+    de una pausa fija entre imágenes, el número de peticiones en curso se
+    adapta a la latencia de la API y baja si responde 429 o 503. Las imágenes
+    ya procesadas en ejecuciones anteriores que no han cambiado se omiten
+    (ver BatchManifest).
     
     Args:
         input_dir: Directorio donde se encuentran las imágenes originales
         output_dir: Directorio donde se guardarán las imágenes con marca de agua
         api_url: URL de la API de marca de agua
+        concurrency: Peticiones en curso máximas
     """
     # Crear la carpeta de salida si no existe
     os.makedirs(output_dir, exist_ok=True)
@@ -19,57 +94,43 @@ def process_images_with_api(input_dir, output_dir, api_url="http://localhost:808
     # Extensiones de archivo soportadas
     supported_extensions = ('.jpg', '.jpeg', '.png', '.bmp', '.tiff')
     
-    # Contador para estadísticas
-    total_images = 0
-    successful_images = 0
-    failed_images = 0
-    
     print(f"Procesando imágenes de {input_dir}...")
-    
-    # Procesar cada imagen en la carpeta de entrada
-    for filename in os.listdir(input_dir):
-        if filename.lower().endswith(supported_extensions):
-            input_path = os.path.join(input_dir, filename)
-            name, ext = os.path.splitext(filename)
-            output_filename = f"{name}_watermarked{ext}"
-            output_path = os.path.join(output_dir, output_filename)
-            
-            total_images += 1
-            
-            try:
-                print(f"Procesando: {filename}")
-                
-                # Abrir el archivo de imagen
-                with open(input_path, 'rb') as img_file:
-                    # Preparar los datos para la solicitud
-                    files = {'image': (filename, img_file, f'image/{ext[1:]}')}
-                    data = {'code': name}  # Usar el nombre del archivo como código
-                    
-                    # Enviar la solicitud a la API
-                    response = requests.post(api_url, files=files, data=data)
-                    
-                    # Verificar si la solicitud fue exitosa
-                    if response.status_code == 200:
-                        # Guardar la imagen procesada
-                        with open(output_path, 'wb') as f:
-                            f.write(response.content)
-                        
-                        print(f"✓ Completado: {filename} -> {output_filename}")
-                        successful_images += 1
-                    else:
-                        print(f"✗ Error en la API: {response.status_code} - {response.text}")
-                        failed_images += 1
-                
-                # Pequeña pausa para no sobrecargar la API
-                time.sleep(0.5)
-                
-            except Exception as e:
-                print(f"✗ Error procesando {filename}: {str(e)}")
-                failed_images += 1
+
+    images = [(filename, output_filename(filename)) for filename in sorted(os.listdir(input_dir))
+              if filename.lower().endswith(supported_extensions)]
+
+    def process(item):
+        filename, output_filename = item
+        done = process_image_with_api(session, limiter, os.path.join(input_dir, filename),
+                                      os.path.join(output_dir, output_filename), api_url)
+        if done:
+            manifest.record(filename, os.path.splitext(filename)[0], output_filename)
+        return done
+
+    # Procesar las imágenes de la carpeta de entrada que no se hayan procesado
+    # ya (por ejemplo, al reanudar una ejecución interrumpida)
+    limiter = AdaptiveLimiter(concurrency)
+    with BatchManifest(input_dir, output_dir) as manifest, create_session(concurrency) as session, \
+            ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = manifest.pending(images)
+        skipped_images = len(images) - len(pending)
+        try:
+            results = list(executor.map(process, pending))
+        except KeyboardInterrupt:
+            # No enviar las imágenes que faltan; las terminadas ya están en el
+            # manifiesto y la siguiente ejecución continúa desde ahí
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+
+    # Contador para estadísticas
+    total_images = len(results)
+    successful_images = sum(results)
+    failed_images = total_images - successful_images
     
     # Mostrar estadísticas
     print("\n--- Resumen ---")
-    print(f"Total de imágenes encontradas: {total_images}")
+    print(f"Total de imágenes encontradas: {total_images + skipped_images}")
+    print(f"Imágenes sin cambios (omitidas): {skipped_images}")
     print(f"Imágenes procesadas exitosamente: {successful_images}")
     print(f"Imágenes con errores: {failed_images}")
     
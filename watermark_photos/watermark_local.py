@@ -1,109 +1,69 @@
-
-from PIL import Image, ImageDraw, ImageFont
-import numpy as np
+from PIL import Image
 import os
-from math import sqrt
+import sys
+import logging
+
+# Configuración de logging
+logging.basicConfig(level=logging.INFO, format='%(message)s')
 
-def create_watermark(input_image_path, output_path, file_code):
-    watermark_text = f"@pedro.rj2 #{file_code}"
-    
-    # Abrir imagen
+# El motor de la marca de agua es compartido con la API
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'api'))
+import watermark_engine
+from batch_manifest import BatchManifest
+from watermark_engine import default_output_path, watermark_many
+
+def create_watermark(input_image_path, output_path, file_code, **options):
+    # Abrir imagen y aplicar la marca de agua con el motor compartido
     with Image.open(input_image_path) as img:
-        # Convertir a RGB si es necesario
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
-        
-        width, height = img.size
-        
-        # Crear una nueva imagen para la marca de agua
-        txt = Image.new('RGBA', img.size, (255, 255, 255, 0))
-        
-        # Calcular tamaño de fuente basado en la diagonal de la imagen
-        diagonal = sqrt(width**2 + height**2)
-        font_size = int(diagonal * 0.025)  # 2.5% de la diagonal
-        
-        try:
-            # Intentar usar Arial
-            font = ImageFont.truetype("arial.ttf", font_size)
-        except:
-            try:
-                # Intentar usar Times New Roman
-                font = ImageFont.truetype("times.ttf", font_size)
-            except:
-                # Si no hay fuentes TrueType, usar la fuente por defecto
-                font = ImageFont.load_default()
-        
-        # Crear objeto para dibujar
-        d = ImageDraw.Draw(txt)
-        
-        # Calcular dimensiones del texto usando textbbox
-        bbox = d.textbbox((0, 0), watermark_text, font=font)
-        textwidth = bbox[2] - bbox[0]
-        textheight = bbox[3] - bbox[1]
-        
-        # Calcular espaciado para el patrón diagonal
-        x_spacing = textwidth + 50
-        y_spacing = textheight + 50
-        
-        # Calcular punto de inicio para que el texto comience desde el borde
-        start_x = 0
-        start_y = 0
-        
-        # Dibujar marca de agua en patrón diagonal
-        y = start_y
-        while y < height:
-            x = start_x
-            while x < width:
-                # Dibujar texto semi-transparente
-                d.text((x, y), watermark_text, font=font, fill=(128, 128, 128, 30))
-                # Dibujar texto sólido
-                d.text((x+2, y+2), watermark_text, font=font, fill=(64, 64, 64, 30))
-                x += x_spacing
-            y += y_spacing
-        
-        # Combinar imagen original con marca de agua
-        watermarked = Image.alpha_composite(img.convert('RGBA'), txt)
-        
-        # Guardar resultado
-        watermarked.convert('RGB').save(output_path, 'JPEG', quality=95)
-        return True
+        return watermark_engine.create_watermark(img, output_path, file_code, **options)
 
-def process_directory(input_dir, output_dir):
+def process_directory(input_dir, output_dir, workers=None):
     if not os.path.exists(input_dir):
         return
 
     os.makedirs(output_dir, exist_ok=True)
     supported_extensions = ('.jpg', '.jpeg', '.png', '.bmp', '.tiff')
 
-    for filename in os.listdir(input_dir):
-        if filename.lower().endswith(supported_extensions):
-            input_path = os.path.join(input_dir, filename)
-            name, ext = os.path.splitext(filename)
-            output_filename = f"{name}_watermark{ext}"
-            output_path = os.path.join(output_dir, output_filename)
-            
-            try:
-                print(f"Procesando: {filename}")
-                create_watermark(
-                    input_path,
-                    output_path,
-                    name  # Usando el nombre del archivo como código
-                )
+    # PNG y JPEG conservan su formato; BMP y TIFF se guardan como JPEG
+    images = [(filename, os.path.basename(default_output_path(filename)))
+              for filename in sorted(os.listdir(input_dir))
+              if filename.lower().endswith(supported_extensions)]
+
+    with BatchManifest(input_dir, output_dir) as manifest:
+        # Omitir las imágenes que ya se procesaron y no han cambiado (por
+        # ejemplo, al reanudar una ejecución interrumpida)
+        pending = manifest.pending(images)
+        if len(pending) < len(images):
+            print(f"{len(images) - len(pending)} imágenes sin cambios desde la última ejecución")
+
+        input_paths = []
+        output_paths = []
+        codes = []
+        for filename, output_filename in pending:
+            input_paths.append(os.path.join(input_dir, filename))
+            output_paths.append(os.path.join(output_dir, output_filename))
+            codes.append(os.path.splitext(filename)[0])  # Usando el nombre del archivo como código
+
+        def report(result):
+            filename = os.path.basename(result['input_path'])
+            if result['error']:
+                print(f"Error procesando {filename}: {result['error']}")
+            else:
+                manifest.record(filename, result['code'], os.path.basename(result['output_path']))
                 print(f"Completado: {filename}")
-            except Exception as e:
-                print(f"Error procesando {filename}: {str(e)}")
+
+        # Procesar las imágenes en paralelo, un proceso por núcleo de CPU
+        print(f"Procesando {len(input_paths)} imágenes...")
+        watermark_many(input_paths, codes, workers=workers, output_paths=output_paths,
+                       on_result=report)
 
 if __name__ == "__main__":
+    watermark_engine.log_font_path()
     script_dir = os.path.dirname(os.path.abspath(__file__))
     input_directory = os.path.join(script_dir, "input")
     output_directory = os.path.join(script_dir, "output")
-    
+
     os.makedirs(input_directory, exist_ok=True)
     os.makedirs(output_directory, exist_ok=True)
-    
-    process_directory(input_directory, output_directory)
-
-
-
-
 
+    process_directory(input_directory, output_directory)